@@ -0,0 +1,100 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+import metrics
+
+# Alternative to the thread-per-worker monitors: every monitor's polling cycle runs as a task on one
+# event loop. pixivpy3 is synchronous, so the actual requests (and whatever a new illustration
+# triggers) go through one fixed-size thread pool shared by all monitors. Each of those threads
+# checks out a client from the shared ClientPool, so connections are reused between artists.
+#
+# Concurrency is limited per monitor (monitor.max_concurrency) and per account (per_account_limit,
+# enforced by the token pool).
+# Checking an artist is the exact same Monitor.check_artist the threaded engine uses.
+# An error in one monitor's cycle gets logged and that monitor carries on with its next cycle; with
+# crash_on_exception, the whole process exits instead.
+
+class AsyncEngine:
+    def __init__(self, monitors, max_workers=8, per_account_limit=4):
+        self.monitors = monitors
+        self.max_workers = max_workers
+        self.per_account_limit = per_account_limit
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pixiv-monitor")
+
+        # the token pool enforces the per-account limit when handing out accounts
+        for monitor in monitors:
+            for token in monitor.token_switcher.tokens:
+                token.max_in_flight = per_account_limit
+
+        logging.getLogger().debug("Created async engine with %d monitors, %d workers, %d requests per account", len(monitors), max_workers, per_account_limit)
+
+    @staticmethod
+    def from_json(json_engine, monitors):
+        return AsyncEngine(monitors, json_engine.get("max_workers", 8), json_engine.get("per_account_limit", 4))
+
+    def run(self):
+        # created here rather than on the loop's thread, so add_monitor can use it right away
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_until_complete, args=(self.main(),), daemon=True).start()
+
+    async def main(self):
+        # the never-finished future keeps the loop going for monitors added later (see configwatch.py)
+        await asyncio.gather(*(self.monitor_loop(monitor) for monitor in self.monitors), self.loop.create_future())
+
+    def add_monitor(self, monitor):
+        # called from other threads
+        for token in monitor.token_switcher.tokens:
+            token.max_in_flight = self.per_account_limit
+        def done(future):
+            if not future.cancelled() and future.exception() is not None:
+                logging.getLogger().critical("Monitor %s stopped: %s", monitor.name, future.exception())
+        asyncio.run_coroutine_threadsafe(self.monitor_loop(monitor), self.loop).add_done_callback(done)
+
+    async def monitor_loop(self, monitor):
+        loop = asyncio.get_running_loop()
+        while not monitor.stopped:
+            # max_concurrency can change between cycles
+            semaphore = asyncio.Semaphore(monitor.max_concurrency)
+            cycle_start = time.monotonic()
+            try:
+                await loop.run_in_executor(self.executor, monitor.start_cycle)
+                artist_ids = monitor.cycle_artists()
+            except Exception as e:
+                # an empty cycle, so it still ends and the next one gets started
+                self.handle_error(monitor, "starting a cycle", e)
+                artist_ids = []
+            metrics.CYCLE_ARTISTS.set(len(artist_ids), monitor=monitor.name)
+            metrics.QUEUE_DEPTH.set(len(artist_ids), monitor=monitor.name)
+            results = await asyncio.gather(*(self.check_artist(monitor, semaphore, artist_id) for artist_id in artist_ids), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    self.handle_error(monitor, "checking an artist", result)
+            try:
+                await loop.run_in_executor(self.executor, monitor.end_cycle)
+            except Exception as e:
+                self.handle_error(monitor, "ending a cycle", e)
+            metrics.CYCLE_SECONDS.observe(time.monotonic() - cycle_start, monitor=monitor.name)
+            # in steps, so monitor.wake can cut it short
+            wake_at = time.monotonic() + monitor.cycle_sleep_time()
+            while not monitor.wake.is_set() and time.monotonic() < wake_at:
+                await asyncio.sleep(min(1, wake_at - time.monotonic()))
+            monitor.wake.clear()
+        metrics.CYCLE_ARTISTS.set(0, monitor=monitor.name)
+
+    async def check_artist(self, monitor, semaphore, artist_id):
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(self.executor, monitor.check_artist, artist_id)
+            finally:
+                metrics.QUEUE_DEPTH.dec(monitor=monitor.name)
+
+    def handle_error(self, monitor, what, e):
+        # every monitor runs on the same loop; letting this through would stop all of them
+        if monitor.config.get("crash_on_exception", False):
+            logging.getLogger().critical("Error while %s of monitor %s, exiting since crash_on_exception is set: %s", what, monitor.name, e, exc_info=e)
+            os._exit(1)
+        logging.getLogger().error("Error while %s of monitor %s: %s", what, monitor.name, e, exc_info=e)
@@ -0,0 +1,197 @@
+import logging
+import os
+import queue
+import threading
+import time
+import illustlog
+import jsoncodec
+import metrics
+import utility
+from monitor import fetch_user_illusts, next_offset
+from pixivmodel import PixivIllustration
+from tokenswitcher import TokenSwitcher
+
+CHECKPOINT_PATH = "./backfill.json"
+
+# artists without a watermark yet are tried again this often, this many times
+DEFER_INTERVAL = 60
+DEFER_ROUNDS = 10
+
+# main.py --backfill: monitors only ever look at the newest 30 illustrations of an artist, so anything
+# older (artists that were just added, or everything posted during a long downtime) never gets logged.
+# This pages through every artist's whole history and quietly adds what's missing to the seen set and
+# the illustration log. No notifications, no hooks.
+#
+# It runs next to the monitors, on a few threads of its own, and only takes an account when that
+# account has `reserve` requests of budget to spare, so live polling always comes first.
+# Illustrations newer than an artist's watermark are left to the monitors, so backfilling can't
+# swallow a new illustration before it gets notified. That's why it needs watermarks, and why an artist
+# the monitors haven't checked yet (no watermark) waits until they have; artists that still don't have
+# one after a while are left for the next --backfill.
+#
+# Progress is checkpointed per artist in backfill.json, so a restart picks up where it left off.
+# Artists that were done before are only paged back to where that run started, so running it again
+# after some downtime only fetches what's new.
+
+class BackfillCheckpoint:
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        # artist ID -> {"offset": next page, "newest": newest ID of this run, "until": stop at this ID}
+        # while in progress, {"complete": newest ID} once done
+        self.artists = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as checkpoint_json:
+                self.artists = {int(k): v for k, v in jsoncodec.load(checkpoint_json)["artists"].items()}
+
+    def get(self, artist_id):
+        return self.artists.get(artist_id)
+
+    def update(self, artist_id, entry):
+        with self.lock:
+            self.artists[artist_id] = entry
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as checkpoint_json:
+                jsoncodec.dump({"artists": self.artists}, checkpoint_json)
+            os.replace(temp_path, self.path)
+            self.dirty = False
+
+class Backfill:
+    def __init__(self, artist_ids, clients, token_switcher, seen, checkpoint, watermarks, num_threads=2, save_interval=10):
+        self.artist_ids = artist_ids
+        self.clients = clients
+        self.token_switcher = token_switcher
+        self.seen = seen
+        self.checkpoint = checkpoint
+        self.watermarks = watermarks
+        self.num_threads = num_threads
+        self.save_interval = save_interval
+        self.done = threading.Event()
+        self.num_added = 0
+        self.stats_lock = threading.Lock()
+        self.deferred = []
+
+    @staticmethod
+    def from_json(json_backfill, artist_ids, clients, token_switcher, seen, watermarks):
+        # same accounts as the monitors, but it keeps out of their way
+        backfill_token_switcher = TokenSwitcher(len(token_switcher.tokens), False)
+        backfill_token_switcher.tokens = token_switcher.tokens
+        backfill_token_switcher.reserve = json_backfill.get("reserve", 2)
+        checkpoint = BackfillCheckpoint(json_backfill.get("path", CHECKPOINT_PATH))
+        return Backfill(artist_ids, clients, backfill_token_switcher, seen, checkpoint, watermarks, json_backfill.get("num_threads", 2), json_backfill.get("save_interval", 10))
+
+    def run(self):
+        # unfinished artists from last time first
+        in_progress = [artist_id for artist_id in self.artist_ids if "offset" in (self.checkpoint.get(artist_id) or {})]
+        in_progress_set = set(in_progress)
+        artist_ids = in_progress + [artist_id for artist_id in self.artist_ids if artist_id not in in_progress_set]
+        logging.getLogger().info("Backfilling %d artists (%d unfinished from last time) on %d threads", len(self.artist_ids), len(in_progress), self.num_threads)
+        threading.Thread(target=self.save_loop, daemon=True).start()
+        threading.Thread(target=self.rounds, args=(artist_ids,), daemon=True).start()
+
+    def rounds(self, artist_ids):
+        for i in range(DEFER_ROUNDS + 1):
+            if i > 0:
+                logging.getLogger().info("Waiting for the monitors to check %d artists before backfilling them", len(artist_ids))
+                time.sleep(DEFER_INTERVAL)
+            self.deferred = []
+            self.run_round(artist_ids)
+            artist_ids = self.deferred
+            if not artist_ids:
+                break
+        if artist_ids:
+            logging.getLogger().warning("Skipped %d artists the monitors never got a watermark for; the next --backfill tries them again", len(artist_ids))
+        self.save()
+        logging.getLogger().info("Backfill finished: %d illustrations added", self.num_added)
+        self.done.set()
+
+    def run_round(self, artist_ids):
+        artist_queue = queue.Queue()
+        for artist_id in artist_ids:
+            artist_queue.put(artist_id)
+        metrics.BACKFILL_LEFT.set(artist_queue.qsize())
+        threads = [threading.Thread(target=self.worker, args=(artist_queue,), daemon=True) for _ in range(self.num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def worker(self, artist_queue):
+        while True:
+            try:
+                artist_id = artist_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if self.watermarks.get(artist_id) is None:
+                    # not checked by a monitor yet; whatever we'd find might be new
+                    with self.stats_lock:
+                        self.deferred.append(artist_id)
+                else:
+                    self.backfill_artist(artist_id)
+            except Exception as e:
+                # stays in the checkpoint as it was; the next --backfill tries again
+                logging.getLogger().error("Error while backfilling artist %d: %s", artist_id, e)
+            metrics.BACKFILL_LEFT.dec()
+
+    def backfill_artist(self, artist_id):
+        entry = self.checkpoint.get(artist_id) or {}
+        if "offset" not in entry:
+            entry = {"offset": None, "newest": None, "until": entry.get("complete")}
+        offset, newest, until = entry["offset"], entry["newest"], entry["until"]
+        # anything newer than this is the monitors' job
+        watermark = self.watermarks.get(artist_id)
+        num_added = 0
+        while True:
+            page = utility.api_wrapper(self.clients, self.token_switcher, fetch_user_illusts, artist_id, None, offset)
+            if "error" in page:
+                raise RuntimeError(page["error"])
+            illusts = page["illusts"]
+            if newest is None and illusts:
+                newest = illusts[0]["id"]
+            reached_until = False
+            new_illusts = []
+            for illust_json in illusts:
+                if until is not None and illust_json["id"] <= until:
+                    reached_until = True
+                    break
+                if illust_json["id"] > watermark:
+                    continue
+                if not self.seen.query_illust(illust_json["id"]):
+                    new_illusts.append(illust_json)
+            self.add(new_illusts)
+            num_added += len(new_illusts)
+
+            offset = next_offset(page.get("next_url"))
+            if reached_until or offset is None:
+                self.checkpoint.update(artist_id, {"complete": max(newest or 0, until or 0)})
+                break
+            self.checkpoint.update(artist_id, {"offset": offset, "newest": newest, "until": until})
+        logging.getLogger().debug("Backfilled artist %d: %d illustrations added", artist_id, num_added)
+
+    def add(self, illusts_json):
+        if not illusts_json:
+            return
+        illusts = [PixivIllustration.from_json(illust_json) for illust_json in illusts_json]
+        self.seen.add_illusts([illust.iden for illust in illusts])
+        illustlog.log_illusts(illusts)
+        self.seen.flush()
+        metrics.BACKFILL_ILLUSTS.inc(len(illusts))
+        with self.stats_lock:
+            self.num_added += len(illusts)
+
+    def save_loop(self):
+        while not self.done.wait(self.save_interval):
+            self.save()
+
+    def save(self):
+        # the seen set has to be on disk before the checkpoint says those pages are done
+        self.seen.flush(force=True)
+        self.checkpoint.save()
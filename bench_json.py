@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# Measures how fast user_illusts responses parse with each JSON library that's installed, including
+# pixivpy's own parsing (json with an object_hook) and msgspec's typed decoding that jsoncodec uses.
+# By default it uses synthetic responses (see bench_model.py); pass --payloads with saved responses,
+# e.g. from `curl -H "Authorization: Bearer ..." "https://app-api.pixiv.net/v1/user/illusts?user_id=..."`,
+# to measure on real ones.
+# Usage: bench_json.py [--payloads response1.json ...] [--count 200] [--rounds 5]
+
+import argparse
+import json
+import time
+import jsoncodec
+from bench_model import make_user_illusts, FIRST_ID
+
+class JsonDict(dict):
+    # what pixivpy decodes every object into
+    def __getattr__(self, attr):
+        return self[attr]
+
+def make_decoders():
+    decoders = {
+        "json (pixivpy)": lambda data: json.loads(data, object_hook=JsonDict),
+        "json": json.loads
+    }
+    if jsoncodec.orjson is not None:
+        decoders["orjson"] = jsoncodec.orjson.loads
+    if jsoncodec.msgspec is not None:
+        decoders["msgspec"] = jsoncodec.msgspec.json.Decoder().decode
+        decoders["msgspec (typed)"] = jsoncodec.msgspec.json.Decoder(jsoncodec.IllustPage).decode
+    return decoders
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payloads", nargs="+", default=None, help="Saved user_illusts responses to parse.")
+    parser.add_argument("--count", type=int, default=200, help="Number of synthetic responses.")
+    parser.add_argument("--rounds", type=int, default=5, help="How many times to parse all of them.")
+    args = parser.parse_args()
+
+    if args.payloads is not None:
+        payloads = []
+        for path in args.payloads:
+            with open(path, "rb") as payload_file:
+                payloads.append(payload_file.read())
+    else:
+        payloads = [json.dumps(make_user_illusts(artist_id, FIRST_ID + artist_id * 1000), ensure_ascii=False).encode("utf-8") for artist_id in range(args.count)]
+    total_size = sum(len(payload) for payload in payloads)
+
+    print(f"{len(payloads)} responses, {total_size / len(payloads) / 1024:.1f} KiB each on average; jsoncodec uses {jsoncodec.BACKEND}")
+    for name, decode in make_decoders().items():
+        best = None
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            for payload in payloads:
+                decode(payload)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{name:>16}: {len(payloads) / best:9.0f} responses/s | {total_size / best / 1024 / 1024:7.1f} MiB/s")
+
+if __name__ == "__main__":
+    main()
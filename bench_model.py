@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Measures what the illustration model costs per poll cycle: allocations (blocks and bytes, with
+# tracemalloc) and time, for a cycle over --artists synthetic user_illusts responses of 30 illustrations
+# each where --new-fraction of them haven't been seen yet.
+#  eager: every illustration fully decoded (what from_json used to do)
+#   lazy: every illustration wrapped, nothing decoded
+# checked: only unseen illustrations wrapped and decoded (what Monitor.check_artist does)
+# Usage: bench_model.py [--artists 500] [--new-fraction 0.02] [--cycles 5]
+
+import argparse
+import random
+import time
+import tracemalloc
+from pixivmodel import PixivIllustration
+
+ILLUSTS_PER_PAGE = 30
+FIRST_ID = 100000000
+
+TAGS = [("オリジナル", "original"), ("女の子", "girl"), ("風景", "scenery"), ("R-18", None), ("落書き", "doodle"), ("ファンアート", "fan art")]
+
+def make_illust_json(iden, artist_id):
+    tags = random.sample(TAGS, random.randint(1, 5))
+    page_count = random.choice([0, 0, 0, 2, 5])
+    return {
+        "id": iden,
+        "title": f"illustration {iden}",
+        "type": "illust",
+        "image_urls": {"square_medium": f"https://i.pximg.net/c/360x360_70/img-master/img/{iden}_p0_square1200.jpg"},
+        "caption": "some caption<br />with a second line" if iden % 3 else "",
+        "restrict": 0,
+        "user": {"id": artist_id, "name": f"artist {artist_id}", "account": f"artist{artist_id}", "profile_image_urls": {"medium": ""}, "is_followed": True},
+        "tags": [{"name": name, "translated_name": translated_name} for name, translated_name in tags],
+        "create_date": "2024-05-01T12:00:00+09:00",
+        "page_count": max(1, page_count),
+        "sanity_level": random.choice([2, 2, 4, 6]),
+        "meta_pages": [{"image_urls": {"original": f"https://i.pximg.net/img-original/img/{iden}_p{page}.png"}} for page in range(page_count)],
+        "total_view": random.randint(0, 100000),
+        "total_bookmarks": random.randint(0, 10000),
+        "illust_ai_type": random.choice([0, 1, 2])
+    }
+
+def make_user_illusts(artist_id, first_id):
+    return {
+        "illusts": [make_illust_json(first_id - i, artist_id) for i in range(ILLUSTS_PER_PAGE)],
+        "next_url": None
+    }
+
+def decode_all(illust):
+    illust.title, illust.caption, illust.user, illust.tags, illust.page_count, illust.is_ai, illust.is_sensitive
+
+def eager(responses, seen):
+    kept = []
+    for response in responses:
+        for illust_json in response["illusts"]:
+            illust = PixivIllustration.from_json(illust_json)
+            decode_all(illust)
+            kept.append(illust)
+    return kept
+
+def lazy(responses, seen):
+    return [PixivIllustration.from_json(illust_json) for response in responses for illust_json in response["illusts"]]
+
+def checked(responses, seen):
+    kept = []
+    for response in responses:
+        for illust_json in response["illusts"]:
+            if illust_json["id"] not in seen:
+                illust = PixivIllustration.from_json(illust_json)
+                decode_all(illust)
+                illust.get_tag_string(False)
+                illust.get_r18_tag()
+                kept.append(illust)
+    return kept
+
+MODES = {"eager": eager, "lazy": lazy, "checked": checked}
+
+def bench_mode(mode, responses, seen, cycles):
+    blocks = 0
+    size = 0
+    elapsed = 0
+    for _ in range(cycles):
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        kept = mode(responses, seen)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        for stat in after.compare_to(before, "filename"):
+            blocks += stat.count_diff
+            size += stat.size_diff
+        del kept
+
+        start = time.perf_counter()
+        mode(responses, seen)
+        elapsed += time.perf_counter() - start
+    return blocks / cycles, size / cycles, elapsed / cycles
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--artists", type=int, default=500, help="Number of artists polled per cycle.")
+    parser.add_argument("--new-fraction", type=float, default=0.02, help="Fraction of illustrations that haven't been seen yet.")
+    parser.add_argument("--cycles", type=int, default=5, help="Number of cycles to average over.")
+    args = parser.parse_args()
+
+    responses = [make_user_illusts(artist_id, FIRST_ID + artist_id * 1000) for artist_id in range(args.artists)]
+    all_ids = [illust_json["id"] for response in responses for illust_json in response["illusts"]]
+    seen = set(random.sample(all_ids, int(len(all_ids) * (1 - args.new_fraction))))
+
+    print(f"{args.artists} artists, {len(all_ids)} illustrations per cycle, {len(all_ids) - len(seen)} new")
+    for name, mode in MODES.items():
+        blocks, size, elapsed = bench_mode(mode, responses, seen, args.cycles)
+        print(f"{name:>7}: {blocks:9.0f} allocations | {size / 1024:9.1f} KiB | {elapsed * 1e3:7.2f} ms per cycle")
+
+if __name__ == "__main__":
+    main()
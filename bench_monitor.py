@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Runs a real Monitor end to end against mockpixiv.py for a while and reports what it managed:
+# artists checked and requests made per second, time from an illustration being posted to it being
+# found (p50/p99), CPU use and peak memory. Every artist count runs in a process of its own, so the
+# numbers don't leak into each other; the mock server runs in another one.
+# Nothing is written outside a temporary directory, and no notifications or hooks run.
+# Usage: bench_monitor.py [--artists 100 1000 10000] [--duration 60] [--threads 30] [--accounts 2]
+
+import argparse
+import contextlib
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import jsoncodec
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_mock(args, num_artists):
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.join(REPO_DIR, "mockpixiv.py"), "--port", str(port), "--artists", str(num_artists),
+        "--latency", str(args.latency), "--post-interval", str(args.post_interval), "--rate-limit", str(args.rate_limit),
+        "--account-rate", str(args.account_rate), "--invalid-grant", str(args.invalid_grant)
+    ], stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            urllib.request.urlopen(url + "/", timeout=1)
+        except urllib.error.HTTPError:
+            return process, url # it's up, it just doesn't have a /
+        except OSError:
+            if time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("mock server didn't start")
+            time.sleep(0.1)
+
+def peak_memory_mib():
+    try:
+        import resource
+    except ImportError:
+        return None # windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024 # bytes on macOS, KiB elsewhere
+
+def run_one(args, num_artists):
+    # everything pixiv-monitor imports is imported here, so the parent process stays small
+    from pixivpy3 import AppPixivAPI
+    import main
+    import metrics
+    import mockpixiv
+    import scheduler
+    import settings
+    import tokenswitcher
+    from clientpool import ClientPool
+    from monitor import Monitor
+    from seen import SeenIllustrations
+    from watermark import WatermarkCache
+
+    detections = []
+
+    class BenchMonitor(Monitor):
+        def new_illust(self, illust_json):
+            detections.append(time.time() - scheduler.parse_date(illust_json["create_date"]))
+            super().new_illust(illust_json)
+
+    mock_process, url = start_mock(args, num_artists)
+    tokenswitcher.AUTH_TOKEN_URL = url + "/auth/token"
+    for i in range(args.accounts):
+        os.environ[f"ACCESS_TOKEN{i}"] = "not-handed-out-yet" # the first request refreshes it
+        os.environ[f"REFRESH_TOKEN{i}"] = f"bench-refresh-{i}"
+
+    def make_client():
+        api = AppPixivAPI()
+        api.set_api_proxy(url)
+        return api
+
+    artist_ids = list(range(mockpixiv.FIRST_ARTIST_ID, mockpixiv.FIRST_ARTIST_ID + num_artists))
+    config = {
+        "artist_ids": artist_ids,
+        "num_accounts": args.accounts,
+        "check_interval": args.check_interval,
+        "num_threads": args.threads,
+        "engine": args.engine,
+        "shared": {"num_threads": args.threads},
+        "rate_limit": {"rate": args.client_rate, "burst": max(5, args.client_rate)}
+    }
+    if not settings.check_config(config):
+        raise RuntimeError("bad config")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+        try:
+            seen = SeenIllustrations.from_json(config["seen"])
+            # what every artist had before the benchmark counts as known, like after a first run
+            watermarks = WatermarkCache()
+            for artist_id in artist_ids:
+                watermarks.update(artist_id, mockpixiv.history_watermark(artist_id))
+            token_switcher = main.load_token_switcher(config)
+            clients = ClientPool(make_client)
+            tokenswitcher.TokenRefresher.from_json(config["token_refresh"], token_switcher.tokens).run()
+            monitor = BenchMonitor(args.check_interval, artist_ids, config, clients, seen, token_switcher, [], args.threads, args.threads, None, None, watermarks)
+
+            start = time.monotonic()
+            cpu_start = time.process_time()
+            # new illustrations get printed, which isn't what's being measured
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                main.start_monitors(config, [monitor])
+                time.sleep(args.duration)
+            elapsed = time.monotonic() - start
+            cpu = time.process_time() - cpu_start
+        finally:
+            os.chdir(REPO_DIR)
+            mock_process.kill()
+
+    detections.sort()
+    return {
+        "artists": num_artists,
+        "checks_per_second": metrics.ARTIST_SECONDS.count() / elapsed,
+        "requests_per_second": metrics.API_SECONDS.count() / elapsed,
+        "cycles": metrics.CYCLE_SECONDS.count(),
+        "found": len(detections),
+        "detection_p50": statistics.median(detections) if detections else None,
+        "detection_p99": detections[min(len(detections) - 1, int(len(detections) * 0.99))] if detections else None,
+        "api_p50": metrics.API_SECONDS.quantile(0.5),
+        "api_p99": metrics.API_SECONDS.quantile(0.99),
+        "rate_limits": metrics.RATE_LIMITS.total(),
+        "refreshes": metrics.TOKEN_REFRESHES.total(),
+        "cpu_percent": cpu / elapsed * 100,
+        "peak_memory_mib": peak_memory_mib()
+    }
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:.2f}s"
+
+def print_result(result):
+    memory = "-" if result["peak_memory_mib"] is None else f"{result['peak_memory_mib']:.0f} MiB"
+    print(
+        f"{result['artists']:>7} artists: {result['checks_per_second']:8.1f} checks/s, {result['requests_per_second']:8.1f} requests/s, {result['cycles']} cycles | "
+        f"found {result['found']}, detection p50 {format_seconds(result['detection_p50'])} p99 {format_seconds(result['detection_p99'])} | "
+        f"API p50 {format_seconds(result['api_p50'])} p99 {format_seconds(result['api_p99'])}, {result['rate_limits']} rate limits, {result['refreshes']} refreshes | "
+        f"CPU {result['cpu_percent']:.0f}%, peak {memory}"
+    )
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--artists", type=int, nargs="+", default=[100, 1000, 10000], help="Numbers of artists to run with, one run each.")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds per run.")
+    parser.add_argument("--engine", choices=["threads", "async", "shared"], default="threads")
+    parser.add_argument("--threads", type=int, default=30, help="num_threads of the monitor (of the pool, with --engine shared).")
+    parser.add_argument("--accounts", type=int, default=2)
+    parser.add_argument("--check-interval", type=float, default=5, help="Seconds to wait between cycles.")
+    parser.add_argument("--client-rate", type=float, default=100, help="rate_limit.rate: requests per second per account on our side.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock server: average seconds per request.")
+    parser.add_argument("--post-interval", type=float, default=600, help="Mock server: average seconds between an artist's posts.")
+    parser.add_argument("--rate-limit", type=float, default=0, help="Mock server: fraction of requests that get rate limited anyway.")
+    parser.add_argument("--account-rate", type=float, default=0, help="Mock server: requests per second per account before rate limiting, 0 for none.")
+    parser.add_argument("--invalid-grant", type=float, default=0, help="Mock server: fraction of requests that fail with invalid_grant.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines.")
+    parser.add_argument("--run", type=int, default=None, help=argparse.SUPPRESS) # one run, in the child process
+    args = parser.parse_args()
+
+    if args.run is not None:
+        print(jsoncodec.dumps(run_one(args, args.run)), flush=True)
+        os._exit(0) # the monitor threads never stop by themselves
+
+    child_args = sys.argv[1:]
+    for num_artists in args.artists:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), *child_args, "--run", str(num_artists)], capture_output=True, text=True, cwd=REPO_DIR)
+        if output.returncode != 0:
+            print(f"{num_artists} artists: failed\n{output.stderr}")
+            continue
+        result = jsoncodec.loads(output.stdout.strip().splitlines()[-1])
+        if args.json:
+            print(jsoncodec.dumps(result))
+        else:
+            print_result(result)
+
+if __name__ == "__main__":
+    main()
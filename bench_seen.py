@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Compares the seen index backends: memory used, time to load a snapshot and lookup speed.
+# Usage: bench_seen.py [--sizes 1000000 10000000] [--lookups 200000]
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from seenindex import make_index, write_snapshot, BACKENDS
+
+FIRST_ID = 100000000 # pixiv IDs are 9 digits these days
+
+def make_ids(count):
+    # roughly as dense as real IDs: a few percent of the ID space
+    return sorted(random.sample(range(FIRST_ID, FIRST_ID + count * 20), count))
+
+def bench_backend(backend, snapshot_path, ids, lookups):
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = make_index(backend)
+    index.load_snapshot(snapshot_path)
+    load_time = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    hits = random.sample(ids, min(lookups, len(ids)))
+    misses = [iden + 1 for iden in hits] # probably not in there
+    start = time.perf_counter()
+    for iden in hits:
+        iden in index
+    for iden in misses:
+        iden in index
+    lookup_time = (time.perf_counter() - start) / (len(hits) + len(misses))
+
+    batch = [iden + 1 for iden in random.sample(ids, min(1000, len(ids)))]
+    start = time.perf_counter()
+    index.update(batch)
+    batch_time = time.perf_counter() - start
+
+    return memory, load_time, lookup_time, batch_time
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000000, 10000000], help="Number of IDs to test with.")
+    parser.add_argument("--lookups", type=int, default=200000, help="Number of lookups (half hits, half misses).")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(f"== {size} IDs ==")
+        ids = make_ids(size)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snapshot_path = os.path.join(temp_dir, "seen.bin")
+            write_snapshot(snapshot_path, ids)
+            print(f"snapshot file: {os.path.getsize(snapshot_path) / 1024 / 1024:.1f} MiB")
+            for backend in BACKENDS:
+                memory, load_time, lookup_time, batch_time = bench_backend(backend, snapshot_path, ids, args.lookups)
+                print(f"{backend:>6}: heap {memory / 1024 / 1024:8.1f} MiB | load {load_time:6.2f} s | lookup {lookup_time * 1e6:6.2f} us | 1000-ID batch insert {batch_time * 1e3:6.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import contextlib
+import threading
+import logging
+
+# A pool of API clients. Every request checks out a client of its own, so setting the access token
+# for one request can't change which account another request uses. Each client has its own
+# requests session, and since idle clients are reused (most recently used first), their
+# keep-alive connections are reused too.
+
+class ClientPool:
+    def __init__(self, factory, max_size=None):
+        self.factory = factory
+        self.max_size = max_size
+        self.condition = threading.Condition()
+        self.idle = []
+        self.size = 0
+
+    def acquire(self):
+        with self.condition:
+            while not self.idle and self.max_size is not None and self.size >= self.max_size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.size += 1
+        logging.getLogger().debug("Creating API client #%d", self.size)
+        try:
+            return PooledClient(self.factory())
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, client):
+        with self.condition:
+            self.idle.append(client)
+            self.condition.notify()
+
+    @contextlib.contextmanager
+    def client(self, access_token):
+        pooled = self.acquire()
+        try:
+            if pooled.access_token != access_token:
+                pooled.api.set_auth(access_token)
+                pooled.access_token = access_token
+            yield pooled.api
+        finally:
+            self.release(pooled)
+
+class PooledClient:
+    def __init__(self, api):
+        self.api = api
+        self.access_token = None
@@ -0,0 +1,216 @@
+import logging
+import os
+import threading
+import jsoncodec
+import settings
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+# Reloads settings.json while pixiv-monitor is running, so editing the artist list doesn't mean a
+# restart (which reloads the seen set, restarts every thread and logs every account in again).
+#
+# The new file goes through settings.check_config first; if it doesn't pass, everything stays as it
+# was. Otherwise it's compared to what's running and only the difference gets applied:
+# - artist_ids: artists are added to and removed from the running monitors (and their schedules).
+#   Artists that are already queued this cycle still get checked.
+# - check_interval, num_threads, max_concurrency, weight: changed in place; worker threads are started or
+#   leave once they're done with what they're doing.
+# - monitors: new ones are started, removed ones stop after their current cycle. A monitor whose
+#   other options (accounts, type, schedule...) changed gets replaced by a new one.
+# - hooks, hook_workers: hooks that are still there keep running (batch hooks keep their process),
+#   removed ones get whatever was already queued for them and are closed.
+# - crash_on_exception takes effect right away.
+# Anything else needs a restart, which gets logged.
+# Monitors are matched by their "name", or by their position in "monitors" if they don't have one.
+
+LIVE_KEYS = {"artist_ids", "monitors", "check_interval", "num_threads", "hooks", "hook_workers", "crash_on_exception"}
+MONITOR_KEYS = {"artist_ids", "check_interval", "num_threads", "max_concurrency", "weight"}
+# not there with sharding; the monitors are in the worker processes
+HOOK_KEYS = {"hooks", "hook_workers"}
+
+class SettingsChangeHandler(FileSystemEventHandler):
+    def __init__(self, changed, path):
+        self.changed = changed
+        self.path = os.path.abspath(path)
+
+    def on_modified(self, event):
+        if os.path.abspath(event.src_path) == self.path:
+            self.changed.set()
+
+    def on_created(self, event):
+        if os.path.abspath(event.src_path) == self.path:
+            self.changed.set()
+
+    def on_moved(self, event):
+        # editors that save to a temporary file and rename it over the old one
+        if os.path.abspath(event.dest_path) == self.path:
+            self.changed.set()
+
+class ConfigReloader:
+    def __init__(self, config, hooks, monitors=None, build=None, engine=None, debounce=1, path=settings.SETTINGS_PATH):
+        # config, hooks and monitors are the running ones and get changed in place
+        self.config = config
+        self.hooks = hooks
+        self.monitors = monitors
+        # build(json_monitor, name) -> Monitor
+        self.build = build
+        self.engine = engine
+        self.debounce = debounce
+        self.path = path
+        self.changed = threading.Event()
+
+    def run(self):
+        observer = Observer()
+        observer.schedule(SettingsChangeHandler(self.changed, self.path), path=os.path.dirname(os.path.abspath(self.path)), recursive=False)
+        observer.start()
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def loop(self):
+        while True:
+            self.changed.wait()
+            # saving can take more than one write
+            self.changed.clear()
+            while self.changed.wait(self.debounce):
+                self.changed.clear()
+            try:
+                self.reload()
+            except Exception as e:
+                logging.getLogger().error("Error while reloading %s: %s", self.path, e)
+
+    def reload(self):
+        logger = logging.getLogger()
+        try:
+            with open(self.path, encoding="utf-8") as config_json:
+                new_config = jsoncodec.load(config_json)
+        except (OSError,) + jsoncodec.DECODE_ERRORS as e:
+            logger.error("Could not read %s, keeping the current settings: %s", self.path, e)
+            return
+        if not isinstance(new_config, dict) or not settings.check_config(new_config, quiet=True):
+            logger.error("%s didn't pass the config check, keeping the current settings", self.path)
+            return
+
+        changed = {key for key in self.config.keys() | new_config.keys() if self.config.get(key) != new_config.get(key)}
+        if not changed:
+            return
+        live_keys = LIVE_KEYS if self.monitors is not None else HOOK_KEYS
+        if self.monitors is not None and ("monitors" in self.config) != ("monitors" in new_config):
+            # a single monitor and a list of them are built differently
+            live_keys = live_keys - {"artist_ids", "monitors", "check_interval", "num_threads"}
+        needs_restart = changed - live_keys
+        if needs_restart:
+            logger.warning("Changes to %s need a restart to take effect", ", ".join(sorted(needs_restart)))
+        changed &= live_keys
+        if not changed:
+            return
+
+        if changed & {"hooks", "hook_workers"}:
+            self.reload_hooks(new_config)
+        if self.monitors is not None and changed & {"artist_ids", "monitors", "check_interval", "num_threads"}:
+            self.reload_monitors(new_config)
+        for key in changed:
+            if key in new_config:
+                self.config[key] = new_config[key]
+            else:
+                self.config.pop(key, None)
+        logger.info("Reloaded %s: %s", self.path, ", ".join(sorted(changed)))
+
+    def reload_hooks(self, new_config):
+        from hook import Hook, HookExecutor
+        old_hooks = list(self.hooks)
+        executor = old_hooks[0].executor if old_hooks else None
+        old_executor = None
+        if executor is not None and new_config.get("hook_workers", 4) != self.config.get("hook_workers", 4):
+            old_executor = executor
+            executor = None
+        if executor is None and new_config.get("hooks"):
+            executor = HookExecutor(new_config.get("hook_workers", 4))
+
+        new_hooks = []
+        num_kept = 0
+        for json_hook in new_config.get("hooks", []):
+            hook = next((hook for hook in old_hooks if hook.json == json_hook and hook.executor is executor), None)
+            if hook is not None:
+                old_hooks.remove(hook)
+                num_kept += 1
+            else:
+                hook = Hook.from_json(json_hook, executor)
+            new_hooks.append(hook)
+        self.hooks[:] = new_hooks
+
+        # after whatever's already queued for them
+        for hook in old_hooks:
+            hook.executor.submit(hook.close)
+        if old_executor is not None:
+            old_executor.shutdown()
+        logging.getLogger().info("Hooks reloaded: %d kept, %d new, %d removed", num_kept, len(new_hooks) - num_kept, len(old_hooks))
+
+    def reload_monitors(self, new_config):
+        logger = logging.getLogger()
+        old_jsons = monitor_jsons(self.config)
+        new_jsons = monitor_jsons(new_config)
+        by_name = {monitor.name: monitor for monitor in self.monitors}
+
+        for name, json_monitor in new_jsons.items():
+            old_json = old_jsons.get(name)
+            monitor = by_name.get(name)
+            if old_json == json_monitor and monitor is not None:
+                continue
+            if monitor is not None and other_options(old_json) == other_options(json_monitor):
+                self.update_monitor(monitor, json_monitor, new_config)
+                continue
+            try:
+                new_monitor = self.build(json_monitor, name)
+            except Exception as e:
+                logger.error("Could not create monitor %s, leaving it as it was: %s", name, e)
+                continue
+            if monitor is not None:
+                logger.info("Options of monitor %s changed, replacing it", name)
+                self.stop_monitor(monitor)
+            else:
+                logger.info("Starting new monitor %s with %d artists", name, len(json_monitor["artist_ids"]))
+            self.monitors.append(new_monitor)
+            if self.engine is not None:
+                self.engine.add_monitor(new_monitor)
+            else:
+                new_monitor.run()
+
+        for name, monitor in by_name.items():
+            if name not in new_jsons:
+                logger.info("Monitor %s was removed, stopping it after its current cycle", name)
+                self.stop_monitor(monitor)
+
+    def stop_monitor(self, monitor):
+        monitor.stop()
+        self.monitors.remove(monitor)
+
+    def update_monitor(self, monitor, json_monitor, new_config):
+        old_artist_ids = set(monitor.artist_ids)
+        new_artist_ids = set(json_monitor["artist_ids"])
+        monitor.set_artist_ids(list(json_monitor["artist_ids"]))
+
+        check_interval = json_monitor.get("check_interval", 30)
+        monitor.check_interval = check_interval
+        if monitor.scheduler is not None:
+            # schedule.min_interval defaults to check_interval
+            json_schedule = {**new_config["schedule"], **json_monitor.get("schedule", {})}
+            monitor.scheduler.min_interval = json_schedule.get("min_interval", check_interval)
+
+        num_threads = json_monitor.get("num_threads", 30)
+        monitor.resize(num_threads)
+        monitor.max_concurrency = json_monitor.get("max_concurrency", num_threads)
+        monitor.weight = json_monitor.get("weight", 1)
+        # new artists shouldn't have to wait out the sleep
+        monitor.wake.set()
+        logging.getLogger().info(
+            "Monitor %s: %d artists added, %d removed, check_interval %s, %d threads",
+            monitor.name, len(new_artist_ids - old_artist_ids), len(old_artist_ids - new_artist_ids), check_interval, num_threads
+        )
+
+def monitor_jsons(config):
+    # name -> options, the same way main.build_monitors sees them
+    if "monitors" not in config:
+        return {"0": {"artist_ids": config["artist_ids"], "check_interval": config["check_interval"], "num_threads": config.get("num_threads", 3)}}
+    return {str(json_monitor.get("name", i)): json_monitor for i, json_monitor in enumerate(config["monitors"])}
+
+def other_options(json_monitor):
+    return {key: value for key, value in json_monitor.items() if key not in MONITOR_KEYS}
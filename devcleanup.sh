@@ -1,6 +1,15 @@
 #!/bin/sh
 
 rm -f seen.json
+rm -f seen.bin
+rm -f seen.journal
 rm -f pixiv-monitor.log
 rm -f illustlog.json
+rm -f illustlog.jsonl
+rm -f illustlog.idx
 rm -f pixiv.atom
+rm -f schedule.json
+rm -f watermarks.json
+rm -f backfill.json
+rm -f *.shard*.json
+rm -f pixiv-monitor*.db*
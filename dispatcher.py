@@ -0,0 +1,133 @@
+import logging
+import queue
+import threading
+import time
+import requests
+import requests.adapters
+import urllib3.util.retry
+import metrics
+import notify
+
+# Sends notifications off the polling path. Workers just put new illustrations on a bounded queue;
+# a dispatcher thread picks them up, waits `window` seconds for more to arrive, and groups them:
+# - one illustration from an artist: the usual notification
+# - several from one artist: "N new illustrations from X"
+# - more than max_individual artists at once: one "N new illustrations from M artists" notification
+# ntfy requests go through one session with keep-alive, a timeout and retries.
+
+class NotificationDispatcher:
+    def __init__(self, system_notifications=True, ntfy_topic=None, ntfy_server=notify.NTFY_SERVER, window=5, queue_size=1000, max_individual=5):
+        self.system_notifications = system_notifications
+        self.ntfy_topic = ntfy_topic
+        self.ntfy_server = ntfy_server
+        self.window = window
+        self.max_individual = max_individual
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.session = requests.Session()
+        retry = urllib3.util.retry.Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["POST"])
+        self.session.mount("http://", requests.adapters.HTTPAdapter(max_retries=retry))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(max_retries=retry))
+
+        self.stats_lock = threading.Lock()
+        self.num_delivered = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    @staticmethod
+    def from_json(config):
+        json_notifications = config.get("notifications", {})
+        return NotificationDispatcher(
+            not config["notifications_off"],
+            config.get("ntfy_topic"),
+            config.get("ntfy_server", notify.NTFY_SERVER),
+            json_notifications.get("window", 5),
+            json_notifications.get("queue_size", 1000),
+            json_notifications.get("max_individual", 5)
+        )
+
+    def enabled(self):
+        return self.system_notifications or self.ntfy_topic is not None
+
+    def run(self):
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def submit(self, illust):
+        if not self.enabled():
+            return
+        try:
+            # don't hold up the worker for long if we're way behind
+            self.queue.put((time.monotonic(), illust), timeout=1)
+        except queue.Full:
+            with self.stats_lock:
+                self.num_dropped += 1
+            logging.getLogger().warning("Notification queue is full; dropping notification for pixiv #%d", illust.iden)
+
+    def loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.deliver(batch)
+            except Exception as e:
+                with self.stats_lock:
+                    self.num_failed += len(batch)
+                logging.getLogger().error("Failed to send notifications: %s", e)
+
+    def deliver(self, batch):
+        groups = {}
+        for _, illust in batch:
+            groups.setdefault(illust.user.iden, []).append(illust)
+
+        if len(groups) > self.max_individual:
+            message = f"{len(batch)} new illustrations from {len(groups)} artists"
+            r18_tag = next((illust.get_r18_tag() for _, illust in batch if illust.get_r18_tag()), "")
+            self.send(message, "https://www.pixiv.net/bookmark_new_illust.php", r18_tag)
+        else:
+            for illusts in groups.values():
+                first = illusts[0]
+                if len(illusts) == 1:
+                    self.send(f"'{first.title}' by {first.user.name} (@{first.user.account})", first.pixiv_link(), first.get_r18_tag())
+                else:
+                    # as to not spam, one notification with a summary that links to the artist instead of the pictures
+                    r18_tag = next((illust.get_r18_tag() for illust in illusts if illust.get_r18_tag()), "")
+                    self.send(f"{len(illusts)} new illustrations from {first.user.name} (@{first.user.account})", first.user.pixiv_link(), r18_tag)
+
+        now = time.monotonic()
+        with self.stats_lock:
+            for enqueued, _ in batch:
+                latency = now - enqueued
+                metrics.NOTIFICATION_SECONDS.observe(latency)
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            self.num_delivered += len(batch)
+
+    def send(self, message, link, r18_tag):
+        if self.system_notifications:
+            notify.send_notification(message, link, r18_tag)
+        if self.ntfy_topic is not None:
+            notify.send_ntfy(self.ntfy_topic, message, link, r18_tag, self.session, self.ntfy_server)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "delivered": self.num_delivered,
+                "dropped": self.num_dropped,
+                "failed": self.num_failed,
+                "avg_latency": self.total_latency / self.num_delivered if self.num_delivered else 0,
+                "max_latency": self.max_latency
+            }
+
+    def log_stats(self):
+        logging.getLogger().info("Notifications: %(queue_depth)d queued, %(delivered)d delivered, %(dropped)d dropped, %(failed)d failed, latency avg %(avg_latency).1fs max %(max_latency).1fs", self.stats())
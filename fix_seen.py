@@ -1,19 +1,30 @@
 #!/usr/bin/env python3
 
+import argparse
 import illustlog
 from seen import SeenIllustrations
 
 def main():
-    print("Creating a new seen.json file based on illustration log")
-    illusts = illustlog.get_illust_log()["illusts"]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=None, help="Rebuild the seen illustrations in this SQLite database instead of seen.bin.")
+    args = parser.parse_args()
+
+    print("Rebuilding the seen illustrations list based on illustration log")
+    if args.db is not None:
+        import sqlitestore
+        added = sqlitestore.rebuild_seen(sqlitestore.Database(args.db))
+        print(f"Done, {added} illustrations added")
+        return
+
+    log = illustlog.get_default_log()
     seen = SeenIllustrations(False)
-    seen.seen_illusts = set()
-    total_illusts = len(illusts)
-    for i, illust in enumerate(illusts):
-        illust_id = illust["id"]
+    # the log can have the same illustration more than once until it gets compacted
+    illust_ids = list(dict.fromkeys(illust["id"] for illust in log.iter_illusts()))
+    total_illusts = len(illust_ids)
+    for i, illust_id in enumerate(illust_ids):
         print(f"[{i+1}/{total_illusts}] {illust_id}")
         seen.add_illust(illust_id)
-    seen.flush()
+    seen.write_snapshot()
     print("Done")
 
 if __name__ == "__main__":
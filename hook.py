@@ -1,22 +1,188 @@
 import subprocess
 import threading
 import logging
+import jsoncodec
+import metrics
+import time
+import concurrent.futures
+import os
+import signal
+
+# Runs hooks on a bounded thread pool, so finding a few hundred illustrations at once doesn't start a
+# few hundred processes at once.
+class HookExecutor:
+    def __init__(self, max_workers=4):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hook")
+
+    def submit(self, func, *args):
+        self.executor.submit(func, *args).add_done_callback(log_failure)
+
+    def shutdown(self):
+        # whatever's queued still runs
+        self.executor.shutdown(wait=False)
+
+def log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.getLogger().error("Hook task failed", exc_info=future.exception())
 
 class Hook:
-    def __init__(self, command):
+    def __init__(self, command, executor, timeout=None, batch=False):
         self.command = command
-    
+        self.executor = executor
+        self.timeout = timeout
+        # batch hooks are started once and get one JSON object per line on stdin for every illustration
+        self.batch = batch
+        self.process = None
+        self.process_lock = threading.Lock()
+        self.closed = False
+        # what it was made from in settings.json, to tell which hooks changed on a reload
+        self.json = None
+
+        self.stats_lock = threading.Lock()
+        self.num_runs = 0
+        self.num_timeouts = 0
+        self.num_failures = 0
+        self.total_time = 0
+        self.max_time = 0
+
+    @staticmethod
+    def from_json(json_hook, executor):
+        # a plain list is just the command
+        if isinstance(json_hook, list):
+            hook = Hook(json_hook, executor)
+        else:
+            hook = Hook(json_hook["command"], executor, json_hook.get("timeout"), json_hook.get("batch", False))
+        hook.json = json_hook
+        return hook
+
     def run(self, illust):
-        threading.Thread(target=self.execute_command, args=(illust,)).start()
-    
+        if self.batch:
+            self.executor.submit(self.run_safely, self.send_to_process, illust)
+        else:
+            self.executor.submit(self.run_safely, self.execute_command, illust)
+
+    def run_safely(self, func, illust):
+        # e.g. the command doesn't exist or isn't executable
+        start = time.monotonic()
+        try:
+            func(illust)
+        except Exception as e:
+            logging.getLogger().exception(f"Hook {str(self)} failed on illustration {illust.iden}: {e}")
+            self.record(time.monotonic() - start, False, True)
+
     def execute_command(self, illust):
         logger = logging.getLogger()
         full_command = self.command + [str(illust.iden), illust.title, illust.caption, illust.get_tag_string(False), str(illust.user.iden), illust.user.name, illust.user.account]
-        process = subprocess.Popen(full_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        start = time.monotonic()
+        # own process group, so a timeout also kills whatever the hook started
+        process = subprocess.Popen(full_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, start_new_session=os.name != "nt")
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            try:
+                if os.name == "nt":
+                    process.kill()
+                else:
+                    os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass # exited just now
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, kill)
+            timer.start()
         for line in process.stdout:
             logger.info(f"[{str(self)}] {line.rstrip()}")
         process.wait()
-        logger.info(f"Hook {str(self)} exited with code {process.returncode}")
-    
+        if timer is not None:
+            timer.cancel()
+        if timed_out.is_set():
+            logger.warning(f"Hook {str(self)} took longer than {self.timeout} seconds and was killed")
+        else:
+            logger.info(f"Hook {str(self)} exited with code {process.returncode}")
+        self.record(time.monotonic() - start, timed_out.is_set(), process.returncode != 0)
+
+    def send_to_process(self, illust):
+        logger = logging.getLogger()
+        line = jsoncodec.dumps({
+            "id": illust.iden,
+            "title": illust.title,
+            "caption": illust.caption,
+            "tags": illust.get_tag_string(False),
+            "user": {
+                "id": illust.user.iden,
+                "name": illust.user.name,
+                "account": illust.user.account
+            }
+        })
+        start = time.monotonic()
+        timed_out = threading.Event()
+        with self.process_lock:
+            if self.closed:
+                logger.warning(f"Batch hook {str(self)} was removed; not sending illustration {illust.iden} to it")
+                return
+            timer = None
+            try:
+                if self.process is None or self.process.poll() is not None:
+                    if self.process is not None:
+                        logger.warning(f"Batch hook {str(self)} exited with code {self.process.returncode}; restarting it")
+                    self.start_process()
+                if self.timeout is not None:
+                    # a hook that stops reading would block the write (and everyone behind the lock) forever;
+                    # killing it makes the write fail
+                    process = self.process
+                    def kill():
+                        timed_out.set()
+                        process.kill()
+                    timer = threading.Timer(self.timeout, kill)
+                    timer.start()
+                self.process.stdin.write(line + "\n")
+                self.process.stdin.flush()
+                failed = False
+            except OSError as e:
+                if timed_out.is_set():
+                    logger.warning(f"Batch hook {str(self)} didn't take an illustration for {self.timeout} seconds and was killed")
+                else:
+                    logger.error(f"Could not send illustration to batch hook {str(self)}: {e}")
+                self.process = None
+                failed = True
+            finally:
+                if timer is not None:
+                    timer.cancel()
+        self.record(time.monotonic() - start, timed_out.is_set(), failed)
+
+    def close(self):
+        # batch hooks get EOF on stdin, which should make them exit
+        with self.process_lock:
+            self.closed = True
+            if self.process is not None and self.process.poll() is None:
+                try:
+                    self.process.stdin.close()
+                except OSError:
+                    pass
+            self.process = None
+
+    def start_process(self):
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding="utf-8")
+        threading.Thread(target=self.log_process_output, args=(self.process,), daemon=True).start()
+
+    def log_process_output(self, process):
+        for line in process.stdout:
+            logging.getLogger().info(f"[{str(self)}] {line.rstrip()}")
+
+    def record(self, duration, timed_out, failed):
+        metrics.HOOK_SECONDS.observe(duration, hook=str(self))
+        with self.stats_lock:
+            self.num_runs += 1
+            self.num_timeouts += timed_out
+            self.num_failures += failed
+            self.total_time += duration
+            self.max_time = max(self.max_time, duration)
+
+    def log_stats(self):
+        with self.stats_lock:
+            if self.num_runs == 0:
+                return
+            logging.getLogger().info(f"Hook {str(self)}: {self.num_runs} runs, {self.num_timeouts} timeouts, {self.num_failures} failures, avg {self.total_time / self.num_runs:.2f}s, max {self.max_time:.2f}s")
+
     def __str__(self):
-        return f"Hook({self.command})"
\ No newline at end of file
+        return f"Hook({self.command})"
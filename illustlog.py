@@ -1,23 +1,320 @@
-import json
+import jsoncodec
 import os
 import threading
+import bisect
+import logging
+import metrics
 from pixivmodel import PixivIllustration
 
 LOCK = threading.Lock()
 
-def get_illust_log():
+LOG_PATH = "./illustlog.jsonl"
+INDEX_PATH = "./illustlog.idx"
+LEGACY_LOG_PATH = "./illustlog.json"
+
+INDEX_MAGIC = "illustlog-index"
+
+# rewrite the log (sorted + deduplicated) after this many appends
+COMPACT_THRESHOLD = 5000
+
+# The illustration log is an append-only JSON Lines file. Each new illustration is one line at the
+# end of the file, so logging an illustration no longer means loading and rewriting the whole thing.
+#
+# Next to it there's a small index file with one "offset length create_date" line per record, which
+# we keep in memory sorted by date. The first line of the index holds the inode of the log file it
+# belongs to; if they don't match (crash during compaction, file copied around, etc.) the index is
+# thrown away and rebuilt from the log.
+#
+# Every once in a while the log gets compacted in a background thread: the records are rewritten
+# newest-first without duplicates and the index is rewritten to match.
+#
+# Other processes that only read the log (rssmain.py) open it read-only: they never migrate it or
+# touch the index file, which belongs to the process writing the log. Whatever they can't trust in
+# the index (a line that's still being written, an index from before a compaction) they read from
+# the log itself.
+
+class IllustLog:
+    def __init__(self, path=LOG_PATH, index_path=INDEX_PATH, legacy_path=LEGACY_LOG_PATH, compact_threshold=COMPACT_THRESHOLD, read_only=False):
+        self.path = path
+        self.index_path = index_path
+        self.legacy_path = legacy_path
+        self.compact_threshold = compact_threshold
+        self.lock = threading.RLock()
+        self.index = [] # (create_date, offset, length), oldest first
+        self.end = 0 # where the last good record ends
+        self.file_ino = None
+        self.tail_checked = False
+        self.appends_since_compaction = 0
+        self.compacting = False
+        self.read_only = read_only
+
+        if not read_only:
+            self.migrate()
+        self.load()
+
+    def migrate(self):
+        if os.path.exists(self.path) or not os.path.exists(self.legacy_path):
+            return
+        logging.getLogger().info("Migrating %s to %s", self.legacy_path, self.path)
+        with open(self.legacy_path, encoding="utf-8") as legacy_json:
+            illusts = jsoncodec.load(legacy_json)["illusts"]
+        illusts.sort(key=lambda x: x["create_date"], reverse=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as log_file:
+            for illust in illusts:
+                log_file.write(encode_record(illust))
+            log_file.flush()
+            os.fsync(log_file.fileno())
+        os.replace(temp_path, self.path)
+        os.replace(self.legacy_path, self.legacy_path + ".bak")
+        logging.getLogger().info("Migrated %d illustrations; old log kept as %s.bak", len(illusts), self.legacy_path)
+
+    def load(self):
+        with self.lock:
+            self.index = []
+            self.end = 0
+            self.tail_checked = False
+            if not os.path.exists(self.path):
+                if self.read_only:
+                    self.file_ino = None # nothing logged yet; refresh() loads it once it's there
+                    return
+                open(self.path, "ab").close()
+            stat = os.stat(self.path)
+            self.file_ino = stat.st_ino
+
+            index_ok = False
+            if os.path.exists(self.index_path):
+                with open(self.index_path, encoding="utf-8") as index_file:
+                    header = index_file.readline().split()
+                    if len(header) == 2 and header[0] == INDEX_MAGIC and header[1] == str(stat.st_ino):
+                        index_ok = True
+                        for line in index_file:
+                            parts = line.split()
+                            if not line.endswith("\n") or len(parts) != 3 or not parts[0].isdigit() or not parts[1].isdigit():
+                                if self.read_only:
+                                    break # most likely still being written; the rest gets read from the log below
+                                index_ok = False # torn line, don't trust any of it
+                                break
+                            offset, length, create_date = int(parts[0]), int(parts[1]), parts[2]
+                            if offset + length > stat.st_size:
+                                continue
+                            self.index.append((create_date, offset, length))
+                            self.end = max(self.end, offset + length)
+                if index_ok:
+                    self.index.sort()
+                else:
+                    self.index = []
+                    self.end = 0
+
+            recovered = self.scan_tail()
+            if not index_ok and not self.read_only:
+                logging.getLogger().info("Rebuilt illustration log index (%d entries)", len(self.index))
+                self.write_index()
+            elif recovered:
+                logging.getLogger().debug("Recovered %d illustration log entries missing from the index", len(recovered))
+
+    def scan_tail(self):
+        # pick up records past self.end, e.g. written by another process or lost from the index
+        recovered = []
+        with open(self.path, "rb") as log_file:
+            log_file.seek(self.end)
+            offset = self.end
+            for line in log_file:
+                if not line.endswith(b"\n"):
+                    break # torn write, gets truncated before the next append
+                try:
+                    create_date = jsoncodec.loads(line)["create_date"]
+                except jsoncodec.DECODE_ERRORS + (KeyError,):
+                    break
+                entry = (create_date, offset, len(line))
+                bisect.insort(self.index, entry)
+                recovered.append(entry)
+                offset += len(line)
+            self.end = offset
+        return recovered
+
+    def write_index(self):
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as index_file:
+            index_file.write(f"{INDEX_MAGIC} {self.file_ino}\n")
+            for create_date, offset, length in self.index:
+                index_file.write(f"{offset} {length} {create_date}\n")
+        os.replace(temp_path, self.index_path)
+
+    def refresh(self):
+        # make sure we see what other processes (i.e. main.py when we're rssmain.py) wrote
+        with self.lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            if stat.st_ino != self.file_ino or stat.st_size < self.end:
+                self.load()
+            elif stat.st_size > self.end:
+                self.scan_tail()
+
+    def append(self, entry):
+        self.append_many([entry])
+
+    def append_many(self, entries):
+        # all in one write (backfilling adds thousands at a time)
+        if not entries:
+            return
+        if self.read_only:
+            raise RuntimeError("Illustration log was opened read-only")
+        records = [encode_record(entry) for entry in entries]
+        with self.lock:
+            if not self.tail_checked:
+                # get rid of a half-written record left by a crash, if any
+                if os.path.getsize(self.path) > self.end:
+                    logging.getLogger().warning("Truncating incomplete record at the end of %s", self.path)
+                    os.truncate(self.path, self.end)
+                self.tail_checked = True
+
+            new_index = []
+            offset = self.end
+            for entry, record in zip(entries, records):
+                new_index.append((entry["create_date"], offset, len(record)))
+                offset += len(record)
+            with open(self.path, "ab") as log_file:
+                log_file.write(b"".join(records))
+            with open(self.index_path, "a", encoding="utf-8") as index_file:
+                index_file.write("".join(f"{offset} {length} {create_date}\n" for create_date, offset, length in new_index))
+            self.end = offset
+            if len(new_index) == 1:
+                bisect.insort(self.index, new_index[0])
+            else:
+                self.index.extend(new_index)
+                self.index.sort()
+
+            self.appends_since_compaction += len(entries)
+            if self.appends_since_compaction >= self.compact_threshold and not self.compacting:
+                self.compacting = True
+                threading.Thread(target=self.compact_worker, daemon=True).start()
+
+    def __len__(self):
+        return len(self.index)
+
+    def iter_illusts(self, newest_first=True, start=0, limit=None):
+        self.refresh()
+        with self.lock:
+            count = len(self.index)
+            stop = count if limit is None else min(count, start + limit)
+            if newest_first:
+                entries = self.index[max(0, count - stop):max(0, count - start)][::-1]
+            else:
+                entries = self.index[start:stop]
+            if not entries:
+                return # the log file might not even exist yet
+            # the file handle keeps pointing to the right file even if compaction swaps it out
+            log_file = open(self.path, "rb")
+        with log_file:
+            for _, offset, length in entries:
+                log_file.seek(offset)
+                yield jsoncodec.loads(log_file.read(length))
+
+    def cursor(self):
+        # where we are in the log; pass it to entries_since later to get what's been added since
+        with self.lock:
+            return (self.file_ino, self.end)
+
+    def entries_since(self, cursor):
+        # returns None if the log was compacted (or replaced) since, the caller has to start over then
+        self.refresh()
+        with self.lock:
+            if cursor[0] != self.file_ino or cursor[1] > self.end:
+                return None, (self.file_ino, self.end)
+            new_cursor = (self.file_ino, self.end)
+            if new_cursor == cursor:
+                return [], new_cursor
+            log_file = open(self.path, "rb")
+        with log_file:
+            log_file.seek(cursor[1])
+            data = log_file.read(new_cursor[1] - cursor[1])
+        return [jsoncodec.loads(line) for line in data.splitlines()], new_cursor
+
+    def get_page(self, page, page_size=100, newest_first=True):
+        return list(self.iter_illusts(newest_first, page * page_size, page_size))
+
+    def compact_worker(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logging.getLogger().error("Illustration log compaction failed: %s", e)
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    def compact(self):
+        with self.lock:
+            self.refresh()
+            snapshot = list(self.index)
+            snapshot_end = self.end
+            self.appends_since_compaction = 0
+
+        temp_path = self.path + ".tmp"
+        new_index = []
+        seen_ids = set()
+        with open(self.path, "rb") as src, open(temp_path, "wb") as dst:
+            position = 0
+            for create_date, offset, length in reversed(snapshot):
+                src.seek(offset)
+                record = src.read(length)
+                illust_id = jsoncodec.loads(record)["id"]
+                if illust_id in seen_ids:
+                    continue
+                seen_ids.add(illust_id)
+                dst.write(record)
+                new_index.append((create_date, position, length))
+                position += length
+
+            with self.lock:
+                # copy whatever got appended while we were busy
+                for create_date, offset, length in self.index:
+                    if offset >= snapshot_end:
+                        new_index.append((create_date, position + offset - snapshot_end, length))
+                src.seek(snapshot_end)
+                dst.write(src.read(self.end - snapshot_end))
+                dst.flush()
+                os.fsync(dst.fileno())
+                new_end = dst.tell()
+                dst.close()
+                src.close()
+
+                os.replace(temp_path, self.path)
+                self.file_ino = os.stat(self.path).st_ino
+                self.index = sorted(new_index)
+                self.end = new_end
+                self.write_index()
+                logging.getLogger().info("Compacted illustration log: %d -> %d entries", len(snapshot), len(seen_ids))
+
+def encode_record(entry):
+    return jsoncodec.dumps_bytes(entry) + b"\n"
+
+_default_log = None
+
+def get_default_log():
+    global _default_log
     with LOCK:
-        if not os.path.exists("./illustlog.json"):
-            return {"illusts": []}
-        with open("./illustlog.json", encoding="utf-8") as illustlog_json:
-            return json.load(illustlog_json)
+        if _default_log is None:
+            _default_log = IllustLog()
+        return _default_log
 
-def save_illust_log(illust_log):
+def set_default_log(log):
+    # e.g. the SQLite one (see sqlitestore.py)
+    global _default_log
     with LOCK:
-        temp_path = "./illustlog.json.tmp"
-        with open(temp_path, "w", encoding="utf-8") as illustlog_json:
-            json.dump(illust_log, illustlog_json, ensure_ascii=False, indent=2)
-        os.replace(temp_path, "./illustlog.json")
+        _default_log = log
+
+def get_illust_log():
+    # loads everything; prefer iter_illusts
+    return {"illusts": list(iter_illusts())}
+
+def iter_illusts(newest_first=True, start=0, limit=None):
+    return get_default_log().iter_illusts(newest_first, start, limit)
+
+def get_illust_page(page, page_size=100):
+    return get_default_log().get_page(page, page_size)
 
 # TODO i think we can add some shit to make the json module recognize our class (i have done this before)
 def serialize_illust(illust):
@@ -27,6 +324,7 @@ def serialize_illust(illust):
         "title": illust.title,
         "caption": illust.caption,
         "user": {
+            "id": illust.user.iden,
             "name": illust.user.name,
             "account": illust.user.account,
         },
@@ -35,10 +333,9 @@ def serialize_illust(illust):
     }
 
 def log_illust(illust):
-    log = get_illust_log()
-    illusts = log["illusts"]
-
-    illusts.append(serialize_illust(illust))
-    illusts.sort(key=lambda x: x["create_date"], reverse=True) # Sort by date so the newest ones come first in the json file
+    with metrics.ILLUST_LOG_SECONDS.time():
+        get_default_log().append(serialize_illust(illust))
 
-    save_illust_log(log)
+def log_illusts(illusts):
+    with metrics.ILLUST_LOG_SECONDS.time():
+        get_default_log().append_many([serialize_illust(illust) for illust in illusts])
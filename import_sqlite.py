@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Copies the file-based state (seen.bin + seen.journal or seen.json, the illustration log, schedule.json
+# and watermarks.json) into a SQLite database for "storage": {"backend": "sqlite"}. The files are left
+# alone (except an old illustlog.json, which gets migrated to illustlog.jsonl first, as usual).
+# Running it again only adds what's missing.
+# Usage: import_sqlite.py [--db pixiv-monitor.db]
+
+import argparse
+import os
+import illustlog
+import jsoncodec
+import seen
+import seenindex
+import scheduler
+import sqlitestore
+import watermark
+
+def seen_ids():
+    yield from seenindex.read_snapshot(seen.SNAPSHOT_PATH)
+    for path in (seen.JOURNAL_PATH + ".old", seen.JOURNAL_PATH):
+        yield from seen.read_journal(path)
+    if os.path.exists(seen.LEGACY_PATH):
+        with open(seen.LEGACY_PATH, encoding="utf-8") as seen_json:
+            yield from jsoncodec.load(seen_json)["illusts"]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default=sqlitestore.DB_PATH, help="Database to import into.")
+    args = parser.parse_args()
+
+    db = sqlitestore.Database(args.db)
+
+    ids = list(seen_ids())
+    db.add_seen(ids)
+    print(f"Seen illustrations: {len(ids)}")
+
+    entries = list(illustlog.IllustLog().iter_illusts(newest_first=False))
+    db.add_illusts(entries)
+    print(f"Logged illustrations: {len(entries)}")
+    db.flush(force=True)
+
+    if os.path.exists(scheduler.STATE_PATH):
+        schedule_state = sqlitestore.SqliteScheduleState(db)
+        for artist_id, entry in scheduler.ScheduleState(scheduler.STATE_PATH).artists.items():
+            schedule_state.update(artist_id, entry)
+        schedule_state.save()
+        print(f"Schedule: {len(schedule_state.artists)} artists")
+
+    if os.path.exists(watermark.WATERMARK_PATH):
+        watermarks = sqlitestore.SqliteWatermarks(db)
+        for artist_id, illust_id in watermark.WatermarkCache(watermark.WATERMARK_PATH).watermarks.items():
+            watermarks.update(artist_id, illust_id)
+        watermarks.save()
+        print(f"Watermarks: {len(watermarks.watermarks)} artists")
+
+    print("Done")
+
+if __name__ == "__main__":
+    main()
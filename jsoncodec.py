@@ -0,0 +1,115 @@
+import json
+
+# All the JSON parsing and writing goes through here, so it can use something faster than the json
+# module when it's installed: msgspec, then orjson, otherwise plain json.
+# With msgspec, user_illusts responses are also decoded straight into the structs below, which only
+# keep the fields we actually use. They can be indexed like dicts, so nothing else has to care.
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if msgspec is not None:
+    BACKEND = "msgspec"
+elif orjson is not None:
+    BACKEND = "orjson"
+else:
+    BACKEND = "json"
+
+# what loads() can raise on bad input; orjson's and json's errors are ValueErrors, msgspec's aren't
+DECODE_ERRORS = (ValueError,) if msgspec is None else (ValueError, msgspec.DecodeError)
+
+if msgspec is not None:
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+
+    class Record(msgspec.Struct):
+        def __getitem__(self, key):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+
+        def get(self, key, default=None):
+            return getattr(self, key, default)
+
+        def __contains__(self, key):
+            # optional fields that weren't in the response are None
+            return getattr(self, key, None) is not None
+
+    class User(Record):
+        id: int
+        name: str
+        account: str
+
+    class Tag(Record):
+        name: str
+        translated_name: str | None = None
+
+    class Illust(Record):
+        id: int
+        title: str
+        user: User
+        create_date: str
+        caption: str = ""
+        tags: list[Tag] = []
+        page_count: int = 1
+        meta_pages: list[dict] = []
+        sanity_level: int = 0
+        illust_ai_type: int = 0
+
+    class IllustPage(Record):
+        illusts: list[Illust] = []
+        next_url: str | None = None
+        error: dict | None = None
+
+    _illust_page_decoder = msgspec.json.Decoder(IllustPage)
+
+def loads(data):
+    # str or bytes
+    if msgspec is not None:
+        return _decoder.decode(data)
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps_bytes(obj):
+    # UTF-8, no escaping of non-ASCII characters, non-string keys turned into strings like json does
+    if msgspec is not None:
+        return _encoder.encode(obj)
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def dumps(obj, indent=None):
+    if indent is not None:
+        # only for files people edit by hand, speed doesn't matter there
+        return json.dumps(obj, indent=indent)
+    return dumps_bytes(obj).decode("utf-8")
+
+def load(fp):
+    return loads(fp.read())
+
+def dump(obj, fp, indent=None):
+    if "b" in getattr(fp, "mode", ""):
+        fp.write(dumps_bytes(obj) if indent is None else dumps(obj, indent).encode("utf-8"))
+    else:
+        fp.write(dumps(obj, indent))
+
+def to_builtins(obj):
+    # plain dicts and lists, e.g. for sending to another process that might not have msgspec
+    if msgspec is not None:
+        return msgspec.to_builtins(obj)
+    return obj
+
+def decode_illust_page(data):
+    # a page of illustrations (user_illusts, illust_follow, ...), or an error
+    if msgspec is not None:
+        return _illust_page_decoder.decode(data)
+    return loads(data)
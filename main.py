@@ -1,106 +1,372 @@
 #!/usr/bin/python3
 
 # standard imports
+import time
+STARTED = time.perf_counter()
+
 import argparse
-import json
 import threading
-import time
 import os
-import datetime
 import logging
-import logging.handlers
-import smtplib
 import sys
-import queue
-import random
-import pathlib
-
-# pixiv
-from pixivpy3 import *
-from pixivpy3.utils import PixivError
-
-# third-party imports
-import requests
-import dotenv
 
 # my imports
-from tokenswitcher import TokenSwitcher
+# everything else (pixivpy, notifications, hooks, the async engine) is imported once the config says
+# it's needed, so starting up doesn't pay for what isn't used
+from tokenswitcher import TokenSwitcher, TokenCache, TokenRefresher, DEFAULT_TOKEN_REFRESH_CONFIG
 import illustlog
+import metrics
 import settings
-import notify
-from pixivmodel import PixivIllustration
-from hook import Hook
 from seen import SeenIllustrations
 import utility
 from monitor import Monitor
+from clientpool import ClientPool
+from watermark import WatermarkCache, WATERMARK_PATH
+from scheduler import ScheduleState, ArtistScheduler
+import scheduler
 from loginit import init_logging
 
-def list_artists(config, api, token_switcher):
+USAGE_REPORT_INTERVAL = 15 * 60
+
+# Times each phase of startup for --profile-startup.
+class StartupProfiler:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.phases = [("imports", time.perf_counter() - STARTED)]
+        self.last = time.perf_counter()
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+        total = sum(duration for _, duration in self.phases)
+        lines = [f"{name:>20}: {duration * 1000:8.1f} ms" for name, duration in self.phases]
+        message = "Startup took %.1f ms:\n%s" % (total * 1000, "\n".join(lines))
+        print(message)
+        logging.getLogger().info(message)
+
+def list_artists(config, clients, token_switcher):
     artist_ids = config["artist_ids"]
     print(f"Will list {len(artist_ids)} artists.")
     for artist_id in artist_ids:
-        user_json = utility.api_wrapper(api, token_switcher, api.user_detail, artist_id)
+        user_json = utility.api_wrapper(clients, token_switcher, "user_detail", artist_id)
         user_id = user_json["user"]["id"]
         user_name = user_json["user"]["name"]
         user_account = user_json["user"]["account"]
         print(f"{user_name} | ID: {user_id} | @{user_account}")
 
 def load_hooks(config):
-    if "hooks" not in config:
+    if not config.get("hooks"):
         return []
-    
+
+    from hook import Hook, HookExecutor
+    executor = HookExecutor(config.get("hook_workers", 4))
     hooks = []
     for chook in config["hooks"]:
-        hooks.append(Hook(chook))
+        hooks.append(Hook.from_json(chook, executor))
     return hooks
 
+def load_dispatcher(config):
+    if config.get("notifications_off", False) and config.get("ntfy_topic") is None:
+        return None
+    from dispatcher import NotificationDispatcher
+    dispatcher = NotificationDispatcher.from_json(config)
+    dispatcher.run()
+    return dispatcher
+
+def load_database(config):
+    if config["storage"]["backend"] != "sqlite":
+        return None
+    import sqlitestore
+    return sqlitestore.Database.from_json(config["storage"], config["seen"])
+
+def load_seen(config, db, initialize=True):
+    if db is not None:
+        import sqlitestore
+        illustlog.set_default_log(sqlitestore.SqliteIllustLog(db))
+        return sqlitestore.SqliteSeen(db)
+    # the first requests take a while anyway, so load the seen set meanwhile
+    seen = SeenIllustrations.from_json(config["seen"], initialize, background=True)
+    if initialize:
+        # the illustration log gets opened on the first new illustration otherwise
+        threading.Thread(target=illustlog.get_default_log, daemon=True).start()
+    return seen
+
+def load_schedule_state(config, db, seed=True):
+    if not config["schedule"].get("enabled", False):
+        return None
+    if db is not None:
+        import sqlitestore
+        schedule_state = sqlitestore.SqliteScheduleState(db)
+        is_new = schedule_state.is_empty()
+    else:
+        path = config["schedule"].get("state_path", scheduler.STATE_PATH)
+        is_new = not os.path.exists(path)
+        schedule_state = ScheduleState(path)
+    if seed and is_new:
+        schedule_state.seed_from_log(illustlog.iter_illusts())
+    return schedule_state
+
+def load_token_switcher(config):
+    token_switcher = TokenSwitcher(config["num_accounts"], rate_limit_config=config["rate_limit"])
+    if config["token_refresh"].get("persist", False):
+        token_cache = TokenCache(config["token_refresh"].get("path", DEFAULT_TOKEN_REFRESH_CONFIG["path"]))
+        for token in token_switcher.tokens:
+            token_cache.apply(token)
+    return token_switcher
+
+def load_watermarks(config, db, seed=True):
+    if not config["watermarks"].get("enabled", True):
+        return None
+    if db is not None:
+        import sqlitestore
+        watermarks = sqlitestore.SqliteWatermarks(db)
+        is_new = not watermarks.watermarks
+    else:
+        path = config["watermarks"].get("path", WATERMARK_PATH)
+        is_new = not os.path.exists(path)
+        watermarks = WatermarkCache(path)
+    if seed and is_new:
+        watermarks.seed_from_log(illustlog.iter_illusts())
+    return watermarks
+
+def load_seeder(config, clients, token_switcher, seen, watermarks):
+    # new artists are told apart by not having a watermark
+    if watermarks is None or not config["seeding"]["enabled"]:
+        return None
+    from seeder import Seeder
+    seeder = Seeder.from_json(config["seeding"], clients, token_switcher, seen, watermarks)
+    seeder.run()
+    return seeder
+
+def build_monitor(json_monitor, name, config, clients, seen, token_switcher, hooks, schedule_state, dispatcher, watermarks, seeder=None):
+    monitor = Monitor.from_json(json_monitor, config, clients, seen, token_switcher, hooks, schedule_state, dispatcher, watermarks)
+    monitor.name = name
+    monitor.seeder = seeder
+    monitor.weight = json_monitor.get("weight", 1)
+    return monitor
+
+def build_monitors(config, clients, seen, token_switcher, hooks, schedule_state, dispatcher, watermarks, seeder=None):
+    if "monitors" in config:
+        return [
+            build_monitor(json_monitor, str(json_monitor.get("name", i)), config, clients, seen, token_switcher, hooks, schedule_state, dispatcher, watermarks, seeder)
+            for i, json_monitor in enumerate(config["monitors"])
+        ]
+    check_interval = config["check_interval"]
+    artist_scheduler = None
+    if schedule_state is not None:
+        artist_scheduler = ArtistScheduler.from_json(config["schedule"], schedule_state, config["artist_ids"], check_interval)
+    num_threads = config.get("num_threads", 3)
+    monitor = Monitor(check_interval, config["artist_ids"], config, clients, seen, token_switcher, hooks, num_threads, num_threads, artist_scheduler, dispatcher, watermarks, config["watermarks"].get("probe", False))
+    monitor.seeder = seeder
+    return [monitor]
+
+def all_artist_ids(config):
+    artist_ids = list(config.get("artist_ids", []))
+    for json_monitor in config.get("monitors", []):
+        artist_ids.extend(json_monitor["artist_ids"])
+    return list(dict.fromkeys(artist_ids))
+
+def start_backfill(config, clients, token_switcher, seen, watermarks):
+    from backfill import Backfill
+    Backfill.from_json(config["backfill"], all_artist_ids(config), clients, token_switcher, seen, watermarks).run()
+
+def start_monitors(config, monitors):
+    # returns the async engine, if that's what's running them
+    if config["engine"] == "async":
+        from asyncengine import AsyncEngine
+        engine = AsyncEngine.from_json(config.get("async", {}), monitors)
+        engine.run()
+        return engine
+    if config["engine"] == "shared":
+        from sharedengine import SharedEngine
+        engine = SharedEngine.from_json(config["shared"], monitors)
+        engine.run()
+        return engine
+    for monitor in monitors:
+        monitor.run()
+    return None
+
+def watch_config(config, hooks, monitors=None, build=None, engine=None):
+    if not config["reload"]["enabled"]:
+        return
+    from configwatch import ConfigReloader
+    ConfigReloader(config, hooks, monitors, build, engine, config["reload"]["debounce"]).run()
+
+def run_shard_owner(config, seen, hooks):
+    # this process only dedups, logs and notifies; workers do the polling (see shard.py)
+    import shard
+    json_sharding = config["sharding"]
+    dispatcher = load_dispatcher(config)
+    shard_configs = shard.split_config(config, json_sharding)
+    owner = shard.ShardOwner(shard_configs, seen, hooks, dispatcher)
+    shard.serve(owner, json_sharding["host"], json_sharding["port"])
+    # the workers have the monitors, so only hooks can change without a restart here
+    watch_config(config, hooks)
+    supervisor = None
+    if json_sharding["local_workers"]:
+        supervisor = shard.WorkerSupervisor(f"{json_sharding['host']}:{json_sharding['port']}", range(len(shard_configs)))
+        supervisor.run()
+
+    try:
+        last_usage_report = time.monotonic()
+        while True:
+            time.sleep(1)
+            if time.monotonic() - last_usage_report >= USAGE_REPORT_INTERVAL:
+                owner.log_stats()
+                if dispatcher is not None:
+                    dispatcher.log_stats()
+                for hook in hooks:
+                    hook.log_stats()
+                last_usage_report = time.monotonic()
+    finally:
+        if supervisor is not None:
+            supervisor.stop()
+        seen.flush(force=True)
+
+def run_shard_worker(args):
+    import shard
+    import dotenv
+    dotenv.load_dotenv()
+    owner = shard.connect(args.worker)
+    config = owner.assignment(args.shard)
+    init_logging(config, args.debug_log)
+    logging.getLogger().info("pixiv-monitor worker for shard %d has started", args.shard)
+    metrics.start(config["metrics"])
+
+    # monitors pick their accounts by index, so they get all of them, but only this shard's get
+    # refreshed and used for seeding
+    token_switcher = load_token_switcher(config)
+    shard_token_switcher = token_switcher
+    accounts = shard.shard_accounts(config)
+    if accounts is not None:
+        shard_token_switcher = TokenSwitcher(len(accounts), False)
+        shard_token_switcher.tokens = [token_switcher.tokens[i] for i in accounts]
+    from pixivpy3 import AppPixivAPI
+    clients = ClientPool(AppPixivAPI, config.get("client_pool_size"))
+    TokenRefresher.from_json(config["token_refresh"], shard_token_switcher.tokens).run()
+
+    # the illustration log belongs to the owner, so no seeding the schedule from it here
+    db = load_database(config)
+    schedule_state = load_schedule_state(config, db, seed=False)
+    seen = shard.ShardSeen(owner)
+    watermarks = load_watermarks(config, db, seed=False)
+    seeder = load_seeder(config, clients, shard_token_switcher, seen, watermarks)
+    monitors = build_monitors(config, clients, seen, token_switcher, [], schedule_state, None, watermarks, seeder)
+    for monitor in monitors:
+        monitor.owner = owner
+    start_monitors(config, monitors)
+
+    last_usage_report = time.monotonic()
+    while True:
+        time.sleep(1)
+        if time.monotonic() - last_usage_report >= USAGE_REPORT_INTERVAL:
+            shard_token_switcher.log_usage()
+            last_usage_report = time.monotonic()
+
 def parse_cli_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--list-artists", action="store_true", help="List artists and exit.")
     parser.add_argument("--debug-log", action="store_true", help="Output debugging logs in the console.")
+    parser.add_argument("--profile-startup", action="store_true", help="Print how long each part of starting up took.")
+    parser.add_argument("--backfill", action="store_true", help="Also go through every artist's older illustrations and quietly log them.")
+    parser.add_argument("--worker", metavar="HOST:PORT", default=None, help="Run as a worker of the shard owner at this address.")
+    parser.add_argument("--shard", type=int, default=0, help="Which shard to work on, with --worker.")
     return parser.parse_args()
 
 def main():
     args = parse_cli_args()
+    if args.worker is not None:
+        run_shard_worker(args)
+        return
+    profiler = StartupProfiler(args.profile_startup)
     config = settings.get_config()
     init_logging(config, args.debug_log)
     if not settings.check_config(config):
         sys.exit(1)
+    profiler.phase("config")
+
     hooks = load_hooks(config)
-    seen = SeenIllustrations()
+    profiler.phase("hooks")
 
-    check_interval = config["check_interval"]
+    # --list-artists doesn't need the seen set
+    db = load_database(config)
+    seen = load_seen(config, db, not args.list_artists)
+    profiler.phase("storage")
 
+    import dotenv
     dotenv.load_dotenv()
 
     logging.getLogger().info("pixiv-monitor has started")
-    
-    if sys.platform.startswith("win"):
-        try:
-            import winotify
-        except ImportError:
-            logging.getLogger().warn("winotify isn't installed. System notifications will not be shown")
+    metrics.start(config["metrics"])
+
+    if config["sharding"].get("enabled", False):
+        if args.backfill:
+            logging.getLogger().warning("--backfill doesn't work with sharding; ignoring it")
+        run_shard_owner(config, seen, hooks)
+        return
 
-    token_switcher = TokenSwitcher(config["num_accounts"])
+    token_switcher = load_token_switcher(config)
+    profiler.phase("accounts")
 
-    api = AppPixivAPI()
-    api.set_auth(token_switcher.get_access_token())
+    from pixivpy3 import AppPixivAPI
+    clients = ClientPool(AppPixivAPI, config.get("client_pool_size"))
+    profiler.phase("pixivpy")
 
     if args.list_artists:
-        list_artists(config, api, token_switcher)
+        list_artists(config, clients, token_switcher)
         sys.exit(0)
 
-    if "monitors" in config:
-        monitors = []
-        for monitor in config["monitors"]:
-            monitors.append(Monitor.from_json(monitor, config, api, seen, token_switcher, hooks))
-        for monitor in monitors:
-            monitor.run()
-    else:
-        Monitor(check_interval, config["artist_ids"], config, api, seen, token_switcher, hooks, config.get("num_threads", 3)).run()
-    
-    while True:
-        time.sleep(1)
+    TokenRefresher.from_json(config["token_refresh"], token_switcher.tokens).run()
+
+    schedule_state = load_schedule_state(config, db)
+    profiler.phase("schedule")
+
+    dispatcher = load_dispatcher(config)
+    profiler.phase("notifications")
+
+    watermarks = load_watermarks(config, db)
+    profiler.phase("watermarks")
+
+    seeder = load_seeder(config, clients, token_switcher, seen, watermarks)
+    monitors = build_monitors(config, clients, seen, token_switcher, hooks, schedule_state, dispatcher, watermarks, seeder)
+    engine = start_monitors(config, monitors)
+    profiler.phase("monitors")
+
+    def build(json_monitor, name):
+        return build_monitor(json_monitor, name, config, clients, seen, token_switcher, hooks, schedule_state, dispatcher, watermarks, seeder)
+    watch_config(config, hooks, monitors, build, engine)
+
+    if args.backfill:
+        if watermarks is None:
+            # it leaves whatever's newer than the watermarks to the monitors
+            logging.getLogger().warning("--backfill needs watermarks; ignoring it")
+        else:
+            start_backfill(config, clients, token_switcher, seen, watermarks)
+
+    if args.profile_startup:
+        # polling has started already; this is how long the seen set took to load next to it
+        seen.wait_loaded()
+        profiler.phase("waiting for seen")
+        profiler.report()
+
+    try:
+        last_usage_report = time.monotonic()
+        while True:
+            time.sleep(1)
+            if time.monotonic() - last_usage_report >= USAGE_REPORT_INTERVAL:
+                token_switcher.log_usage()
+                if dispatcher is not None:
+                    dispatcher.log_stats()
+                for hook in hooks:
+                    hook.log_stats()
+                last_usage_report = time.monotonic()
+    finally:
+        seen.flush(force=True)
 
 if __name__ == "__main__":
     try:
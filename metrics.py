@@ -0,0 +1,258 @@
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+# Counters, gauges and histograms for the polling pipeline, so num_threads and the number of accounts
+# can be sized from numbers instead of guesses. Everything is recorded all the time (it's a dict
+# lookup and an add under a lock); with "metrics": {"enabled": true} they're served in the Prometheus
+# text format on host:port/metrics, and every summary_interval seconds a summary line goes to the log.
+# No prometheus_client needed, the text format is simple enough.
+
+DEFAULT_METRICS_CONFIG = {
+    "enabled": False, # serve /metrics over HTTP
+    "host": "127.0.0.1",
+    "port": 9464,
+    "summary_interval": 15 * 60 # seconds between summary log lines, 0 to turn them off
+}
+
+# seconds; requests and checks are usually well under a second, cycles take minutes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CYCLE_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {} # label values -> value
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # counts per bucket (the last one is +Inf), sum
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def merged(self, **labels):
+        # bucket counts and sum over every label set matching the given labels
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0
+        with self.lock:
+            for key, (entry_counts, entry_sum) in self.values.items():
+                if any(key[self.labels.index(name)] != str(value) for name, value in labels.items()):
+                    continue
+                counts = [a + b for a, b in zip(counts, entry_counts)]
+                total += entry_sum
+        return counts, total
+
+    def count(self, **labels):
+        return sum(self.merged(**labels)[0])
+
+    def mean(self, **labels):
+        counts, total = self.merged(**labels)
+        return total / sum(counts) if sum(counts) else 0
+
+    def quantile(self, q, **labels):
+        # estimated from the buckets, the same way Prometheus' histogram_quantile does it
+        counts, _ = self.merged(**labels)
+        num = sum(counts)
+        if num == 0:
+            return 0
+        rank = q * num
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1] # somewhere above the last bucket
+                lower = self.buckets[i - 1] if i > 0 else 0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), key + (format_value(bound),))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(float(total))}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+REGISTRY = []
+
+# monitors are labelled with their "name" in settings.json, or their position in "monitors"
+CYCLE_SECONDS = Histogram("pixiv_monitor_cycle_seconds", "Time from the start of a monitor's cycle to the end of it.", ["monitor"], CYCLE_BUCKETS)
+CYCLE_ARTISTS = Gauge("pixiv_monitor_cycle_artists", "Artists checked in the monitor's current cycle.", ["monitor"])
+QUEUE_DEPTH = Gauge("pixiv_monitor_queue_depth", "Artists of the current cycle not checked yet.", ["monitor"])
+ARTIST_SECONDS = Histogram("pixiv_monitor_artist_check_seconds", "Time from taking an artist off the queue to being done with it.", ["monitor"])
+NEW_ILLUSTS = Counter("pixiv_monitor_new_illusts_total", "New illustrations found.", ["monitor"])
+API_SECONDS = Histogram("pixiv_monitor_api_request_seconds", "pixiv API request latency, including parsing the response.", ["account"])
+RATE_LIMITS = Counter("pixiv_monitor_rate_limits_total", "Rate limit errors from pixiv.", ["account"])
+TOKEN_REFRESHES = Counter("pixiv_monitor_token_refreshes_total", "Access token refreshes.", ["account"])
+SEEN_SIZE = Gauge("pixiv_monitor_seen_illusts", "Illustration IDs in the seen set.")
+SEEN_FLUSH_SECONDS = Histogram("pixiv_monitor_seen_flush_seconds", "Time to write pending seen IDs to disk.")
+ILLUST_LOG_SECONDS = Histogram("pixiv_monitor_illust_log_write_seconds", "Time to add an illustration to the illustration log.")
+NOTIFICATION_SECONDS = Histogram("pixiv_monitor_notification_latency_seconds", "Time from finding an illustration to its notification being sent.")
+SEED_QUEUE_DEPTH = Gauge("pixiv_monitor_seed_queue_depth", "New artists waiting for their existing illustrations to be marked as seen.")
+SEEDED_ARTISTS = Counter("pixiv_monitor_seeded_artists_total", "New artists whose existing illustrations were marked as seen.")
+BACKFILL_LEFT = Gauge("pixiv_monitor_backfill_artists_left", "Artists --backfill hasn't gone through yet.")
+BACKFILL_ILLUSTS = Counter("pixiv_monitor_backfill_illusts_total", "Illustrations added by --backfill.")
+WORKER_SECONDS = Counter("pixiv_monitor_worker_seconds_total", "Time the shared worker pool (engine \"shared\") spent on each monitor.", ["monitor"])
+WORKERS_BUSY = Gauge("pixiv_monitor_workers_busy", "Workers of the shared pool busy with each monitor right now.", ["monitor"])
+HOOK_SECONDS = Histogram("pixiv_monitor_hook_seconds", "Time a hook took per illustration.", ["hook"])
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def summary():
+    parts = []
+    monitors = set()
+    for metric in (CYCLE_SECONDS, ARTIST_SECONDS):
+        with metric.lock:
+            monitors.update(key[0] for key in metric.values)
+    for monitor in sorted(monitors):
+        parts.append(
+            f"monitor {monitor}: {CYCLE_SECONDS.count(monitor=monitor)} cycles avg {CYCLE_SECONDS.mean(monitor=monitor):.1f}s, "
+            f"{QUEUE_DEPTH.get(monitor=monitor)}/{CYCLE_ARTISTS.get(monitor=monitor)} queued, "
+            f"artist p50 {ARTIST_SECONDS.quantile(0.5, monitor=monitor):.2f}s p99 {ARTIST_SECONDS.quantile(0.99, monitor=monitor):.2f}s, "
+            f"{NEW_ILLUSTS.get(monitor=monitor)} new"
+        )
+    worker_seconds = WORKER_SECONDS.total()
+    if worker_seconds:
+        with WORKER_SECONDS.lock:
+            shares = sorted(WORKER_SECONDS.values.items())
+        parts.append("shared workers: " + ", ".join(f"{key[0]} {value / worker_seconds:.0%}" for key, value in shares))
+    parts.append(
+        f"API: {API_SECONDS.count()} requests p50 {API_SECONDS.quantile(0.5):.2f}s p99 {API_SECONDS.quantile(0.99):.2f}s, "
+        f"{RATE_LIMITS.total()} rate limits, {TOKEN_REFRESHES.total()} refreshes"
+    )
+    parts.append(f"seen: {SEEN_SIZE.get()} IDs, flush avg {SEEN_FLUSH_SECONDS.mean() * 1000:.1f}ms")
+    parts.append(f"log write avg {ILLUST_LOG_SECONDS.mean() * 1000:.1f}ms")
+    if NOTIFICATION_SECONDS.count():
+        parts.append(f"notifications p50 {NOTIFICATION_SECONDS.quantile(0.5):.1f}s p99 {NOTIFICATION_SECONDS.quantile(0.99):.1f}s")
+    if HOOK_SECONDS.count():
+        parts.append(f"hooks p50 {HOOK_SECONDS.quantile(0.5):.2f}s p99 {HOOK_SECONDS.quantile(0.99):.2f}s")
+    return "; ".join(parts)
+
+def log_summary():
+    logging.getLogger().info("Metrics: %s", summary())
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scraped every few seconds; not worth a log line each
+
+def start_server(host, port):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.getLogger().info("Serving metrics on http://%s:%d/metrics", host, port)
+    return server
+
+def run_summaries(interval):
+    def loop():
+        while True:
+            time.sleep(interval)
+            log_summary()
+    threading.Thread(target=loop, daemon=True).start()
+
+def start(json_metrics):
+    if json_metrics["enabled"]:
+        start_server(json_metrics["host"], json_metrics["port"])
+    if json_metrics["summary_interval"] > 0:
+        run_summaries(json_metrics["summary_interval"])
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# A fake pixiv App API for benchmarks (see bench_monitor.py), so tuning doesn't mean hammering the real
+# one. Serves user_illusts, user_detail and OAuth token refreshes for --artists artists with IDs from
+# FIRST_ARTIST_ID up, with made-up latency and errors:
+# - every artist already has --history illustrations (30 a page, with next_url), and posts a new one
+#   every --post-interval seconds on average (the create_date of new ones is when they were posted,
+#   to the microsecond)
+# - --rate-limit of the requests fail with "Rate Limit", and so does anything over --account-rate
+#   requests per second per account
+# - --invalid-grant of the requests fail with invalid_grant, as do access tokens the server didn't hand
+#   out or that are older than --token-lifetime
+# Posts are only made up when an artist is asked about, so 100000 artists cost next to nothing.
+# Usage: mockpixiv.py [--port 8765] [--artists 1000] [--latency 0.05] [--post-interval 3600]
+
+import argparse
+import datetime
+import http.server
+import random
+import secrets
+import threading
+import time
+import urllib.parse
+import jsoncodec
+from bench_model import make_illust_json, ILLUSTS_PER_PAGE
+
+FIRST_ARTIST_ID = 1000000
+HISTORY_FIRST_ID = 100000000
+MAX_HISTORY = 1000 # IDs set aside for each artist's history
+NEW_FIRST_ID = 900000000
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+def history_watermark(artist_id, history=ILLUSTS_PER_PAGE):
+    # the newest of the illustrations an artist starts out with
+    return HISTORY_FIRST_ID + (artist_id - FIRST_ARTIST_ID) * MAX_HISTORY + history - 1
+
+def format_date(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, JST).isoformat()
+
+class MockPixiv:
+    def __init__(self, num_artists=1000, latency=0.05, post_interval=3600, rate_limit=0, account_rate=0, invalid_grant=0, token_lifetime=3600, history=ILLUSTS_PER_PAGE):
+        self.num_artists = num_artists
+        self.history = min(history, MAX_HISTORY)
+        self.latency = latency
+        self.post_interval = post_interval
+        self.rate_limit = rate_limit
+        self.account_rate = account_rate
+        self.invalid_grant = invalid_grant
+        self.token_lifetime = token_lifetime
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.next_id = NEW_FIRST_ID
+        self.posts = {} # artist ID -> [(illust ID, posted at)] of new illustrations, oldest first
+        self.next_post = {} # artist ID -> when they post next
+        self.access_tokens = {} # access token -> (refresh token, issued at)
+        self.buckets = {} # refresh token -> (requests left, last refill)
+        self.accounts = {} # refresh token -> pixiv user ID of the account
+
+    def is_artist(self, artist_id):
+        return FIRST_ARTIST_ID <= artist_id < FIRST_ARTIST_ID + self.num_artists
+
+    def new_posts(self, artist_id, now):
+        with self.lock:
+            next_post = self.next_post.get(artist_id)
+            if next_post is None:
+                next_post = self.started + random.expovariate(1 / self.post_interval)
+            posts = self.posts.setdefault(artist_id, [])
+            while next_post <= now:
+                posts.append((self.next_id, next_post))
+                self.next_id += 1
+                next_post += random.expovariate(1 / self.post_interval)
+            self.next_post[artist_id] = next_post
+            return list(posts)
+
+    def user_illusts(self, artist_id, now, offset=0):
+        # newest first: new posts, then the history
+        posts = self.new_posts(artist_id, now)
+        newest_history = history_watermark(artist_id, self.history)
+        total = len(posts) + self.history
+        illusts = []
+        for i in range(offset, min(offset + ILLUSTS_PER_PAGE, total)):
+            if i < len(posts):
+                iden, posted = posts[len(posts) - 1 - i]
+            else:
+                age = i - len(posts)
+                iden, posted = newest_history - age, self.started - (age + 1) * 86400
+            illust = make_illust_json(iden, artist_id)
+            illust["create_date"] = format_date(posted)
+            illusts.append(illust)
+        next_url = None
+        if offset + ILLUSTS_PER_PAGE < total:
+            next_url = f"https://app-api.pixiv.net/v1/user/illusts?user_id={artist_id}&filter=for_ios&type=illust&offset={offset + ILLUSTS_PER_PAGE}"
+        return {"illusts": illusts, "next_url": next_url}
+
+    def user_detail(self, artist_id):
+        return {"user": {"id": artist_id, "name": f"artist {artist_id}", "account": f"artist{artist_id}", "profile_image_urls": {"medium": ""}, "comment": "", "is_followed": True}}
+
+    def refresh(self, refresh_token):
+        access_token = secrets.token_hex(16)
+        with self.lock:
+            self.access_tokens[access_token] = (refresh_token, time.time())
+            user_id = self.accounts.setdefault(refresh_token, len(self.accounts) + 1)
+        return {
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "expires_in": self.token_lifetime,
+            "user": {"id": str(user_id)}
+        }
+
+    def check_token(self, authorization, now):
+        # returns the error to respond with, if any
+        entry = self.access_tokens.get(authorization.removeprefix("Bearer "))
+        if entry is None or now - entry[1] > self.token_lifetime or random.random() < self.invalid_grant:
+            return 400, {"error": {"user_message": "", "message": "Error occurred at the OAuth process. Please check your Access Token to fix this. Error Message: invalid_grant", "reason": "", "user_message_details": {}}}
+        if random.random() < self.rate_limit or not self.take_request(entry[0], now):
+            return 403, {"error": {"user_message": "", "message": "Rate Limit", "reason": "", "user_message_details": {}}}
+        return None
+
+    def take_request(self, refresh_token, now):
+        if self.account_rate <= 0:
+            return True
+        with self.lock:
+            left, last_refill = self.buckets.get(refresh_token, (self.account_rate, now))
+            left = min(self.account_rate, left + (now - last_refill) * self.account_rate)
+            if left < 1:
+                self.buckets[refresh_token] = (left, now)
+                return False
+            self.buckets[refresh_token] = (left - 1, now)
+            return True
+
+class MockRequestHandler(http.server.BaseHTTPRequestHandler):
+    mock = None
+    protocol_version = "HTTP/1.1" # keep-alive, like the real thing
+
+    def respond(self, status, body):
+        data = jsoncodec.dumps_bytes(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        time.sleep(random.uniform(0.5, 1.5) * self.mock.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        now = time.time()
+        error = self.mock.check_token(self.headers.get("Authorization", ""), now)
+        if error is not None:
+            self.respond(*error)
+            return
+        artist_id = int(query.get("user_id", ["0"])[0])
+        if url.path not in ("/v1/user/illusts", "/v1/user/detail"):
+            self.respond(404, {"error": {"message": f"{url.path} isn't mocked"}})
+        elif not self.mock.is_artist(artist_id):
+            self.respond(404, {"error": {"user_message": "Page not found", "message": ""}})
+        elif url.path == "/v1/user/illusts":
+            self.respond(200, self.mock.user_illusts(artist_id, now, int(query.get("offset", ["0"])[0])))
+        else:
+            self.respond(200, self.mock.user_detail(artist_id))
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path != "/auth/token":
+            self.respond(404, {"error": {"message": "not mocked"}})
+            return
+        form = urllib.parse.parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+        refresh_token = form.get("refresh_token", [""])[0]
+        if not refresh_token:
+            self.respond(400, {"has_error": True, "errors": {"system": {"message": "invalid_grant"}}})
+            return
+        self.respond(200, self.mock.refresh(refresh_token))
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(mock, host="127.0.0.1", port=8765):
+    handler = type("BoundMockRequestHandler", (MockRequestHandler,), {"mock": mock})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--artists", type=int, default=1000, help=f"Number of artists, with IDs from {FIRST_ARTIST_ID} up.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Average seconds per request.")
+    parser.add_argument("--post-interval", type=float, default=3600, help="Average seconds between an artist's posts.")
+    parser.add_argument("--rate-limit", type=float, default=0, help="Fraction of requests that get rate limited anyway.")
+    parser.add_argument("--account-rate", type=float, default=0, help="Requests per second per account before getting rate limited, 0 for no limit.")
+    parser.add_argument("--invalid-grant", type=float, default=0, help="Fraction of requests that fail with invalid_grant.")
+    parser.add_argument("--token-lifetime", type=float, default=3600, help="Seconds until an access token stops working.")
+    parser.add_argument("--history", type=int, default=ILLUSTS_PER_PAGE, help=f"Illustrations every artist has to begin with (at most {MAX_HISTORY}).")
+    args = parser.parse_args()
+
+    mock = MockPixiv(args.artists, args.latency, args.post_interval, args.rate_limit, args.account_rate, args.invalid_grant, args.token_lifetime, args.history)
+    server = serve(mock, args.host, args.port)
+    print(f"Mock pixiv API on http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
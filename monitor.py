@@ -1,22 +1,52 @@
-from pixivpy3 import *
 import logging
 import threading
-from seen import SeenIllustrations
 from tokenswitcher import TokenSwitcher
+from scheduler import ArtistScheduler
 import queue
 import time
 from pixivmodel import PixivIllustration
 import illustlog
+import jsoncodec
+import metrics
 import utility
-import notify
 import random
 import sys
-from tokenswitcher import TokenSwitcher
+import re
+import urllib.parse
+
+FIRST_ILLUST_ID_RE = re.compile(rb'"illusts":\s*\[\s*\{\s*"id":\s*(\d+)')
+
+def fetch_user_illusts(api, artist_id, watermark=None, offset=None):
+    # same request pixivpy makes in user_illusts, but the response is parsed with jsoncodec.
+    # with a watermark, we peek at the raw response first: if the newest illustration is one we
+    # already know about, there's nothing to parse
+    params = {"user_id": artist_id, "filter": "for_ios", "type": "illust"}
+    if offset:
+        params["offset"] = offset
+    response = api.no_auth_requests_call("GET", f"{api.hosts}/v1/user/illusts", params=params)
+    if watermark is not None:
+        match = FIRST_ILLUST_ID_RE.search(response.content[:256])
+        if match is not None and int(match.group(1)) <= watermark:
+            return {"illusts": []}
+    return jsoncodec.decode_illust_page(response.content)
+
+def fetch_illust_follow(api, offset=None):
+    # same request as pixivpy's illust_follow, parsed with jsoncodec
+    params = {"restrict": "public"}
+    if offset:
+        params["offset"] = offset
+    response = api.no_auth_requests_call("GET", f"{api.hosts}/v2/illust/follow", params=params)
+    return jsoncodec.decode_illust_page(response.content)
 
-def get_json_illusts(api, artist_id, token_switcher):
+def next_offset(next_url):
+    if next_url is None:
+        return None
+    return urllib.parse.parse_qs(urllib.parse.urlsplit(next_url).query).get("offset", [None])[0]
+
+def get_json_illusts(clients, artist_id, token_switcher, probe_watermark=None):
     while True:
         try:
-            user_illusts_json = utility.api_wrapper(api, token_switcher, api.user_illusts, artist_id)
+            user_illusts_json = utility.api_wrapper(clients, token_switcher, fetch_user_illusts, artist_id, probe_watermark)
             #logging.getLogger().debug(user_illusts_json)
             return user_illusts_json
         except Exception as e:
@@ -26,20 +56,43 @@ def get_json_illusts(api, artist_id, token_switcher):
                 continue
 
 class Monitor:
-    def __init__(self, check_interval, artist_ids, config, api, seen, token_switcher, hooks, num_threads):
+    def __init__(self, check_interval, artist_ids, config, clients, seen, token_switcher, hooks, num_threads, max_concurrency=None, scheduler=None, dispatcher=None, watermarks=None, probe=False):
         self.check_interval = check_interval
         self.artist_ids = artist_ids
         self.config = config
-        self.api = api
+        self.clients = clients
         self.seen = seen
         self.token_switcher = token_switcher
         self.hooks = hooks
         self.num_threads = num_threads
+        # only used by the async engine; how many artists of this monitor can be checked at once
+        self.max_concurrency = max_concurrency if max_concurrency is not None else num_threads
+        # adaptive per-artist schedule; None means check everyone every cycle
+        self.scheduler = scheduler
+        # new illustrations get handed to this for notifications
+        self.dispatcher = dispatcher
+        # newest known illustration per artist; lets us skip everything we've already seen
+        self.watermarks = watermarks
+        self.probe = probe
+        # set in sharded workers; new illustrations get reported to it instead of handled here
+        self.owner = None
+        # what the metrics call this monitor; its "name" or its position in "monitors"
+        self.name = "0"
+        # artists that were never polled go to this instead of being checked (see seeder.py)
+        self.seeder = None
+        # share of the pool relative to other monitors, with the shared engine (see sharedengine.py)
+        self.weight = 1
+        self.artist_queue = queue.Queue()
+        self.workers_lock = threading.Lock()
+        self.running = False
+        # set to cut the sleep between cycles short, e.g. when settings.json was reloaded
+        self.wake = threading.Event()
+        self.stopped = False
 
         logging.getLogger().debug("Created monitor with %d artist IDs, %d threads, %d tokens", len(artist_ids), num_threads, len(token_switcher.tokens))
 
     @staticmethod
-    def from_json(json_monitor, config, api, seen, token_switcher, hooks):
+    def from_json(json_monitor, config, clients, seen, token_switcher, hooks, schedule_state=None, dispatcher=None, watermarks=None):
         monitor_token_switcher = None
         if len(json_monitor.get("accounts", [])) == 0:
             monitor_token_switcher = token_switcher
@@ -48,42 +101,139 @@ class Monitor:
             tokens = [token_switcher.tokens[i] for i in accounts]
             monitor_token_switcher = TokenSwitcher(len(accounts), False)
             monitor_token_switcher.tokens = tokens
-        return Monitor(json_monitor.get("check_interval", 30), json_monitor["artist_ids"], config, api, seen, monitor_token_switcher, hooks, json_monitor.get("num_threads", 30))
+        num_threads = json_monitor.get("num_threads", 30)
+        check_interval = json_monitor.get("check_interval", 30)
+        if json_monitor.get("type", "artists") == "follow":
+            follow_account = json_monitor.get("follow_account", (json_monitor.get("accounts") or [0])[0])
+            follow_token_switcher = TokenSwitcher(1, False)
+            follow_token_switcher.tokens = [token_switcher.tokens[follow_account]]
+            return FollowMonitor(
+                check_interval, json_monitor["artist_ids"], config, clients, seen, monitor_token_switcher, hooks, num_threads, json_monitor.get("max_concurrency", num_threads),
+                dispatcher, watermarks, config["watermarks"].get("probe", False), follow_token_switcher,
+                json_monitor.get("only_listed", True), json_monitor.get("sync_follows", False), json_monitor.get("max_pages", 10), json_monitor.get("reconcile_interval", 6 * 60 * 60)
+            )
+        scheduler = None
+        if schedule_state is not None:
+            json_schedule = {**config["schedule"], **json_monitor.get("schedule", {})}
+            scheduler = ArtistScheduler.from_json(json_schedule, schedule_state, json_monitor["artist_ids"], check_interval)
+        return Monitor(check_interval, json_monitor["artist_ids"], config, clients, seen, monitor_token_switcher, hooks, num_threads, json_monitor.get("max_concurrency", num_threads), scheduler, dispatcher, watermarks, config["watermarks"].get("probe", False))
 
     def run(self):
         threading.Thread(target=self.loop, daemon=True).start()
 
     def loop(self):
-        artist_queue = queue.Queue()
+        artist_queue = self.artist_queue
 
-        threads = []
-        for _ in range(self.num_threads):
-            thread = threading.Thread(target=self.illust_worker, args=(artist_queue,), daemon=True)
-            thread.start()
-            threads.append(thread)
+        with self.workers_lock:
+            for _ in range(self.num_threads):
+                self.start_worker()
+            self.running = True
 
         stop_event = threading.Event()
-        
-        # TODO this would not work with multiple monitors
-        def progress_worker(artist_queue, max):
+
+        def progress_worker(artist_queue):
             while not stop_event.is_set():
-                print(f"\033]0;pixiv-monitor: {artist_queue.qsize()}/{max} left\007", end="")
+                metrics.QUEUE_DEPTH.set(artist_queue.qsize(), monitor=self.name)
+                # the title counts every monitor's artists, not just this one's
+                print(f"\033]0;pixiv-monitor: {metrics.QUEUE_DEPTH.total()}/{metrics.CYCLE_ARTISTS.total()} left\007", end="")
                 sys.stdout.flush()
                 time.sleep(2)
 
-        while True:
-            shuffled_ids = random.sample(self.artist_ids, len(self.artist_ids))
-
-            for artist_id in shuffled_ids:
+        while not self.stopped:
+            cycle_start = time.monotonic()
+            try:
+                self.start_cycle()
+                artist_ids = self.cycle_artists()
+            except Exception as e:
+                if self.config.get("crash_on_exception", False):
+                    raise
+                logging.getLogger().error("Error while starting a cycle of monitor %s: %s", self.name, e)
+                artist_ids = []
+            for artist_id in artist_ids:
                 artist_queue.put(artist_id)
+            metrics.CYCLE_ARTISTS.set(artist_queue.qsize(), monitor=self.name)
 
-            thread = threading.Thread(target=progress_worker, args=(artist_queue, artist_queue.qsize()))
+            thread = threading.Thread(target=progress_worker, args=(artist_queue,))
             thread.start()
             artist_queue.join()
             stop_event.set()
             thread.join()
             stop_event.clear()
-            time.sleep(self.check_interval)
+            metrics.QUEUE_DEPTH.set(0, monitor=self.name)
+            try:
+                self.end_cycle()
+            except Exception as e:
+                # e.g. the seen set, schedule or watermarks couldn't be saved; they're tried again next cycle
+                if self.config.get("crash_on_exception", False):
+                    raise
+                logging.getLogger().error("Error while ending a cycle of monitor %s: %s", self.name, e)
+            metrics.CYCLE_SECONDS.observe(time.monotonic() - cycle_start, monitor=self.name)
+            self.wake.wait(self.cycle_sleep_time())
+            self.wake.clear()
+
+        with self.workers_lock:
+            for _ in range(self.num_threads):
+                artist_queue.put(None)
+            self.running = False
+        metrics.CYCLE_ARTISTS.set(0, monitor=self.name)
+
+    def start_worker(self):
+        threading.Thread(target=self.illust_worker, args=(self.artist_queue,), daemon=True).start()
+
+    def resize(self, num_threads):
+        # more workers start right away; extra ones leave once they get to the end of the queue
+        with self.workers_lock:
+            if self.running:
+                for _ in range(num_threads - self.num_threads):
+                    self.start_worker()
+                for _ in range(self.num_threads - num_threads):
+                    self.artist_queue.put(None)
+            self.num_threads = num_threads
+
+    def stop(self):
+        # finishes the current cycle first
+        self.stopped = True
+        self.wake.set()
+
+    def set_artist_ids(self, artist_ids):
+        # artists already queued this cycle still get checked
+        self.artist_ids = artist_ids
+        if self.scheduler is not None:
+            self.scheduler.set_artist_ids(artist_ids)
+
+    def start_cycle(self):
+        pass
+
+    def cycle_artists(self):
+        artist_ids = self.due_artists()
+        if self.seeder is None:
+            return artist_ids
+        cycle_artist_ids = []
+        for artist_id in artist_ids:
+            if self.seeder.is_new(artist_id):
+                self.seeder.submit(self, artist_id)
+            else:
+                cycle_artist_ids.append(artist_id)
+        return cycle_artist_ids
+
+    def due_artists(self):
+        if self.scheduler is None:
+            return random.sample(self.artist_ids, len(self.artist_ids))
+        return self.scheduler.pop_due()
+
+    def cycle_sleep_time(self):
+        if self.scheduler is None:
+            return self.check_interval
+        # wake up when the next artist is due, but not more often than once a second
+        return min(self.check_interval, max(1, self.scheduler.seconds_until_next()))
+
+    def end_cycle(self):
+        # whatever was found this cycle gets written in one go
+        self.seen.flush(force=True)
+        if self.scheduler is not None:
+            self.scheduler.state.save()
+        if self.watermarks is not None:
+            self.watermarks.save()
 
     def illust_worker(self, artist_queue):
         while True:
@@ -91,50 +241,187 @@ class Monitor:
                 artist_id = artist_queue.get()
                 if artist_id is None:
                     break
+                self.check_artist(artist_id)
+            finally:
+                artist_queue.task_done()
 
-                user_illusts_json = get_json_illusts(self.api, artist_id, self.token_switcher)
-                if not user_illusts_json:
+    def check_artist(self, artist_id):
+        create_dates = None
+        num_new_illusts = 0
+        start = time.monotonic()
+        try:
+            watermark = self.watermarks.get(artist_id) if self.watermarks is not None else None
+            user_illusts_json = get_json_illusts(self.clients, artist_id, self.token_switcher, watermark if self.probe else None)
+            if not user_illusts_json:
+                return
+
+            illusts = user_illusts_json["illusts"]
+            create_dates = [illust_json["create_date"] for illust_json in illusts]
+            for illust_json in illusts:
+                if watermark is not None and illust_json["id"] <= watermark:
+                    break # newest first, so the rest is old too
+                if not self.seen.query_illust(illust_json["id"]):
+                    num_new_illusts += 1
+                    self.new_illust(illust_json)
+
+            if self.watermarks is not None and illusts:
+                self.watermarks.update(artist_id, max(illust_json["id"] for illust_json in illusts))
+
+            self.seen.flush()
+        except Exception as e:
+            if self.config.get("crash_on_exception", False):
+                raise
+            logging.getLogger().error("Error in worker thread: %s", e)
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.reschedule(artist_id, create_dates, num_new_illusts > 0)
+            metrics.ARTIST_SECONDS.observe(time.monotonic() - start, monitor=self.name)
+
+    def new_illust(self, illust_json):
+        metrics.NEW_ILLUSTS.inc(monitor=self.name)
+        if self.owner is not None:
+            # sharded: the owner process dedups, logs and notifies (see shard.py)
+            self.owner.report(jsoncodec.to_builtins(illust_json))
+            return
+        handle_new_illust(illust_json, self.seen, self.hooks, self.dispatcher)
+
+def handle_new_illust(illust_json, seen, hooks, dispatcher):
+    illust = PixivIllustration.from_json(illust_json)
+    seen.add_illust(illust.iden)
+
+    print(f"[{utility.hrdatetime()}] \033[0;32mFound new illustration:\033[0m\n{str(illust)}\n")
+
+    page_count_string = "" if illust.page_count == 0 else f" ({illust.page_count} pages)"
+    log_message = f"New illustration: pixiv #{illust.iden}{page_count_string} '{illust.title}' by {illust.user.name} (@{illust.user.account}). Tags: {illust.get_tag_string(False)}"
+    logging.getLogger().info(log_message)
+
+    # Run hooks
+    for hook in hooks:
+        logging.getLogger().info("Running hook %s", hook)
+        hook.run(illust)
+
+    if dispatcher is not None:
+        dispatcher.submit(illust)
+    illustlog.log_illust(illust)
+
+# Instead of asking for every artist's illustrations separately, read the timeline of illustrations
+# from everyone one account follows (illust_follow): a few requests per cycle, however many artists
+# there are. The timeline is read newest first until the newest illustration from last time.
+# The timeline can miss things (if more was posted since last time than max_pages pages hold, or
+# illustrations that show up late), so every reconcile_interval seconds all artists are also checked
+# one by one, like a normal monitor does.
+class FollowMonitor(Monitor):
+    def __init__(self, check_interval, artist_ids, config, clients, seen, token_switcher, hooks, num_threads, max_concurrency, dispatcher, watermarks, probe, follow_token_switcher, only_listed=True, sync_follows=False, max_pages=10, reconcile_interval=6 * 60 * 60):
+        super().__init__(check_interval, artist_ids, config, clients, seen, token_switcher, hooks, num_threads, max_concurrency, None, dispatcher, watermarks, probe)
+        # requests for the timeline have to be made with the account that follows the artists
+        self.follow_token_switcher = follow_token_switcher
+        self.follow_token = follow_token_switcher.tokens[0]
+        # leave out illustrations from followed artists that aren't in artist_ids
+        self.only_listed = only_listed
+        self.sync_follows = sync_follows
+        self.max_pages = max_pages
+        self.reconcile_interval = reconcile_interval
+        self.last_reconcile = time.monotonic()
+        self.reconcile_due = False
+        self.follows_synced = False
+        # watermarks are per artist; the timeline's is saved under a key no artist can have
+        self.timeline_key = -1 - self.follow_token.index
+        self.timeline_watermark = watermarks.get(self.timeline_key) if watermarks is not None else None
+
+    def start_cycle(self):
+        try:
+            if self.sync_follows and not self.follows_synced:
+                self.sync_follow_list()
+                self.follows_synced = True
+            self.check_timeline()
+        except Exception as e:
+            if self.config.get("crash_on_exception", False):
+                raise
+            logging.getLogger().error("Error while reading the follow timeline: %s", e)
+
+    def due_artists(self):
+        if not self.reconcile_due and time.monotonic() - self.last_reconcile < self.reconcile_interval:
+            return []
+        logging.getLogger().info("Checking all %d artists one by one to catch anything the follow timeline missed", len(self.artist_ids))
+        self.last_reconcile = time.monotonic()
+        self.reconcile_due = False
+        # pick up artists that were added to the list since the last sync
+        self.follows_synced = False
+        return random.sample(self.artist_ids, len(self.artist_ids))
+
+    def cycle_sleep_time(self):
+        return self.check_interval
+
+    def set_artist_ids(self, artist_ids):
+        super().set_artist_ids(artist_ids)
+        # follow whoever was just added
+        self.follows_synced = False
+
+    def check_timeline(self):
+        listed = set(self.artist_ids)
+        watermark = self.timeline_watermark
+        newest = None
+        newest_per_artist = {}
+        num_new_illusts = 0
+        reached_watermark = False
+        offset = None
+        for _ in range(self.max_pages):
+            page = utility.api_wrapper(self.clients, self.follow_token_switcher, fetch_illust_follow, offset)
+            if "error" in page:
+                raise RuntimeError(page["error"])
+            for illust_json in page["illusts"]:
+                if watermark is not None and illust_json["id"] <= watermark:
+                    reached_watermark = True
+                    break
+                newest = max(newest or 0, illust_json["id"])
+                artist_id = illust_json["user"]["id"]
+                if self.only_listed and artist_id not in listed:
+                    continue
+                if self.seeder is not None and self.seeder.is_new(artist_id):
+                    # same as in cycle_artists; their first page includes this one
+                    self.seeder.submit(self, artist_id)
                     continue
+                newest_per_artist[artist_id] = max(newest_per_artist.get(artist_id, 0), illust_json["id"])
+                if not self.seen.query_illust(illust_json["id"]):
+                    num_new_illusts += 1
+                    self.new_illust(illust_json)
+            offset = next_offset(page.get("next_url"))
+            if reached_watermark or offset is None:
+                break
 
-                illusts = user_illusts_json["illusts"]
-                num_new_illusts = 0
-                first_illust = None
-                for illust_json in illusts:
-                    illust = PixivIllustration.from_json(illust_json)
-                    if not self.seen.query_illust(illust.iden):
-                        num_new_illusts += 1
-                        if num_new_illusts == 1:
-                            first_illust = illust
-                        self.seen.add_illust(illust.iden)
-
-                        print(f"[{utility.hrdatetime()}] \033[0;32mFound new illustration:\033[0m\n{str(illust)}\n")
-
-                        page_count_string = "" if illust.page_count == 0 else f" ({illust.page_count} pages)"
-                        log_message = f"New illustration: pixiv #{illust.iden}{page_count_string} '{illust.title}' by {illust.user.name} (@{illust.user.account}). Tags: {illust.get_tag_string(False)}"
-                        logging.getLogger().info(log_message)
-
-                        # Run hooks
-                        for hook in self.hooks:
-                            logging.getLogger().info("Running hook %s", hook)
-                            hook.run(illust)
-
-                        if not self.config["notifications_off"]:
-                            notify.send_notification(f"'{illust.title}' by {illust.user.name} (@{illust.user.account})", illust.pixiv_link(), illust.get_r18_tag())
-                        illustlog.log_illust(illust)
-
-                if "ntfy_topic" in self.config:
-                    if num_new_illusts > 1:
-                        # as to not spam ntfy's servers, we send one (1) notification with a summary of the pictures
-                        # link to the pixiv url instead of the individual pictures
-                        notify.send_ntfy(self.config["ntfy_topic"], f"{num_new_illusts} new illustrations from {illust.user.name}", illust.user.pixiv_link())
-                    elif num_new_illusts > 0:
-                        # just like usual
-                        notify.send_ntfy(self.config["ntfy_topic"], f"'{first_illust.title}' by {first_illust.user.name}", first_illust.pixiv_link(), first_illust.get_r18_tag())
-
-                self.seen.flush()
-            except Exception as e:
-                if self.config.get("crash_on_exception", False):
-                    raise
-                logging.getLogger().error("Error in worker thread: %s", e)
-            finally:
-                artist_queue.task_done()
+        if not reached_watermark and offset is not None:
+            # ran out of pages before getting to where we were last time; there's a gap
+            logging.getLogger().warning("Follow timeline has more than %d pages of new illustrations; checking all artists one by one", self.max_pages)
+            self.reconcile_due = True
+        elif self.watermarks is not None:
+            # per-artist watermarks are only safe to move when we've seen everything newer than last time,
+            # otherwise the one-by-one check would skip what's in the gap
+            for artist_id, illust_id in newest_per_artist.items():
+                self.watermarks.update(artist_id, illust_id)
+
+        if newest is not None:
+            self.timeline_watermark = newest
+            if self.watermarks is not None:
+                self.watermarks.update(self.timeline_key, newest)
+        self.seen.flush()
+        logging.getLogger().debug("Follow timeline of account %d: %d new illustrations", self.follow_token.index, num_new_illusts)
+
+    def sync_follow_list(self):
+        # follow every listed artist the account doesn't follow yet. never unfollows anyone
+        if self.follow_token.user_id is None:
+            self.follow_token.refresh() # the refresh response tells us who the account is
+        followed = set()
+        offset = None
+        while True:
+            page = utility.api_wrapper(self.clients, self.follow_token_switcher, "user_following", self.follow_token.user_id, offset=offset)
+            if "error" in page:
+                raise RuntimeError(page["error"])
+            followed.update(user_preview["user"]["id"] for user_preview in page["user_previews"])
+            offset = next_offset(page.get("next_url"))
+            if offset is None:
+                break
+
+        missing = [artist_id for artist_id in self.artist_ids if artist_id not in followed]
+        for artist_id in missing:
+            utility.api_wrapper(self.clients, self.follow_token_switcher, "user_follow_add", artist_id)
+        logging.getLogger().info("Account %d follows %d artists; followed %d more from the artist list", self.follow_token.index, len(followed), len(missing))
@@ -3,30 +3,51 @@ import logging
 import webbrowser
 import threading
 import sys
+import importlib
 import requests
 
-# lunix
-try:
-    import dbus
-    import dbus.mainloop.glib
-    from gi.repository import GLib
-    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-except ImportError:
-    dbus = None
+# the system notification libraries are only imported when the first notification gets sent, so
+# running without notifications (or headless) doesn't load dbus and GLib at all
+dbus = None
+GLib = None
+winotify = None
+backends_loaded = False
+backends_lock = threading.Lock()
 
-# window
-try:
-    import winotify
-except ImportError:
-    winotify = None
+def load_backends():
+    global dbus, GLib, winotify, backends_loaded
+    with backends_lock:
+        if backends_loaded:
+            return
+        backends_loaded = True
+        # lunix
+        if sys.platform.startswith("linux"):
+            try:
+                dbus_module = importlib.import_module("dbus")
+                dbus_glib = importlib.import_module("dbus.mainloop.glib")
+                GLib_module = importlib.import_module("gi.repository.GLib")
+                dbus_glib.DBusGMainLoop(set_as_default=True)
+                dbus, GLib = dbus_module, GLib_module
+            except ImportError:
+                pass
+        # window
+        elif sys.platform.startswith("win"):
+            try:
+                import winotify as winotify_module
+                winotify = winotify_module
+            except ImportError:
+                logging.getLogger().warning("winotify isn't installed. System notifications will not be shown")
 
 # i could have used an external library for this but they all suck bcus "cross platform"
 
+NTFY_SERVER = "https://ntfy.sh"
+
 def r18_title_prefix(r18_tag):
     return f"[!{r18_tag}!]" if len(r18_tag) > 0 else ""
 
 def send_notification(message, link, r18_tag=""):
     title_prefix = r18_title_prefix(r18_tag)
+    load_backends()
     if sys.platform.startswith("linux"):
         if dbus:
             try:
@@ -67,22 +88,27 @@ def send_notification(message, link, r18_tag=""):
                 logging.getLogger().warn(f"Unable to send dbus notification: {exc}; trying notify-send instead")
 
         # fallback in case we don't have dbus or it fail
-        subprocess.run(["notify-send", "-i", "dialog-information", f"{title_prefix}pixiv-monitor alert!", message, "-t", "0"])
+        try:
+            subprocess.run(["notify-send", "-i", "dialog-information", f"{title_prefix}pixiv-monitor alert!", message, "-t", "0"], timeout=10)
+        except subprocess.TimeoutExpired:
+            logging.getLogger().warning("notify-send took too long, giving up")
     elif sys.platform.startswith("win"):
         if winotify:
             toast = winotify.Notification(app_id="pixiv-monitor", title=f"{title_prefix}pixiv-monitor alert!", msg=message)
             toast.add_actions(label="View", launch=link)
             toast.show()
 
-def send_ntfy(ntfy_topic, message, link, r18_tag=""):
+def send_ntfy(ntfy_topic, message, link, r18_tag="", session=None, server=NTFY_SERVER, timeout=10):
     title_prefix = r18_title_prefix(r18_tag)
-    requests.post(
-        f"https://ntfy.sh",
+    response = (session or requests).post(
+        server,
         json={
             "topic": ntfy_topic,
             "title": f"{title_prefix}pixiv-monitor alert!",
             "message": message,
             "click": link
         },
-        headers={"Content-Type": "application/json; charset=utf-8"}
+        headers={"Content-Type": "application/json; charset=utf-8"},
+        timeout=timeout
     )
+    response.raise_for_status()
@@ -1,14 +1,19 @@
 import html
 
+# The model classes wrap the JSON they came from and only decode things when they're used. Most
+# illustrations in a response are ones we've already seen and only ever get their ID looked at.
+
 class PixivUser:
+    __slots__ = ("iden", "name", "account")
+
     def __init__(self, iden, name, account):
         self.iden = iden
         self.name = name
         self.account = account
- 
+
     def __str__(self):
         return f"\033[0;36m\033]8;;{self.pixiv_link()}\033\\{self.name}\033]8;;\033\\\033[0m \033]8;;{self.pixiv_stacc_link()}\033\\(@{self.account})\033]8;;\033\\"
-    
+
     @staticmethod
     def from_json(json_user):
         return PixivUser(json_user["id"], json_user["name"], json_user["account"])
@@ -20,10 +25,12 @@ class PixivUser:
         return f"https://pixiv.net/stacc/{self.account}"
 
 class PixivTag:
+    __slots__ = ("name", "translated_name")
+
     def __init__(self, name, translated_name):
         self.name = name
         self.translated_name = translated_name
-    
+
     def __str__(self, use_color=True):
         if use_color:
             if self.translated_name is None:
@@ -35,11 +42,11 @@ class PixivTag:
         if self.translated_name is None:
             return self.name
         return f"{self.name} / {self.translated_name}"
-    
+
     @staticmethod
     def from_json(tag_json):
         return PixivTag(tag_json["name"], tag_json["translated_name"])
-    
+
     @staticmethod
     def from_json_list(tags_json):
         tags = []
@@ -48,19 +55,54 @@ class PixivTag:
         return tags
 
 class PixivIllustration:
-    def __init__(self, iden, title, caption, user, tags, page_count, create_date, is_ai, is_sensitive):
-        self.iden = iden
-        self.title = title
-        self.caption = caption
-        self.user = user
-        self.tags = tags
-        self.page_count = page_count
-        self.is_ai = is_ai
-        self.is_sensitive = is_sensitive
-
-        # for log:
-        self.create_date = create_date
-    
+    __slots__ = ("json", "iden", "_user", "_tags", "_tag_string", "_tag_string_color", "_r18_tag")
+
+    def __init__(self, json_illust):
+        self.json = json_illust
+        self.iden = json_illust["id"]
+        self._user = None
+        self._tags = None
+        self._tag_string = None
+        self._tag_string_color = None
+        self._r18_tag = None
+
+    @property
+    def title(self):
+        return self.json["title"]
+
+    @property
+    def caption(self):
+        return self.json["caption"]
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = PixivUser.from_json(self.json["user"])
+        return self._user
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = PixivTag.from_json_list(self.json["tags"])
+        return self._tags
+
+    @property
+    def page_count(self):
+        return len(self.json["meta_pages"])
+
+    @property
+    def create_date(self):
+        # for log
+        return self.json["create_date"]
+
+    @property
+    def is_ai(self):
+        return self.json["illust_ai_type"] == 2
+
+    @property
+    def is_sensitive(self):
+        return self.json["sanity_level"] == 4
+
     def __str__(self):
         unescape_caption = html.unescape(self.caption)
         multiline_caption = unescape_caption.replace("<br />", "\n")
@@ -81,25 +123,22 @@ class PixivIllustration:
         )
 
     def get_tag_string(self, use_color=True):
-        return ", ".join(tag.__str__(use_color) for tag in self.tags)
+        if use_color:
+            if self._tag_string_color is None:
+                self._tag_string_color = ", ".join(tag.__str__(True) for tag in self.tags)
+            return self._tag_string_color
+        if self._tag_string is None:
+            self._tag_string = ", ".join(tag.__str__(False) for tag in self.tags)
+        return self._tag_string
 
     def pixiv_link(self):
         return f"https://www.pixiv.net/en/artworks/{self.iden}"
-    
+
     def get_r18_tag(self):
-        return next((tag.name for tag in self.tags if tag.name == "R-18" or tag.name == "R-18G"), "")
-    
+        if self._r18_tag is None:
+            self._r18_tag = next((tag.name for tag in self.tags if tag.name == "R-18" or tag.name == "R-18G"), "")
+        return self._r18_tag
+
     @staticmethod
     def from_json(json_illust):
-        return PixivIllustration(
-            json_illust["id"],
-            json_illust["title"],
-            json_illust["caption"],
-            PixivUser.from_json(json_illust["user"]),
-            PixivTag.from_json_list(json_illust["tags"]),
-            len(json_illust["meta_pages"]),
-            json_illust["create_date"],
-            json_illust["illust_ai_type"] == 2,
-            json_illust["sanity_level"] == 4
-        )
-
+        return PixivIllustration(json_illust)
@@ -1,56 +1,248 @@
 #!/usr/bin/python3
 
 import feedgen.feed
+import feedgen.entry
 import illustlog
 import logging
 import time
 import datetime
-import json
+import jsoncodec
+import os
+import argparse
+import threading
+import gzip
+import hashlib
+import http.server
+import urllib.parse
+import email.utils
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from pixivmodel import PixivIllustration
 
-def make_rss_feed(illust_log):
-    gen = feedgen.feed.FeedGenerator()
-    gen.id("pixiv-monitor")
-    gen.title("pixiv-monitor RSS feed")
-    gen.description("pixiv monitoring and whatnot")
-    gen.link(href="http://192.168.1.46/files/dev/pixiv-monitor/pixiv.atom")
-
-    for illust in illust_log["illusts"]:
-        illust_id = illust["id"]
-        illust_create_date = illust["create_date"]
-        illust_title = illust["title"]
-        illust_caption = illust["caption"]
-        illust_artist_name = illust["user"]["name"]
-        illust_artist_account = illust["user"]["account"]
-        illust_tags = illust["tags"]
-
-        entry = gen.add_entry()
-        entry.id(f"pixiv-{illust_id}")
-        entry.title(f"{illust_title} by {illust_artist_name} (@{illust_artist_account})")
-        entry.link(href=f"https://www.pixiv.net/en/artworks/{illust_id}")
-        entry.description(illust_caption if illust_caption else "no description specified")
-        entry.pubDate(datetime.datetime.fromisoformat(illust_create_date).strftime("%a, %d %b %Y %H:%M:%S +0000")) # placeholder tz
-
-    gen.rss_file("pixiv.atom")
-
-def make_rss_feed_safe():
+# The feed is kept in memory: on every change we only read the illustrations that were added to the
+# log since last time, and the feed is capped at max_items (and optionally max_age_days), so updating
+# it doesn't get slower as the log grows.
+
+class RssFeed:
+    def __init__(self, log, output_path="pixiv.atom", max_items=500, max_age_days=None):
+        self.log = log
+        self.output_path = output_path
+        self.max_items = max_items
+        self.max_age_days = max_age_days
+        self.entries = {} # illust ID -> (create_date, illust, FeedEntry)
+        self.cursor = None
+        self.lock = threading.Lock()
+        self.cache = {} # (artist, tag) -> RenderedFeed
+        self.last_modified = time.time()
+
+    def rebuild(self):
+        self.entries = {}
+        self.cursor = self.log.cursor()
+        self.add_illusts(self.log.iter_illusts(limit=self.max_items))
+        logging.info("Built RSS feed from the illust log (%d entries)", len(self.entries))
+
+    def update(self):
+        with self.lock:
+            if self.cursor is None:
+                self.rebuild()
+            else:
+                illusts, self.cursor = self.log.entries_since(self.cursor)
+                if illusts is None:
+                    # the log got compacted, offsets are different now
+                    self.rebuild()
+                else:
+                    self.add_illusts(illusts)
+                    logging.info("Added %d new entries to the RSS feed", len(illusts))
+            self.cache = {}
+            self.last_modified = time.time()
+
+    def add_illusts(self, illusts):
+        for illust in illusts:
+            self.entries[illust["id"]] = (illust["create_date"], illust, make_feed_entry(illust))
+        self.trim()
+
+    def trim(self):
+        newest = sorted(self.entries.items(), key=lambda item: item[1][0], reverse=True)
+        if self.max_age_days is not None:
+            oldest_date = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=self.max_age_days)
+            newest = [item for item in newest if datetime.datetime.fromisoformat(item[1][0]) >= oldest_date]
+        self.entries = dict(newest[:self.max_items])
+
+    def render(self, artist=None, tag=None):
+        gen = feedgen.feed.FeedGenerator()
+        gen.id("pixiv-monitor")
+        gen.title("pixiv-monitor RSS feed")
+        gen.description("pixiv monitoring and whatnot")
+        gen.link(href="http://192.168.1.46/files/dev/pixiv-monitor/pixiv.atom")
+
+        # self.entries is newest first
+        for _, illust, entry in self.entries.values():
+            if matches(illust, artist, tag):
+                gen.add_entry(entry, order="append")
+        return gen.rss_str()
+
+    def write(self):
+        with self.lock:
+            rss = self.render()
+        temp_path = self.output_path + ".tmp"
+        with open(temp_path, "wb") as rss_file:
+            rss_file.write(rss)
+        os.replace(temp_path, self.output_path)
+
+    def get_rendered(self, artist=None, tag=None):
+        # rendered (and gzipped) once per change of the log, per filter
+        key = (artist, tag)
+        with self.lock:
+            rendered = self.cache.get(key)
+            if rendered is None:
+                if len(self.cache) >= MAX_CACHED_FEEDS:
+                    self.cache = {}
+                rendered = RenderedFeed(self.render(artist, tag), self.last_modified)
+                self.cache[key] = rendered
+            return rendered
+
+MAX_CACHED_FEEDS = 256
+
+class RenderedFeed:
+    def __init__(self, body, last_modified):
+        self.body = body
+        self.gzip_body = gzip.compress(body)
+        digest = hashlib.sha1(body).hexdigest()[:16]
+        # a different body, so a different (strong) ETag, or a cache could hand gzip to someone who can't take it
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gz"'
+        self.last_modified = int(last_modified)
+
+def matches(illust, artist, tag):
+    if artist is not None and str(illust["user"].get("id")) != artist and illust["user"]["account"] != artist:
+        return False
+    if tag is not None:
+        # tags are stored as "name / translated name, name, ..."
+        names = {name.strip().lower() for part in illust["tags"].split(", ") for name in part.split(" / ")}
+        if tag.lower() not in names:
+            return False
+    return True
+
+# Serves the feed straight from memory. Supports conditional requests (ETag and Last-Modified), so
+# most polls by feed readers end up as a tiny 304, and gzip.
+# /pixiv.atom?artist=<ID or account> and /pixiv.atom?tag=<tag> give filtered feeds.
+class FeedRequestHandler(http.server.BaseHTTPRequestHandler):
+    feed = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path not in ("/", "/pixiv.atom"):
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        rendered = self.feed.get_rendered(query.get("artist", [None])[0], query.get("tag", [None])[0])
+        use_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+        etag = rendered.gzip_etag if use_gzip else rendered.etag
+
+        if self.not_modified(rendered, etag):
+            self.send_response(304)
+            self.send_common_headers(rendered, etag)
+            self.end_headers()
+            return
+
+        body = rendered.gzip_body if use_gzip else rendered.body
+        self.send_response(200)
+        self.send_common_headers(rendered, etag)
+        self.send_header("Content-Type", "application/rss+xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_modified(self, rendered, etag):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag in [candidate.strip() for candidate in if_none_match.split(",")] or if_none_match.strip() == "*"
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                return email.utils.parsedate_to_datetime(if_modified_since).timestamp() >= rendered.last_modified
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_common_headers(self, rendered, etag):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", email.utils.formatdate(rendered.last_modified, usegmt=True))
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Cache-Control", "no-cache")
+
+    def log_message(self, format, *args):
+        logging.debug("Feed server: " + format, *args)
+
+def start_feed_server(feed, host, port):
+    handler = type("BoundFeedRequestHandler", (FeedRequestHandler,), {"feed": feed})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Serving the RSS feed on http://%s:%d/pixiv.atom", host, port)
+    return server
+
+def make_feed_entry(illust):
+    illust_id = illust["id"]
+    illust_create_date = illust["create_date"]
+    illust_title = illust["title"]
+    illust_caption = illust["caption"]
+    illust_artist_name = illust["user"]["name"]
+    illust_artist_account = illust["user"]["account"]
+    illust_tags = illust["tags"]
+
+    entry = feedgen.entry.FeedEntry()
+    entry.id(f"pixiv-{illust_id}")
+    entry.title(f"{illust_title} by {illust_artist_name} (@{illust_artist_account})")
+    entry.link(href=f"https://www.pixiv.net/en/artworks/{illust_id}")
+    entry.description(illust_caption if illust_caption else "no description specified")
+    entry.pubDate(datetime.datetime.fromisoformat(illust_create_date).strftime("%a, %d %b %Y %H:%M:%S +0000")) # placeholder tz
+    return entry
+
+def update_feed_safe(feed):
     while True:
         try:
-            make_rss_feed(illustlog.get_illust_log())
+            feed.update()
+            feed.write()
             break
-        except json.decoder.JSONDecodeError as jde:
+        except jsoncodec.DECODE_ERRORS as jde:
             logging.warn(f"Failed to part illust log JSON: {jde}, retry in 5 seconds")
             time.sleep(5)
 
 class IllustLogChangeHandler(FileSystemEventHandler):
+    def __init__(self, changed, log_path):
+        self.changed = changed
+        self.log_path = log_path
+
     def on_modified(self, event):
-        if event.src_path == "./illustlog.json" or event.src_path == ".\\illustlog.json":
-            logging.info("Illust log changed, regenerating RSS feed")
-            make_rss_feed_safe()
+        if is_illust_log_path(event.src_path, self.log_path):
+            self.changed.set()
+
+    def on_moved(self, event):
+        # compaction replaces the log file
+        if is_illust_log_path(event.dest_path, self.log_path):
+            self.changed.set()
+
+def is_illust_log_path(path, log_path):
+    # with SQLite, new rows land in the -wal file first
+    return os.path.abspath(path) in (os.path.abspath(log_path), os.path.abspath(log_path + "-wal"))
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="pixiv.atom", help="Where to write the feed.")
+    parser.add_argument("--max-items", type=int, default=500, help="Maximum number of illustrations in the feed.")
+    parser.add_argument("--max-age-days", type=float, default=None, help="Leave out illustrations older than this many days.")
+    parser.add_argument("--debounce", type=float, default=2, help="Wait until the log hasn't changed for this many seconds before updating the feed.")
+    parser.add_argument("--serve", type=int, default=None, metavar="PORT", help="Also serve the feed over HTTP on this port.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to serve the feed on.")
+    parser.add_argument("--max-delay", type=float, default=30, help="...but don't wait longer than this many seconds.")
+    parser.add_argument("--db", default=None, help="Read the illustration log from this SQLite database (storage backend \"sqlite\").")
+    return parser.parse_args()
 
 def main():
+    args = parse_cli_args()
+
     logging.basicConfig(filename="rss.log", level=logging.INFO)
     logger = logging.getLogger()
 
@@ -61,16 +253,39 @@ def main():
 
     logger.info("pixiv-monitor RSS feed started")
 
-    event_handler = IllustLogChangeHandler()
+    if args.db is not None:
+        import sqlitestore
+        log = sqlitestore.SqliteIllustLog(path=args.db)
+        log_path = args.db
+    else:
+        # main.py writes the log and its index; we only read them
+        log = illustlog.IllustLog(read_only=True)
+        log_path = illustlog.LOG_PATH
+    feed = RssFeed(log, args.output, args.max_items, args.max_age_days)
+
+    changed = threading.Event()
+    event_handler = IllustLogChangeHandler(changed, log_path)
     observer = Observer()
-    observer.schedule(event_handler, path=".", recursive=False)
+    observer.schedule(event_handler, path=os.path.dirname(os.path.abspath(log_path)), recursive=False)
     observer.start()
 
-    make_rss_feed_safe()
+    update_feed_safe(feed)
+
+    if args.serve is not None:
+        start_feed_server(feed, args.host, args.serve)
 
     try:
         while True:
-            time.sleep(1)
+            if not changed.wait(1):
+                continue
+            # a burst of new illustrations means a burst of changes; wait for it to settle down
+            first_change = time.monotonic()
+            changed.clear()
+            while changed.wait(args.debounce) and time.monotonic() - first_change < args.max_delay:
+                changed.clear()
+            changed.clear()
+            logging.info("Illust log changed, updating RSS feed")
+            update_feed_safe(feed)
     except KeyboardInterrupt:
         observer.stop()
         logging.info("User terminate. Gracefully stopping")
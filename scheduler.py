@@ -0,0 +1,145 @@
+import datetime
+import heapq
+import jsoncodec
+import logging
+import os
+import random
+import statistics
+import threading
+import time
+
+STATE_PATH = "./schedule.json"
+
+# Adaptive polling: instead of checking every artist every cycle, each artist gets its own interval
+# based on how often they post, clamped between min_interval and max_interval. An artist who posts
+# daily gets checked much more often than one who posts twice a year.
+#
+# ScheduleState is shared by all monitors and saved to schedule.json, so restarting doesn't mean
+# checking everyone at once. Each monitor has its own ArtistScheduler, a heap of (next due time, artist ID).
+
+class ScheduleState:
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.artists = {} # artist ID -> {"next_due": unix time, "interval": seconds, "last_post": unix time, "median_gap": seconds}
+        self.dirty = False
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as state_json:
+                self.artists = {int(k): v for k, v in jsoncodec.load(state_json)["artists"].items()}
+
+    def seed_from_log(self, illusts):
+        # no saved state yet: guess from when each artist posted the illustrations we've logged so far
+        dates = {}
+        for illust in illusts:
+            artist_id = illust["user"].get("id")
+            if artist_id is not None:
+                dates.setdefault(artist_id, []).append(parse_date(illust["create_date"]))
+        with self.lock:
+            for artist_id, artist_dates in dates.items():
+                if artist_id not in self.artists:
+                    self.artists[artist_id] = {"next_due": 0, "interval": None, "last_post": max(artist_dates), "median_gap": median_gap(artist_dates)}
+            self.dirty = True
+        logging.getLogger().info("Seeded schedule for %d artists from the illustration log", len(dates))
+
+    def get(self, artist_id):
+        return self.artists.get(artist_id)
+
+    def update(self, artist_id, entry):
+        with self.lock:
+            self.artists[artist_id] = entry
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as state_json:
+                jsoncodec.dump({"artists": self.artists}, state_json)
+            os.replace(temp_path, self.path)
+            self.dirty = False
+
+class ArtistScheduler:
+    def __init__(self, state, artist_ids, min_interval, max_interval, factor=0.05):
+        self.state = state
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.lock = threading.Lock()
+        self.artist_ids = set(artist_ids)
+        now = time.time()
+        self.heap = [(self.initial_due(artist_id, now), artist_id) for artist_id in self.artist_ids]
+        heapq.heapify(self.heap)
+
+    @staticmethod
+    def from_json(json_schedule, state, artist_ids, check_interval):
+        return ArtistScheduler(state, artist_ids, json_schedule.get("min_interval", check_interval), json_schedule.get("max_interval", 6 * 60 * 60), json_schedule.get("factor", 0.05))
+
+    def initial_due(self, artist_id, now):
+        entry = self.state.get(artist_id)
+        if entry is None:
+            return now # never seen them, check right away
+        if entry["next_due"] == 0:
+            # seeded from the log; spread them out so they don't all get checked at once
+            return now + random.uniform(0, self.interval_for(entry, now))
+        return entry["next_due"]
+
+    def set_artist_ids(self, artist_ids):
+        # artist_ids changed in settings.json; everyone who stays keeps their place in the heap
+        now = time.time()
+        artist_ids = set(artist_ids)
+        with self.lock:
+            added = artist_ids - self.artist_ids
+            self.heap = [entry for entry in self.heap if entry[1] in artist_ids]
+            self.heap.extend((self.initial_due(artist_id, now), artist_id) for artist_id in added)
+            heapq.heapify(self.heap)
+            self.artist_ids = artist_ids
+
+    def interval_for(self, entry, now):
+        gap = entry.get("median_gap")
+        if gap is None:
+            return self.min_interval
+        # someone who hasn't posted in ages is probably not going to post in the next 5 minutes either
+        if entry.get("last_post") is not None:
+            gap = max(gap, (now - entry["last_post"]) / 2)
+        return min(self.max_interval, max(self.min_interval, gap * self.factor))
+
+    def pop_due(self):
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap)[1])
+        return due
+
+    def seconds_until_next(self):
+        with self.lock:
+            if not self.heap:
+                return self.max_interval
+            return max(0, self.heap[0][0] - time.time())
+
+    def reschedule(self, artist_id, create_dates, found_new):
+        now = time.time()
+        entry = dict(self.state.get(artist_id) or {})
+        if create_dates:
+            dates = [parse_date(d) for d in create_dates]
+            entry["last_post"] = max(dates)
+            entry["median_gap"] = median_gap(dates)
+        # found something, they might post more soon
+        interval = self.min_interval if found_new else self.interval_for(entry, now)
+        entry["interval"] = interval
+        entry["next_due"] = now + interval
+        self.state.update(artist_id, entry)
+        with self.lock:
+            # unless they were taken out of artist_ids while being checked
+            if artist_id in self.artist_ids:
+                heapq.heappush(self.heap, (entry["next_due"], artist_id))
+
+def parse_date(create_date):
+    return datetime.datetime.fromisoformat(create_date).timestamp()
+
+def median_gap(dates):
+    dates = sorted(dates)[-11:] # only the recent ones matter
+    if len(dates) < 2:
+        return None
+    return statistics.median(b - a for a, b in zip(dates, dates[1:]))
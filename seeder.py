@@ -0,0 +1,100 @@
+import logging
+import queue
+import threading
+import metrics
+import utility
+from monitor import fetch_user_illusts
+from tokenswitcher import TokenSwitcher
+
+# Artists nobody has ever polled (no watermark yet) would have their whole first page treated as new:
+# up to 30 notifications, hook runs and log entries for illustrations that might be years old, times
+# however many artists were just added. Instead, monitors hand such artists over to the seeder, which
+# fetches their first page once and adds all of it to the seen set in one go, without any of that,
+# and sets their watermark. From then on they're polled like everyone else.
+#
+# No watermark doesn't always mean new, though: watermarks can be turned on (or watermarks.json lost)
+# long after an artist was added. If anything on their first page is in the seen set already, we know
+# them, and whatever on it isn't seen yet was posted while nobody was looking, so that gets notified
+# like any other new illustration. (main.py also fills in watermarks from the illustration log when
+# there are none at all, so after upgrading most artists don't have to come through here.)
+#
+# The seeder has a queue and a thread of its own, and like backfill.py it only takes an account that
+# has `reserve` requests of budget to spare, so adding 500 artists doesn't hold up anybody's cycle.
+# (--backfill goes further and logs whole histories.)
+
+class Seeder:
+    def __init__(self, clients, token_switcher, seen, watermarks, num_threads=1):
+        self.clients = clients
+        self.token_switcher = token_switcher
+        self.seen = seen
+        self.watermarks = watermarks
+        self.num_threads = num_threads
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = {} # artist ID queued or being seeded -> monitors that submitted it
+
+    @staticmethod
+    def from_json(json_seeding, clients, token_switcher, seen, watermarks):
+        seeder_token_switcher = TokenSwitcher(len(token_switcher.tokens), False)
+        seeder_token_switcher.tokens = token_switcher.tokens
+        seeder_token_switcher.reserve = json_seeding.get("reserve", 1)
+        return Seeder(clients, seeder_token_switcher, seen, watermarks, json_seeding.get("num_threads", 1))
+
+    def run(self):
+        for _ in range(self.num_threads):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def is_new(self, artist_id):
+        return self.watermarks.get(artist_id) is None
+
+    def submit(self, monitor, artist_id):
+        # several monitors can have the same artist; every one of them gets it back in its schedule
+        with self.lock:
+            if artist_id in self.pending:
+                if monitor not in self.pending[artist_id]:
+                    self.pending[artist_id].append(monitor)
+                return
+            self.pending[artist_id] = [monitor]
+        self.queue.put(artist_id)
+        metrics.SEED_QUEUE_DEPTH.inc()
+
+    def worker(self):
+        while True:
+            artist_id = self.queue.get()
+            with self.lock:
+                monitors = list(self.pending[artist_id])
+            create_dates = None
+            try:
+                create_dates = self.seed_artist(monitors[0], artist_id)
+            except Exception as e:
+                # still no watermark, so it comes back here next cycle
+                logging.getLogger().error("Error while seeding artist %d: %s", artist_id, e)
+            finally:
+                with self.lock:
+                    monitors = self.pending.pop(artist_id)
+                metrics.SEED_QUEUE_DEPTH.dec()
+                for monitor in monitors:
+                    if monitor.scheduler is not None:
+                        # found_new: get them checked properly soon
+                        monitor.scheduler.reschedule(artist_id, create_dates, create_dates is not None)
+
+    def seed_artist(self, monitor, artist_id):
+        page = utility.api_wrapper(self.clients, self.token_switcher, fetch_user_illusts, artist_id)
+        if "error" in page:
+            raise RuntimeError(page["error"])
+        illusts = page["illusts"]
+        illust_ids = [illust_json["id"] for illust_json in illusts]
+        unseen = [illust_json for illust_json in illusts if not self.seen.query_illust(illust_json["id"])]
+        if len(unseen) < len(illusts):
+            # we know them, they just had no watermark
+            for illust_json in unseen:
+                monitor.new_illust(illust_json)
+            logging.getLogger().info("Artist %d has no watermark but was checked before: %d new illustrations", artist_id, len(unseen))
+        else:
+            self.seen.add_illusts(illust_ids)
+            metrics.SEEDED_ARTISTS.inc()
+            logging.getLogger().info("Seeded new artist %d: %d existing illustrations marked as seen", artist_id, len(illust_ids))
+        self.seen.flush()
+        # 0 if they have nothing yet; still marks them as polled
+        self.watermarks.update(artist_id, max(illust_ids, default=0))
+        return [illust_json["create_date"] for illust_json in illusts]
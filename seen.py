@@ -1,26 +1,201 @@
 import threading
 import os
-import json
+import jsoncodec
+import time
+import logging
+import metrics
+from seenindex import make_index, write_snapshot
+
+SNAPSHOT_PATH = "./seen.bin"
+JOURNAL_PATH = "./seen.journal"
+LEGACY_PATH = "./seen.json"
+
+# The seen set lives in two files:
+# - seen.bin: snapshot of every ID as a sorted array of little-endian uint64s
+# - seen.journal: IDs added since the snapshot, one per line, append-only
+# On startup we load the snapshot and replay the journal on top of it. Once the journal gets long
+# enough it's folded into a new snapshot. While a snapshot is being written the old journal is kept
+# as seen.journal.old so a crash at any point loses nothing.
+#
+# How the IDs are held in memory depends on the index backend (see seenindex.py).
+#
+# seen.json (the old format) is still understood: if it exists, it's merged in and renamed to seen.json.bak.
+#
+# load_in_background() loads all that on a thread of its own, so startup can get on with other things;
+# lookups and adds wait until loading is done.
 
 class SeenIllustrations:
-    def __init__(self, initialize=True):
+    def __init__(self, initialize=True, flush_every=50, flush_interval=30, snapshot_every=100000, backend="set",
+                 snapshot_path=SNAPSHOT_PATH, journal_path=JOURNAL_PATH, legacy_path=LEGACY_PATH):
         self.lock = threading.Lock()
-        self.seen_illusts = set()
-        if initialize and os.path.exists("./seen.json"):
-            with open("./seen.json", "r", encoding="utf8") as seen_json:
-                jseen = json.load(seen_json)
-                self.seen_illusts = set(jseen["illusts"])
+        self.seen_illusts = make_index(backend)
+        self.pending = [] # added but not journaled yet
+        self.journal_size = 0 # IDs in the journal since the last snapshot
+        self.snapshotting = False
+        self.last_flush = time.monotonic()
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.legacy_path = legacy_path
+        self.loaded = threading.Event()
+        self.load_error = None
+        if initialize:
+            self.load()
+        else:
+            self.loaded.set()
+
+    @staticmethod
+    def from_json(json_seen, initialize=True, background=False):
+        seen = SeenIllustrations(
+            initialize and not background,
+            json_seen.get("flush_every", 50),
+            json_seen.get("flush_interval", 30),
+            json_seen.get("snapshot_every", 100000),
+            json_seen.get("backend", "set")
+        )
+        if initialize and background:
+            seen.load_in_background()
+        return seen
+
+    def load_in_background(self):
+        self.loaded.clear()
+        def load():
+            try:
+                self.load()
+            except Exception as e:
+                logging.getLogger().critical("Failed to load seen illustrations: %s", e)
+                self.load_error = e
+                self.loaded.set()
+        threading.Thread(target=load, daemon=True).start()
+
+    def wait_loaded(self):
+        self.loaded.wait()
+        if self.load_error is not None:
+            raise RuntimeError(f"seen illustrations failed to load: {self.load_error}")
+
+    def load(self):
+        start = time.monotonic()
+        with self.lock:
+            self.seen_illusts.load_snapshot(self.snapshot_path)
+            self.journal_size = 0
+            for path in (self.journal_path + ".old", self.journal_path):
+                journal_ids = list(read_journal(path))
+                self.seen_illusts.update(journal_ids)
+                self.journal_size += len(journal_ids)
+
+            repair_journal(self.journal_path + ".old")
+            repair_journal(self.journal_path)
+
+        if os.path.exists(self.journal_path + ".old"):
+            # we crashed while writing a snapshot; finish the job
+            self.write_snapshot()
+
+        if os.path.exists(self.legacy_path):
+            self.import_json(self.legacy_path)
+            os.replace(self.legacy_path, self.legacy_path + ".bak")
 
-    def flush(self):
+        logging.getLogger().debug("Loaded %d seen illustrations (%d from journal) in %.2fs", len(self.seen_illusts), self.journal_size, time.monotonic() - start)
+        metrics.SEEN_SIZE.set(len(self.seen_illusts))
+        self.loaded.set()
+
+    def import_json(self, path):
+        with open(path, "r", encoding="utf8") as seen_json:
+            jseen = jsoncodec.load(seen_json)
+        with self.lock:
+            new_illusts = self.seen_illusts.update(jseen["illusts"])
+            self.pending.extend(new_illusts)
+        logging.getLogger().info("Imported %d illustrations from %s", len(new_illusts), path)
+        self.flush(force=True)
+
+    def flush(self, force=False):
+        if not self.pending:
+            return # nothing changed since the last flush
+        with self.lock:
+            if not self.pending:
+                return
+            if not force and len(self.pending) < self.flush_every and time.monotonic() - self.last_flush < self.flush_interval:
+                return
+            start = time.monotonic()
+            with open(self.journal_path, "a", encoding="utf8") as journal:
+                journal.write("".join(f"{iden}\n" for iden in self.pending))
+                journal.flush()
+                os.fsync(journal.fileno())
+            self.journal_size += len(self.pending)
+            self.pending = []
+            self.last_flush = time.monotonic()
+            metrics.SEEN_FLUSH_SECONDS.observe(self.last_flush - start)
+            metrics.SEEN_SIZE.set(len(self.seen_illusts))
+            if self.journal_size < self.snapshot_every or self.snapshotting:
+                return
+        self.write_snapshot()
+
+    def write_snapshot(self):
         with self.lock:
-            temp_path = "./seen.json.tmp"
-            with open(temp_path, "w", encoding="utf8") as seen_json:
-                json.dump({"illusts": list(self.seen_illusts)}, seen_json)
-            os.replace(temp_path, "./seen.json")
+            if self.snapshotting:
+                return
+            self.snapshotting = True
+            # start a fresh journal; the old one stays around until the snapshot is safely written.
+            # if there's already an old journal (we crashed last time), it's in memory too, so appending
+            # the current one to it keeps both on disk until the snapshot is done
+            if os.path.exists(self.journal_path):
+                old_path = self.journal_path + ".old"
+                if os.path.exists(old_path):
+                    with open(self.journal_path, "rb") as journal, open(old_path, "ab") as old_journal:
+                        old_journal.write(journal.read())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, old_path)
+            sorted_ids = self.seen_illusts.begin_snapshot()
+            self.pending = []
+            self.journal_size = 0
+        try:
+            start = time.monotonic()
+            write_snapshot(self.snapshot_path, sorted_ids)
+            with self.lock:
+                self.seen_illusts.end_snapshot(self.snapshot_path)
+            if os.path.exists(self.journal_path + ".old"):
+                os.remove(self.journal_path + ".old")
+            logging.getLogger().debug("Wrote seen snapshot with %d illustrations in %.2fs", len(self.seen_illusts), time.monotonic() - start)
+        finally:
+            self.snapshotting = False
 
     def add_illust(self, iden):
+        self.wait_loaded()
         with self.lock:
-            self.seen_illusts.add(iden)
+            if self.seen_illusts.add(iden):
+                self.pending.append(iden)
+
+    def add_illusts(self, idens):
+        self.wait_loaded()
+        with self.lock:
+            self.pending.extend(self.seen_illusts.update(idens))
 
     def query_illust(self, iden):
+        self.wait_loaded()
         return iden in self.seen_illusts
+
+    def __len__(self):
+        self.wait_loaded()
+        return len(self.seen_illusts)
+
+def read_journal(path):
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf8") as journal:
+        for line in journal:
+            if not line.endswith("\n"):
+                break # torn write
+            yield int(line)
+
+def repair_journal(path):
+    # cut off a half-written line so the next append doesn't glue onto it
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as journal:
+        data = journal.read()
+        good_size = data.rfind(b"\n") + 1
+        if good_size != len(data):
+            logging.getLogger().warning("Truncating incomplete line at the end of %s", path)
+            journal.truncate(good_size)
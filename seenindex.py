@@ -0,0 +1,162 @@
+import array
+import bisect
+import heapq
+import mmap
+import os
+import struct
+import sys
+
+SNAPSHOT_MAGIC = b"PMSEEN1\0"
+SNAPSHOT_HEADER = struct.Struct("<8sQ")
+
+# Seen-ID index backends. Both understand the same snapshot file: a header followed by every ID as
+# a sorted array of little-endian uint64s.
+#
+# SetIndex: plain Python set. Fast, but costs ~60-70 bytes per ID.
+# ArrayIndex: the snapshot is memory-mapped and searched with bisect, so startup doesn't parse
+#   anything and the IDs cost 8 bytes each (and only in the page cache). IDs added since the snapshot
+#   are kept in a small set and merged into the array when the next snapshot is written.
+
+class SetIndex:
+    def __init__(self):
+        self.ids = set()
+
+    def load_snapshot(self, path):
+        self.ids = set(read_snapshot(path))
+
+    def __contains__(self, iden):
+        return iden in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def add(self, iden):
+        if iden in self.ids:
+            return False
+        self.ids.add(iden)
+        return True
+
+    def update(self, idens):
+        new_ids = set(idens) - self.ids
+        self.ids.update(new_ids)
+        return new_ids
+
+    def begin_snapshot(self):
+        # called with the seen lock held, so only copy here; the sorting happens when the result is consumed
+        return sorted_later(list(self.ids))
+
+    def end_snapshot(self, path):
+        pass
+
+class ArrayIndex:
+    def __init__(self):
+        self.base = array.array("Q") # sorted
+        self.delta = set() # added since the snapshot
+        self.frozen = set() # being written into the next snapshot
+
+    def load_snapshot(self, path):
+        self.base = map_snapshot(path)
+        self.delta = set()
+        self.frozen = set()
+
+    def __contains__(self, iden):
+        if iden in self.delta or iden in self.frozen:
+            return True
+        base = self.base
+        i = bisect.bisect_left(base, iden)
+        return i < len(base) and base[i] == iden
+
+    def __len__(self):
+        return len(self.base) + len(self.frozen) + len(self.delta)
+
+    def __iter__(self):
+        yield from self.base
+        yield from self.frozen
+        yield from self.delta
+
+    def add(self, iden):
+        if iden in self:
+            return False
+        self.delta.add(iden)
+        return True
+
+    def update(self, idens):
+        new_ids = set()
+        base = self.base
+        # walking the batch in order lets each search start where the last one stopped
+        lo = 0
+        for iden in sorted(set(idens)):
+            if iden in self.delta or iden in self.frozen:
+                continue
+            lo = bisect.bisect_left(base, iden, lo)
+            if lo < len(base) and base[lo] == iden:
+                continue
+            new_ids.add(iden)
+        self.delta.update(new_ids)
+        return new_ids
+
+    def begin_snapshot(self):
+        # if the last snapshot failed, its IDs are still in frozen
+        self.frozen = self.frozen | self.delta
+        self.delta = set()
+        return heapq.merge(self.base, sorted(self.frozen))
+
+    def end_snapshot(self, path):
+        # the old mapping goes away once nobody's looking at it anymore
+        self.base = map_snapshot(path)
+        self.frozen = set()
+
+BACKENDS = {
+    "set": SetIndex,
+    "array": ArrayIndex
+}
+
+def make_index(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown seen index backend '{backend}'")
+    return BACKENDS[backend]()
+
+def sorted_later(ids):
+    ids.sort()
+    yield from ids
+
+def read_snapshot(path):
+    if not os.path.exists(path):
+        return array.array("Q")
+    with open(path, "rb") as snapshot:
+        magic, count = SNAPSHOT_HEADER.unpack(snapshot.read(SNAPSHOT_HEADER.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a seen snapshot")
+        ids = array.array("Q")
+        ids.fromfile(snapshot, count)
+    if sys.byteorder == "big":
+        ids.byteswap()
+    return ids
+
+def map_snapshot(path):
+    # windows can't replace a file that's mapped, and big endian machines need the bytes swapped
+    if os.name == "nt" or sys.byteorder != "little" or not os.path.exists(path):
+        return read_snapshot(path)
+    with open(path, "rb") as snapshot:
+        if os.fstat(snapshot.fileno()).st_size <= SNAPSHOT_HEADER.size:
+            return read_snapshot(path)
+        mapping = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, count = SNAPSHOT_HEADER.unpack_from(mapping)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a seen snapshot")
+    return memoryview(mapping)[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + count * 8].cast("Q")
+
+def write_snapshot(path, sorted_ids):
+    ids = array.array("Q", sorted_ids)
+    if sys.byteorder == "big":
+        ids.byteswap()
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as snapshot:
+        snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(ids)))
+        ids.tofile(snapshot)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temp_path, path)
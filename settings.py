@@ -1,10 +1,14 @@
-import json
+import jsoncodec
 import logging
+import metrics
 import os
 import sys
+from tokenswitcher import DEFAULT_RATE_LIMIT_CONFIG
 
 # TODO Rewrite this
 
+SETTINGS_PATH = "./settings.json"
+
 DEFAULT_LOG_CONFIG = {
     "backup_count": 5,
     "max_size": 10,
@@ -12,40 +16,100 @@ DEFAULT_LOG_CONFIG = {
     "level": "info"
 }
 
+DEFAULT_SEEN_CONFIG = {
+    "flush_every": 50,
+    "flush_interval": 30,
+    "snapshot_every": 100000,
+    "backend": "set"
+}
+
+DEFAULT_STORAGE_CONFIG = {
+    "backend": "files", # or "sqlite"
+    "path": "./pixiv-monitor.db"
+}
+
+DEFAULT_SEEDING_CONFIG = {
+    "enabled": True, # needs watermarks
+    "num_threads": 1,
+    "reserve": 1
+}
+
+DEFAULT_BACKFILL_CONFIG = {
+    "num_threads": 2,
+    "reserve": 2, # requests of budget an account has to have left before backfilling uses it
+    "path": "./backfill.json",
+    "save_interval": 10
+}
+
+DEFAULT_SHARDING_CONFIG = {
+    "enabled": False,
+    "shards": 2,
+    "split": "hash", # "hash": consistent hashing of artist_ids, "monitors": monitors are dealt out to shards
+    "host": "127.0.0.1",
+    "port": 50600,
+    "local_workers": True, # start the workers as child processes
+    "virtual_nodes": 64
+}
+
+DEFAULT_SHARED_CONFIG = {
+    "num_threads": 30 # for all monitors together
+}
+
+DEFAULT_RELOAD_CONFIG = {
+    "enabled": True,
+    "debounce": 1 # seconds settings.json has to stay unchanged before it's reloaded
+}
+
 def get_config():
-    if not os.path.exists("./settings.json"):
+    if not os.path.exists(SETTINGS_PATH):
         print("Settings file not found. Please follow the setup instructions and try again.")
         sys.exit(1)
-    with open("./settings.json", "r", encoding="utf-8") as config_json:
-        return json.load(config_json)
+    with open(SETTINGS_PATH, "r", encoding="utf-8") as config_json:
+        return jsoncodec.load(config_json)
 
 def save_config(config):
-    with open("./settings.json", "w", encoding="utf-8") as config_json:
-        config_json.write(json.dumps(config, indent=4))
+    with open(SETTINGS_PATH, "w", encoding="utf-8") as config_json:
+        config_json.write(jsoncodec.dumps(config, indent=4))
 
-def check_config(config):
+def check_config(config, quiet=False):
+    # quiet: only log what's wrong, e.g. when settings.json is reloaded (see configwatch.py)
     logger = logging.getLogger()
 
+    def report(message):
+        if not quiet:
+            print(message)
+
     if ("artist_ids" not in config or len(config["artist_ids"]) == 0) and "monitors" not in config:
-        print("No artist IDs specified. Halting.")
+        report("No artist IDs specified. Halting.")
         logger.error("Config check failed: artist_ids not specified or empty")
         return False
 
     for artist_id in config["artist_ids"]:
         if artist_id < 1:
-            print("Artist ID cannot be less than 1. Halting.")
+            report("Artist ID cannot be less than 1. Halting.")
             logger.error("Config check failed: one of the specified artist IDs is less than 1")
             return False
         if not isinstance(artist_id, int):
-            print("Artist ID must be an integer value. Halting.")
+            report("Artist ID must be an integer value. Halting.")
             logger.error("Config check failed: one of the specified artist IDs is not an integer value")
             return False
 
+    for monitor in config.get("monitors", []):
+        if monitor.get("type", "artists") not in ("artists", "follow"):
+            report("Monitor type must be either \"artists\" or \"follow\". Halting.")
+            logger.error("Config check failed: unknown monitor type %s", monitor["type"])
+            return False
+        weight = monitor.get("weight", 1)
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            report("Monitor weight must be a positive number. Halting.")
+            logger.error("Config check failed: monitor weight %s is not a positive number", weight)
+            return False
+
     if "check_interval" not in config:
         config["check_interval"] = 60 * 5 # default value 5 minutes
 
     if not isinstance(config["check_interval"], int) and not isinstance(config["check_interval"], float):
-        print("Check interval must be either an integer or floating-point value. Halting.")
+        report("Check interval must be either an integer or floating-point value. Halting.")
         logger.error("Config check failed: check_interval is not an integer or float value")
         return False
 
@@ -53,11 +117,177 @@ def check_config(config):
         config["num_accounts"] = 1
 
     if not isinstance(config["num_accounts"], int):
-        print("Number of accounts must be an integer value. Halting.")
+        report("Number of accounts must be an integer value. Halting.")
         logger.error("Config check failed: num_accounts is not an integer value")
         return False
 
+    if "schedule" not in config:
+        config["schedule"] = {"enabled": False}
+
+    if config["schedule"].get("enabled", False):
+        min_interval = config["schedule"].get("min_interval", config["check_interval"])
+        max_interval = config["schedule"].get("max_interval", 6 * 60 * 60)
+        if not isinstance(min_interval, (int, float)) or not isinstance(max_interval, (int, float)) or min_interval > max_interval:
+            report("schedule.min_interval and schedule.max_interval must be numbers, and min_interval can't be greater than max_interval. Halting.")
+            logger.error("Config check failed: bad schedule.min_interval/max_interval")
+            return False
+
+    if "engine" not in config:
+        config["engine"] = "threads"
+
+    if config["engine"] not in ("threads", "async", "shared"):
+        report("Engine must be \"threads\", \"async\" or \"shared\". Halting.")
+        logger.error("Config check failed: unknown engine %s", config["engine"])
+        return False
+
+    config["shared"] = {**DEFAULT_SHARED_CONFIG, **config.get("shared", {})}
+
+    if not isinstance(config["shared"]["num_threads"], int) or config["shared"]["num_threads"] < 1:
+        report("shared.num_threads must be a positive integer. Halting.")
+        logger.error("Config check failed: shared.num_threads is not a positive integer")
+        return False
+
     if "log" not in config:
-        config["log"] = DEFAULT_LOG_CONFIG
+        config["log"] = dict(DEFAULT_LOG_CONFIG)
+
+    pool_size = config.get("client_pool_size")
+    if pool_size is not None and (not isinstance(pool_size, int) or pool_size < 1):
+        report("client_pool_size must be a positive integer. Halting.")
+        logger.error("Config check failed: client_pool_size is not a positive integer")
+        return False
+
+    if "notifications" not in config:
+        config["notifications"] = {}
+
+    for key in ("window", "queue_size", "max_individual"):
+        value = config["notifications"].get(key, 1)
+        if not isinstance(value, (int, float)) or value < 0:
+            report(f"notifications.{key} must be a non-negative number. Halting.")
+            logger.error("Config check failed: notifications.%s is not a non-negative number", key)
+            return False
+
+    hook_workers = config.get("hook_workers", 4)
+    if not isinstance(hook_workers, int) or hook_workers < 1:
+        report("hook_workers must be a positive integer. Halting.")
+        logger.error("Config check failed: hook_workers is not a positive integer")
+        return False
+
+    if "watermarks" not in config:
+        config["watermarks"] = {}
+
+    if "token_refresh" not in config:
+        config["token_refresh"] = {}
+
+    if not isinstance(config["token_refresh"].get("margin", 300), (int, float)):
+        report("token_refresh.margin must be a number. Halting.")
+        logger.error("Config check failed: token_refresh.margin is not a number")
+        return False
+
+    if "rate_limit" not in config:
+        config["rate_limit"] = {}
+
+    for key in ("rate", "burst", "backoff", "max_backoff"):
+        value = config["rate_limit"].get(key, 1)
+        if not isinstance(value, (int, float)) or value <= 0:
+            report(f"rate_limit.{key} must be a positive number. Halting.")
+            logger.error("Config check failed: rate_limit.%s is not a positive number", key)
+            return False
+
+    if "seen" not in config:
+        config["seen"] = dict(DEFAULT_SEEN_CONFIG)
+
+    for key in ("flush_every", "flush_interval", "snapshot_every"):
+        if key in config["seen"] and not isinstance(config["seen"][key], (int, float)):
+            report(f"seen.{key} must be a number. Halting.")
+            logger.error("Config check failed: seen.%s is not a number", key)
+            return False
+
+    if config["seen"].get("backend", "set") not in ("set", "array"):
+        report("seen.backend must be either \"set\" or \"array\". Halting.")
+        logger.error("Config check failed: unknown seen.backend %s", config["seen"]["backend"])
+        return False
+
+    config["storage"] = {**DEFAULT_STORAGE_CONFIG, **config.get("storage", {})}
+
+    if config["storage"]["backend"] not in ("files", "sqlite"):
+        report("storage.backend must be either \"files\" or \"sqlite\". Halting.")
+        logger.error("Config check failed: unknown storage.backend %s", config["storage"]["backend"])
+        return False
+
+    config["seeding"] = {**DEFAULT_SEEDING_CONFIG, **config.get("seeding", {})}
+
+    if not isinstance(config["seeding"]["num_threads"], int) or config["seeding"]["num_threads"] < 1:
+        report("seeding.num_threads must be a positive integer. Halting.")
+        logger.error("Config check failed: seeding.num_threads is not a positive integer")
+        return False
+
+    if not isinstance(config["seeding"]["reserve"], (int, float)) or config["seeding"]["reserve"] < 0:
+        report("seeding.reserve must be a non-negative number. Halting.")
+        logger.error("Config check failed: seeding.reserve is not a non-negative number")
+        return False
+
+    # same as backfill.reserve below
+    if config["seeding"]["reserve"] + 1 > config["rate_limit"].get("burst", DEFAULT_RATE_LIMIT_CONFIG["burst"]):
+        report("seeding.reserve can be at most rate_limit.burst - 1, or new artists never get seeded. Halting.")
+        logger.error("Config check failed: seeding.reserve is too big for rate_limit.burst")
+        return False
+
+    config["backfill"] = {**DEFAULT_BACKFILL_CONFIG, **config.get("backfill", {})}
+
+    if not isinstance(config["backfill"]["num_threads"], int) or config["backfill"]["num_threads"] < 1:
+        report("backfill.num_threads must be a positive integer. Halting.")
+        logger.error("Config check failed: backfill.num_threads is not a positive integer")
+        return False
+
+    if not isinstance(config["backfill"]["reserve"], (int, float)) or config["backfill"]["reserve"] < 0:
+        report("backfill.reserve must be a non-negative number. Halting.")
+        logger.error("Config check failed: backfill.reserve is not a non-negative number")
+        return False
+
+    # an account never has more than burst requests of budget, and using it needs reserve + 1
+    burst = config["rate_limit"].get("burst", DEFAULT_RATE_LIMIT_CONFIG["burst"])
+    if config["backfill"]["reserve"] + 1 > burst:
+        report(f"backfill.reserve can be at most rate_limit.burst - 1 ({burst - 1}), or backfilling never gets to make a request. Halting.")
+        logger.error("Config check failed: backfill.reserve is too big for rate_limit.burst")
+        return False
+
+    config["metrics"] = {**metrics.DEFAULT_METRICS_CONFIG, **config.get("metrics", {})}
+
+    if not isinstance(config["metrics"]["port"], int) or not isinstance(config["metrics"]["summary_interval"], (int, float)) or config["metrics"]["summary_interval"] < 0:
+        report("metrics.port must be an integer and metrics.summary_interval a non-negative number. Halting.")
+        logger.error("Config check failed: bad metrics.port/summary_interval")
+        return False
+
+    config["reload"] = {**DEFAULT_RELOAD_CONFIG, **config.get("reload", {})}
+
+    if not isinstance(config["reload"]["debounce"], (int, float)) or config["reload"]["debounce"] < 0:
+        report("reload.debounce must be a non-negative number. Halting.")
+        logger.error("Config check failed: reload.debounce is not a non-negative number")
+        return False
+
+    config["sharding"] = {**DEFAULT_SHARDING_CONFIG, **config.get("sharding", {})}
+
+    if config["sharding"]["enabled"]:
+        json_sharding = config["sharding"]
+        if not isinstance(json_sharding["shards"], int) or json_sharding["shards"] < 1:
+            report("sharding.shards must be a positive integer. Halting.")
+            logger.error("Config check failed: sharding.shards is not a positive integer")
+            return False
+        if json_sharding["split"] not in ("hash", "monitors"):
+            report("sharding.split must be either \"hash\" or \"monitors\". Halting.")
+            logger.error("Config check failed: unknown sharding.split %s", json_sharding["split"])
+            return False
+        if json_sharding["split"] == "hash" and not config.get("artist_ids"):
+            report("sharding.split \"hash\" splits up artist_ids, but there are none. Use \"monitors\" to split up monitors instead. Halting.")
+            logger.error("Config check failed: sharding.split is hash but artist_ids is empty")
+            return False
+        if json_sharding["split"] == "hash" and config.get("monitors"):
+            report("sharding.split \"hash\" only splits up artist_ids, so the monitors would be ignored. Use \"monitors\" to split up monitors instead. Halting.")
+            logger.error("Config check failed: sharding.split is hash but there are monitors")
+            return False
+        if json_sharding["split"] == "monitors" and "monitors" not in config:
+            report("sharding.split \"monitors\" needs monitors. Halting.")
+            logger.error("Config check failed: sharding.split is monitors but there are no monitors")
+            return False
 
     return True
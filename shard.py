@@ -0,0 +1,257 @@
+import bisect
+import copy
+import hashlib
+import logging
+import multiprocessing.managers
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from monitor import handle_new_illust
+
+# Sharded mode: the artists are split across several worker processes (on this machine or on others),
+# each with accounts of its own. The process started normally becomes the owner: it doesn't poll
+# anything itself, but it's the only one that touches the seen set, the illustration log, hooks and
+# notifications. Workers report the new illustrations they find to it and it decides whether they
+# really are new, so two workers can never write the same file.
+#
+# Owner and workers talk through a multiprocessing manager over TCP, authenticated with a shared key,
+# so the same thing works for local processes and for workers on other hosts.
+# Each worker keeps its own schedule, watermarks and token cache (the file names get .shardN added),
+# logs to a shardN directory inside the log directory and serves its metrics on port + 1 + N.
+
+AUTHKEY_ENV = "SHARD_AUTHKEY"
+
+class ShardManager(multiprocessing.managers.BaseManager):
+    pass
+
+def stable_hash(key):
+    # the same on every host and every run, unlike hash()
+    return int.from_bytes(hashlib.md5(str(key).encode("utf-8")).digest()[:8], "big")
+
+# Consistent hashing: every shard gets virtual_nodes points on a ring and an artist belongs to the first
+# shard point after its own hash. Changing the number of shards only moves around 1/N of the artists,
+# so most workers keep their schedule and watermarks.
+class HashRing:
+    def __init__(self, num_shards, virtual_nodes=64):
+        self.points = sorted((stable_hash(f"shard-{shard}-{node}"), shard) for shard in range(num_shards) for node in range(virtual_nodes))
+        self.hashes = [point for point, _ in self.points]
+
+    def shard_for(self, key):
+        i = bisect.bisect(self.hashes, stable_hash(key)) % len(self.points)
+        return self.points[i][1]
+
+def shard_file(path, shard):
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext}"
+
+def shard_accounts(config):
+    # the accounts a shard's monitors use, None if one of them uses all of them
+    accounts = set()
+    for json_monitor in config["monitors"]:
+        if not json_monitor.get("accounts"):
+            return None
+        accounts.update(json_monitor["accounts"])
+        if "follow_account" in json_monitor:
+            accounts.add(json_monitor["follow_account"])
+    return sorted(accounts)
+
+def split_config(config, json_sharding):
+    # one config per shard, with only that shard's monitors
+    num_shards = json_sharding["shards"]
+    if json_sharding["split"] == "monitors" and len(config["monitors"]) < num_shards:
+        logging.getLogger().warning("Only %d monitors for %d shards; starting %d workers", len(config["monitors"]), num_shards, len(config["monitors"]))
+        num_shards = len(config["monitors"])
+    shard_configs = []
+    for shard in range(num_shards):
+        shard_config = copy.deepcopy(config)
+        shard_config.pop("sharding", None)
+        shard_config["schedule"]["state_path"] = shard_file(config["schedule"].get("state_path", "./schedule.json"), shard)
+        shard_config["watermarks"]["path"] = shard_file(config["watermarks"].get("path", "./watermarks.json"), shard)
+        shard_config["token_refresh"]["path"] = shard_file(config["token_refresh"].get("path", "./tokens.json"), shard)
+        shard_config["storage"] = {**config["storage"], "path": shard_file(config["storage"]["path"], shard)}
+        shard_config["log"] = {**config["log"], "directory": os.path.join(config["log"]["directory"], f"shard{shard}")}
+        # the owner serves metrics on the configured port, workers on the ones after it
+        shard_config["metrics"] = {**config["metrics"], "port": config["metrics"]["port"] + 1 + shard}
+        shard_config["monitors"] = []
+        shard_configs.append(shard_config)
+
+    if json_sharding["split"] == "monitors":
+        for i, json_monitor in enumerate(config["monitors"]):
+            shard_configs[i % num_shards]["monitors"].append(copy.deepcopy(json_monitor))
+        deal_monitor_accounts(shard_configs, config["num_accounts"])
+        return shard_configs
+
+    ring = HashRing(num_shards, json_sharding.get("virtual_nodes", 64))
+    artist_ids = [[] for _ in range(num_shards)]
+    for artist_id in config["artist_ids"]:
+        artist_ids[ring.shard_for(artist_id)].append(artist_id)
+
+    # accounts are dealt out too, so no account is used by two workers at once (as long as there are enough)
+    num_accounts = config["num_accounts"]
+    if num_accounts < num_shards:
+        logging.getLogger().warning("Only %d accounts for %d shards; some accounts are shared between workers, which don't know about each other's rate limits", num_accounts, num_shards)
+    for shard in range(num_shards):
+        accounts = [account for account in range(num_accounts) if account % num_shards == shard] or [shard % num_accounts]
+        num_threads = config.get("num_threads", 3)
+        shard_configs[shard]["monitors"].append({
+            "artist_ids": artist_ids[shard],
+            "accounts": accounts,
+            "check_interval": config["check_interval"],
+            "num_threads": num_threads,
+            "max_concurrency": num_threads
+        })
+    return shard_configs
+
+def deal_monitor_accounts(shard_configs, num_accounts):
+    # monitors without "accounts" would use every account, in every worker. they get the accounts no
+    # monitor asked for instead, dealt out to the shards like with the hash split
+    claimed = set()
+    for shard_config in shard_configs:
+        for json_monitor in shard_config["monitors"]:
+            claimed.update(json_monitor.get("accounts") or [])
+    free = [account for account in range(num_accounts) if account not in claimed]
+    needy = [(shard, [json_monitor for json_monitor in shard_config["monitors"] if not json_monitor.get("accounts")]) for shard, shard_config in enumerate(shard_configs)]
+    needy = [(shard, monitors) for shard, monitors in needy if monitors]
+    if free and len(free) < len(needy):
+        logging.getLogger().warning("Only %d accounts left over for %d shards with monitors without accounts; some of them are shared between workers", len(free), len(needy))
+    for n, (shard, monitors) in enumerate(needy):
+        if free:
+            accounts = [account for i, account in enumerate(free) if i % len(needy) == n] or [free[n % len(free)]]
+        else:
+            accounts = list(range(num_accounts))
+            logging.getLogger().warning("Every account is taken by a monitor; the monitors without accounts in shard %d share all of them with other workers", shard)
+        for json_monitor in monitors:
+            if json_monitor.get("type", "artists") == "follow" and "follow_account" not in json_monitor:
+                json_monitor["follow_account"] = 0 # what it would have used without accounts
+            json_monitor["accounts"] = accounts
+
+class ShardOwner:
+    def __init__(self, shard_configs, seen, hooks, dispatcher):
+        self.shard_configs = shard_configs
+        self.seen = seen
+        self.hooks = hooks
+        self.dispatcher = dispatcher
+        self.lock = threading.Lock()
+        self.num_reported = 0
+        self.num_duplicates = 0
+
+    def assignment(self, shard):
+        return self.shard_configs[shard]
+
+    def is_seen(self, iden):
+        return self.seen.query_illust(iden)
+
+    def report(self, illust_json):
+        # the check and the add have to happen together, two workers might report the same illustration
+        with self.lock:
+            self.num_reported += 1
+            if self.seen.query_illust(illust_json["id"]):
+                self.num_duplicates += 1
+                return False
+            handle_new_illust(illust_json, self.seen, self.hooks, self.dispatcher)
+        self.seen.flush()
+        return True
+
+    def seed(self, idens):
+        # a worker's seeder marking a new artist's existing illustrations as seen
+        self.seen.add_illusts(idens)
+        self.seen.flush()
+
+    def log_stats(self):
+        logging.getLogger().info("Shard owner: %d illustrations reported by workers, %d already seen", self.num_reported, self.num_duplicates)
+
+# What a worker's monitors use instead of SeenIllustrations. IDs the owner has said it knows about are
+# remembered, so each one is only asked about once.
+class ShardSeen:
+    def __init__(self, owner):
+        self.owner = owner
+        self.known = set()
+
+    def query_illust(self, iden):
+        if iden in self.known:
+            return True
+        if self.owner.is_seen(iden):
+            self.known.add(iden)
+            return True
+        return False
+
+    def add_illust(self, iden):
+        self.known.add(iden)
+
+    def add_illusts(self, idens):
+        idens = list(idens)
+        self.owner.seed(idens)
+        self.known.update(idens)
+
+    def flush(self, force=False):
+        pass
+
+    def wait_loaded(self):
+        pass
+
+def get_authkey(required):
+    authkey = os.getenv(AUTHKEY_ENV)
+    if authkey is None:
+        if required:
+            raise RuntimeError(f"Set {AUTHKEY_ENV} in .env (the same on every host) to use sharding across hosts")
+        authkey = secrets.token_hex(16)
+        os.environ[AUTHKEY_ENV] = authkey # local workers inherit it
+    return authkey.encode("utf-8")
+
+def is_loopback(host):
+    return host in ("127.0.0.1", "localhost", "::1")
+
+def serve(owner, host, port):
+    authkey = get_authkey(not is_loopback(host))
+    ShardManager.register("owner", callable=lambda: owner)
+    manager = ShardManager(address=(host, port), authkey=authkey)
+    server = manager.get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.getLogger().info("Shard owner listening on %s:%d", host, port)
+    return server
+
+def connect(address, retry_for=60):
+    host, port = address.rsplit(":", 1)
+    ShardManager.register("owner")
+    manager = ShardManager(address=(host, int(port)), authkey=get_authkey(True))
+    deadline = time.monotonic() + retry_for
+    while True:
+        try:
+            manager.connect()
+            return manager.owner()
+        except ConnectionRefusedError:
+            # the owner might still be starting up
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1)
+
+# Starts the workers of this machine as child processes and restarts them if they die.
+class WorkerSupervisor:
+    def __init__(self, address, shards):
+        self.address = address
+        self.shards = shards
+        self.processes = {}
+
+    def start(self, shard):
+        logging.getLogger().info("Starting worker for shard %d", shard)
+        self.processes[shard] = subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0]), "--worker", self.address, "--shard", str(shard)])
+
+    def run(self):
+        for shard in self.shards:
+            self.start(shard)
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def loop(self):
+        while True:
+            time.sleep(5)
+            for shard, process in list(self.processes.items()):
+                if process.poll() is not None:
+                    logging.getLogger().warning("Worker for shard %d exited with code %d; restarting it", shard, process.returncode)
+                    self.start(shard)
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
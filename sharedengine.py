@@ -0,0 +1,152 @@
+import collections
+import logging
+import threading
+import time
+import metrics
+
+# Third engine, next to every monitor having threads of its own ("threads") and the event loop
+# ("async"): one pool of num_threads worker threads for all monitors. Every monitor still has its own
+# cycles, check_interval, schedule and accounts, but instead of its own queue and threads its due
+# artists go into a queue the whole pool takes work from. A small monitor that's done with its cycle
+# doesn't keep threads waiting around, they go help whichever monitor still has work.
+#
+# A free worker takes the next artist from the monitor that has had the least of the pool so far
+# relative to its weight (stride scheduling), skipping monitors whose accounts have no request budget
+# left right now, since their artists would only sit in TokenSwitcher.acquire. A monitor starting a
+# cycle gets no credit for the time it was asleep, so it can't lock everyone else out afterwards.
+# Starting and ending cycles (the follow timeline, flushing) is done by the workers too.
+#
+# How much of the pool each monitor got is in the metrics (pixiv_monitor_worker_seconds_total, and the
+# summary in the log). num_threads and max_concurrency of the monitors aren't used.
+
+class MonitorState:
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.ready = collections.deque() # artists of the current cycle nobody has taken yet
+        self.in_flight = 0
+        self.running = False # in a cycle
+        self.busy = False # a worker is starting or ending its cycle
+        self.next_cycle = 0 # monotonic time
+        self.cycle_start = None
+        self.pass_value = 0 # pool time used / weight, in artists
+
+class SharedEngine:
+    def __init__(self, monitors, num_threads=30):
+        self.states = [MonitorState(monitor) for monitor in monitors]
+        self.num_threads = num_threads
+        self.cond = threading.Condition()
+
+        logging.getLogger().debug("Created shared engine with %d monitors, %d threads", len(monitors), num_threads)
+
+    @staticmethod
+    def from_json(json_shared, monitors):
+        return SharedEngine(monitors, json_shared.get("num_threads", 30))
+
+    def run(self):
+        for _ in range(self.num_threads):
+            threading.Thread(target=self.worker, name="shared-worker", daemon=True).start()
+
+    def add_monitor(self, monitor):
+        # called from other threads (see configwatch.py)
+        with self.cond:
+            self.states.append(MonitorState(monitor))
+            self.cond.notify()
+
+    def worker(self):
+        while True:
+            state, artist_id = self.next_task()
+            try:
+                if artist_id is None:
+                    self.start_cycle(state)
+                else:
+                    self.check_artist(state, artist_id)
+            except Exception as e:
+                # crash_on_exception, a failed flush or a bug; the state has been put right already,
+                # and one monitor's problem shouldn't cost everyone a thread
+                logging.getLogger().exception("Error in shared worker (monitor %s): %s", state.monitor.name, e)
+
+    def next_task(self):
+        # (state, None) to start that monitor's cycle, (state, artist ID) to check an artist
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                wait = 1
+                best = None
+                for state in list(self.states):
+                    monitor = state.monitor
+                    if not state.running and not state.busy:
+                        if monitor.stopped:
+                            self.states.remove(state)
+                            metrics.CYCLE_ARTISTS.set(0, monitor=monitor.name)
+                            continue
+                        if now >= state.next_cycle or monitor.wake.is_set():
+                            # cycles get started first; that only queues up work
+                            monitor.wake.clear()
+                            state.busy = True
+                            return state, None
+                        wait = min(wait, state.next_cycle - now)
+                    elif state.ready:
+                        if any(token.budget(now) >= 1 for token in monitor.token_switcher.tokens):
+                            if best is None or state.pass_value < best.pass_value:
+                                best = state
+                        else:
+                            wait = min([wait] + [token.wait_time(now) for token in monitor.token_switcher.tokens])
+                if best is not None:
+                    best.in_flight += 1
+                    best.pass_value += 1 / best.monitor.weight
+                    return best, best.ready.popleft()
+                self.cond.wait(max(0.05, wait))
+
+    def start_cycle(self, state):
+        monitor = state.monitor
+        state.cycle_start = time.monotonic()
+        try:
+            monitor.start_cycle()
+            artist_ids = monitor.cycle_artists()
+        except Exception as e:
+            # an empty cycle, so it still ends and the next one gets started
+            logging.getLogger().exception("Error while starting a cycle of monitor %s: %s", monitor.name, e)
+            artist_ids = []
+        metrics.CYCLE_ARTISTS.set(len(artist_ids), monitor=monitor.name)
+        metrics.QUEUE_DEPTH.set(len(artist_ids), monitor=monitor.name)
+        with self.cond:
+            others = [other.pass_value for other in self.states if other is not state and (other.ready or other.in_flight)]
+            if others:
+                state.pass_value = max(state.pass_value, min(others))
+            state.ready.extend(artist_ids)
+            state.running = True
+            state.busy = False
+            self.cond.notify_all()
+        if not artist_ids:
+            self.end_cycle(state)
+
+    def check_artist(self, state, artist_id):
+        monitor = state.monitor
+        start = time.monotonic()
+        metrics.WORKERS_BUSY.inc(monitor=monitor.name)
+        try:
+            monitor.check_artist(artist_id)
+        finally:
+            metrics.WORKERS_BUSY.dec(monitor=monitor.name)
+            metrics.WORKER_SECONDS.inc(time.monotonic() - start, monitor=monitor.name)
+            metrics.QUEUE_DEPTH.dec(monitor=monitor.name)
+            with self.cond:
+                state.in_flight -= 1
+                last = not state.ready and state.in_flight == 0
+                if last:
+                    state.busy = True
+            if last:
+                self.end_cycle(state)
+
+    def end_cycle(self, state):
+        monitor = state.monitor
+        try:
+            monitor.end_cycle()
+        finally:
+            metrics.QUEUE_DEPTH.set(0, monitor=monitor.name)
+            metrics.CYCLE_SECONDS.observe(time.monotonic() - state.cycle_start, monitor=monitor.name)
+            with self.cond:
+                state.next_cycle = time.monotonic() + monitor.cycle_sleep_time()
+                state.running = False
+                state.busy = False
+                self.cond.notify_all()
@@ -0,0 +1,285 @@
+import sqlite3
+import threading
+import time
+import jsoncodec
+import metrics
+from scheduler import ScheduleState
+from watermark import WatermarkCache
+
+DB_PATH = "./pixiv-monitor.db"
+
+# Optional storage backend: everything in one SQLite database (WAL mode, so rssmain.py can read while
+# main.py writes) instead of seen.bin/seen.journal, illustlog.jsonl, schedule.json and watermarks.json.
+#
+# - seen: seen illustration IDs
+# - illusts: the illustration log, the same records as illustlog.jsonl, indexed by ID, artist and date
+# - illust_tags: tag name -> illustration, for looking illustrations up by tag
+# - poll_state: per artist schedule and watermark (negative IDs are follow timelines, see FollowMonitor)
+#
+# New seen IDs and illustrations are queued in memory and written together in one transaction, when
+# enough of them have piled up or at the end of a cycle, like the seen journal. The schedule and
+# watermarks are kept in memory as before and written at the end of every cycle.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen (
+    id INTEGER PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS illusts (
+    seq INTEGER PRIMARY KEY,
+    id INTEGER NOT NULL UNIQUE,
+    artist_id INTEGER,
+    create_date TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS illusts_create_date ON illusts (create_date);
+CREATE INDEX IF NOT EXISTS illusts_artist ON illusts (artist_id, create_date);
+CREATE TABLE IF NOT EXISTS illust_tags (
+    tag TEXT NOT NULL,
+    illust_id INTEGER NOT NULL,
+    PRIMARY KEY (tag, illust_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS poll_state (
+    artist_id INTEGER PRIMARY KEY,
+    next_due REAL,
+    interval REAL,
+    last_post REAL,
+    median_gap REAL,
+    watermark INTEGER
+);
+"""
+
+SCHEDULE_FIELDS = ("next_due", "interval", "last_post", "median_gap")
+
+def connect(path, read_only=False):
+    if read_only:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # with WAL, only the last transactions can get lost on power loss
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+def tag_names(tags):
+    # tags are stored as "name / translated name, name, ..."
+    return {name.strip().lower() for part in tags.split(", ") for name in part.split(" / ") if name.strip()}
+
+class Database:
+    def __init__(self, path=DB_PATH, flush_every=50, flush_interval=30):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.conn = connect(path)
+        self.conn.executescript(SCHEMA)
+        self.pending_seen = {}
+        self.pending_illusts = []
+        self.last_flush = time.monotonic()
+        self.num_seen = self.conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+        metrics.SEEN_SIZE.set(self.num_seen)
+
+    @staticmethod
+    def from_json(json_storage, json_seen):
+        return Database(json_storage.get("path", DB_PATH), json_seen.get("flush_every", 50), json_seen.get("flush_interval", 30))
+
+    def flush(self, force=False):
+        if not self.pending_seen and not self.pending_illusts:
+            return
+        with self.lock:
+            num_pending = len(self.pending_seen) + len(self.pending_illusts)
+            if num_pending == 0:
+                return
+            if not force and num_pending < self.flush_every and time.monotonic() - self.last_flush < self.flush_interval:
+                return
+            start = time.monotonic()
+            with self.conn:
+                self.num_seen += self.conn.executemany("INSERT OR IGNORE INTO seen (id) VALUES (?)", ((iden,) for iden in self.pending_seen)).rowcount
+                for entry in self.pending_illusts:
+                    cursor = self.conn.execute(
+                        "INSERT OR IGNORE INTO illusts (id, artist_id, create_date, record) VALUES (?, ?, ?, ?)",
+                        (entry["id"], entry.get("user", {}).get("id"), entry["create_date"], jsoncodec.dumps(entry))
+                    )
+                    if cursor.rowcount:
+                        self.conn.executemany("INSERT OR IGNORE INTO illust_tags (tag, illust_id) VALUES (?, ?)", ((tag, entry["id"]) for tag in tag_names(entry.get("tags", ""))))
+            self.pending_seen = {}
+            self.pending_illusts = []
+            self.last_flush = time.monotonic()
+            metrics.SEEN_FLUSH_SECONDS.observe(self.last_flush - start)
+            metrics.SEEN_SIZE.set(self.num_seen)
+
+    def add_seen(self, idens):
+        with self.lock:
+            for iden in idens:
+                self.pending_seen[iden] = True
+
+    def add_illusts(self, entries):
+        with self.lock:
+            self.pending_illusts.extend(entries)
+
+    def is_seen(self, iden):
+        with self.lock:
+            if iden in self.pending_seen:
+                return True
+            return self.conn.execute("SELECT 1 FROM seen WHERE id = ?", (iden,)).fetchone() is not None
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def write(self, sql, rows):
+        with self.lock, self.conn:
+            self.conn.executemany(sql, rows)
+
+# Same interface as SeenIllustrations.
+class SqliteSeen:
+    def __init__(self, db):
+        self.db = db
+
+    def load_in_background(self):
+        pass
+
+    def wait_loaded(self):
+        pass
+
+    def add_illust(self, iden):
+        self.db.add_seen([iden])
+
+    def add_illusts(self, idens):
+        self.db.add_seen(idens)
+
+    def query_illust(self, iden):
+        return self.db.is_seen(iden)
+
+    def flush(self, force=False):
+        self.db.flush(force)
+
+    def __len__(self):
+        return self.db.query("SELECT COUNT(*) FROM seen")[0][0]
+
+# Same interface as IllustLog. Readers (rssmain.py) open the database read-only with a path instead.
+class SqliteIllustLog:
+    def __init__(self, db=None, path=DB_PATH):
+        self.db = db
+        self.path = db.path if db is not None else path
+        self.read_conn = None
+
+    def connection(self):
+        if self.db is not None:
+            return self.db.conn, self.db.lock
+        if self.read_conn is None:
+            self.read_conn = connect(self.path, read_only=True)
+            self.read_lock = threading.Lock()
+        return self.read_conn, self.read_lock
+
+    def query(self, sql, params=()):
+        conn, lock = self.connection()
+        with lock:
+            return conn.execute(sql, params).fetchall()
+
+    def append(self, entry):
+        self.db.add_illusts([entry])
+
+    def append_many(self, entries):
+        self.db.add_illusts(entries)
+
+    def __len__(self):
+        return self.query("SELECT COUNT(*) FROM illusts")[0][0]
+
+    def iter_illusts(self, newest_first=True, start=0, limit=None):
+        order = "DESC" if newest_first else "ASC"
+        # a connection of its own so a long iteration doesn't hold up writes
+        conn = connect(self.path, read_only=True)
+        try:
+            for (record,) in conn.execute(f"SELECT record FROM illusts ORDER BY create_date {order} LIMIT ? OFFSET ?", (-1 if limit is None else limit, start)):
+                yield jsoncodec.loads(record)
+        finally:
+            conn.close()
+
+    def iter_artist(self, artist_id, limit=None):
+        for (record,) in self.query("SELECT record FROM illusts WHERE artist_id = ? ORDER BY create_date DESC LIMIT ?", (artist_id, -1 if limit is None else limit)):
+            yield jsoncodec.loads(record)
+
+    def iter_tag(self, tag, limit=None):
+        for (record,) in self.query("SELECT illusts.record FROM illust_tags JOIN illusts ON illusts.id = illust_tags.illust_id WHERE illust_tags.tag = ? ORDER BY illusts.create_date DESC LIMIT ?", (tag.lower(), -1 if limit is None else limit)):
+            yield jsoncodec.loads(record)
+
+    def cursor(self):
+        return self.query("SELECT COALESCE(MAX(seq), 0) FROM illusts")[0][0]
+
+    def entries_since(self, cursor):
+        # the log never gets compacted, so unlike IllustLog this never has to return None
+        rows = self.query("SELECT seq, record FROM illusts WHERE seq > ? ORDER BY seq", (cursor,))
+        if not rows:
+            return [], cursor
+        return [jsoncodec.loads(record) for _, record in rows], rows[-1][0]
+
+    def get_page(self, page, page_size=100, newest_first=True):
+        return list(self.iter_illusts(newest_first, page * page_size, page_size))
+
+class SqliteScheduleState(ScheduleState):
+    def __init__(self, db):
+        self.db = db
+        self.path = db.path
+        self.lock = threading.Lock()
+        self.artists = {}
+        self.dirty = False
+        self.dirty_ids = set()
+        for row in db.query(f"SELECT artist_id, {', '.join(SCHEDULE_FIELDS)} FROM poll_state WHERE next_due IS NOT NULL"):
+            self.artists[row[0]] = dict(zip(SCHEDULE_FIELDS, row[1:]))
+
+    def is_empty(self):
+        return not self.artists
+
+    def seed_from_log(self, illusts):
+        super().seed_from_log(illusts)
+        with self.lock:
+            self.dirty_ids.update(self.artists)
+
+    def update(self, artist_id, entry):
+        with self.lock:
+            self.artists[artist_id] = entry
+            self.dirty = True
+            self.dirty_ids.add(artist_id)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty_ids:
+                return
+            rows = [(artist_id, *(self.artists[artist_id].get(field) for field in SCHEDULE_FIELDS)) for artist_id in self.dirty_ids]
+            self.dirty_ids = set()
+            self.dirty = False
+        self.db.write(
+            f"INSERT INTO poll_state (artist_id, {', '.join(SCHEDULE_FIELDS)}) VALUES (?, ?, ?, ?, ?) "
+            f"ON CONFLICT (artist_id) DO UPDATE SET {', '.join(f'{field} = excluded.{field}' for field in SCHEDULE_FIELDS)}",
+            rows
+        )
+
+class SqliteWatermarks(WatermarkCache):
+    def __init__(self, db):
+        self.db = db
+        self.path = db.path
+        self.lock = threading.Lock()
+        self.watermarks = dict(db.query("SELECT artist_id, watermark FROM poll_state WHERE watermark IS NOT NULL"))
+        self.dirty = False
+        self.dirty_ids = set()
+
+    def update(self, artist_id, illust_id):
+        with self.lock:
+            if artist_id not in self.watermarks or illust_id > self.watermarks[artist_id]:
+                self.watermarks[artist_id] = illust_id
+                self.dirty = True
+                self.dirty_ids.add(artist_id)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty_ids:
+                return
+            rows = [(artist_id, self.watermarks[artist_id]) for artist_id in self.dirty_ids]
+            self.dirty_ids = set()
+            self.dirty = False
+        self.db.write("INSERT INTO poll_state (artist_id, watermark) VALUES (?, ?) ON CONFLICT (artist_id) DO UPDATE SET watermark = excluded.watermark", rows)
+
+def rebuild_seen(db):
+    # what fix_seen.py does for the files: every logged illustration counts as seen
+    with db.lock, db.conn:
+        return db.conn.execute("INSERT OR IGNORE INTO seen (id) SELECT id FROM illusts").rowcount
@@ -0,0 +1,53 @@
+import threading
+import time
+import unittest
+from asyncengine import AsyncEngine
+from tokenswitcher import ApiToken, TokenSwitcher
+
+# run from the repository root: python -m unittest discover tests
+
+class FlakyMonitor:
+    # just enough of a Monitor for the engine; end_cycle fails from the second cycle on
+    def __init__(self, name, fail):
+        self.name = name
+        self.fail = fail
+        self.config = {}
+        self.max_concurrency = 2
+        self.stopped = False
+        self.wake = threading.Event()
+        self.token_switcher = TokenSwitcher(1, False)
+        self.token_switcher.tokens = [ApiToken("access", "refresh", 0, 1000, 1000)]
+        self.cycles = 0
+
+    def start_cycle(self):
+        pass
+
+    def cycle_artists(self):
+        return [1, 2, 3]
+
+    def check_artist(self, artist_id):
+        pass
+
+    def end_cycle(self):
+        self.cycles += 1
+        if self.fail and self.cycles >= 2:
+            raise OSError("disk full")
+
+    def cycle_sleep_time(self):
+        return 0.05
+
+class AsyncEngineTest(unittest.TestCase):
+    def test_failing_monitor_keeps_others_going(self):
+        failing = FlakyMonitor("failing", True)
+        healthy = FlakyMonitor("healthy", False)
+        AsyncEngine([failing, healthy], 2).run()
+        deadline = time.monotonic() + 5
+        while (failing.cycles < 4 or healthy.cycles < 4) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertGreaterEqual(failing.cycles, 4)
+        self.assertGreaterEqual(healthy.cycles, 4)
+        failing.stopped = True
+        healthy.stopped = True
+
+if __name__ == "__main__":
+    unittest.main()
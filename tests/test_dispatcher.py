@@ -0,0 +1,67 @@
+import http.server
+import json
+import threading
+import time
+import unittest
+from dispatcher import NotificationDispatcher
+from pixivmodel import PixivIllustration
+
+# run from the repository root: python -m unittest discover tests
+
+class NtfyHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append(json.loads(body))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def make_illust(iden, artist_id):
+    return PixivIllustration({
+        "id": iden,
+        "title": f"illust {iden}",
+        "user": {"id": artist_id, "name": f"artist {artist_id}", "account": f"artist{artist_id}"},
+        "tags": []
+    })
+
+class DispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), NtfyHandler)
+        self.server.received = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.dispatcher = NotificationDispatcher(False, "test", f"http://127.0.0.1:{self.server.server_port}", window=0, max_individual=2)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def messages(self):
+        return [notification["message"] for notification in self.server.received]
+
+    def test_coalesces_per_artist(self):
+        batch = [(0, make_illust(1, 10)), (0, make_illust(2, 10)), (0, make_illust(3, 20))]
+        self.dispatcher.deliver(batch)
+        self.assertEqual(sorted(self.messages()), ["'illust 3' by artist 20 (@artist20)", "2 new illustrations from artist 10 (@artist10)"])
+        self.assertTrue(all(notification["topic"] == "test" for notification in self.server.received))
+        self.assertEqual(self.dispatcher.stats()["delivered"], 3)
+
+    def test_max_individual(self):
+        batch = [(0, make_illust(i, i)) for i in range(1, 4)]
+        self.dispatcher.deliver(batch)
+        self.assertEqual(self.messages(), ["3 new illustrations from 3 artists"])
+
+    def test_window_groups_submitted(self):
+        self.dispatcher.window = 0.5
+        self.dispatcher.run()
+        for i in range(1, 4):
+            self.dispatcher.submit(make_illust(i, 10))
+        deadline = time.monotonic() + 5
+        while not self.server.received and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.messages(), ["3 new illustrations from artist 10 (@artist10)"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import contextlib
+import io
+import unittest
+import settings
+
+# run from the repository root: python -m unittest discover tests
+
+class CheckConfigTest(unittest.TestCase):
+    def check(self, config, quiet):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), self.assertLogs(level="ERROR") as logs:
+            result = settings.check_config(config, quiet=quiet)
+        return result, output.getvalue(), logs.output
+
+    def test_bad_config_prints(self):
+        result, output, logs = self.check({"artist_ids": [0]}, quiet=False)
+        self.assertFalse(result)
+        self.assertIn("Halting.", output)
+        self.assertTrue(any("Config check failed" in line for line in logs))
+
+    def test_bad_config_quiet(self):
+        result, output, logs = self.check({"artist_ids": [0]}, quiet=True)
+        self.assertFalse(result)
+        self.assertEqual(output, "")
+        self.assertTrue(any("Config check failed" in line for line in logs))
+
+    def test_good_config(self):
+        self.assertTrue(settings.check_config({"artist_ids": [1]}, quiet=True))
+
+if __name__ == "__main__":
+    unittest.main()
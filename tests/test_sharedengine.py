@@ -0,0 +1,61 @@
+import threading
+import time
+import unittest
+from sharedengine import SharedEngine
+from tokenswitcher import ApiToken, TokenSwitcher
+
+# run from the repository root: python -m unittest discover tests
+
+class FailingMonitor:
+    # just enough of a Monitor for the engine; checking every other artist fails
+    def __init__(self, name, artist_ids):
+        self.name = name
+        self.artist_ids = artist_ids
+        self.weight = 1
+        self.stopped = False
+        self.wake = threading.Event()
+        self.token_switcher = TokenSwitcher(1, False)
+        self.token_switcher.tokens = [ApiToken("access", "refresh", 0, 1000, 1000)]
+        self.lock = threading.Lock()
+        self.checked = []
+        self.cycles = 0
+
+    def start_cycle(self):
+        pass
+
+    def cycle_artists(self):
+        return list(self.artist_ids)
+
+    def check_artist(self, artist_id):
+        with self.lock:
+            self.checked.append(artist_id)
+        if artist_id % 2 == 0:
+            raise RuntimeError("broken artist")
+
+    def end_cycle(self):
+        with self.lock:
+            self.cycles += 1
+
+    def cycle_sleep_time(self):
+        return 0.05
+
+def worker_threads():
+    return [thread for thread in threading.enumerate() if thread.name == "shared-worker"]
+
+class SharedEngineTest(unittest.TestCase):
+    def test_failing_check_keeps_pool_and_cycle(self):
+        before = len(worker_threads())
+        monitor = FailingMonitor("failing", list(range(10)))
+        SharedEngine([monitor], 3).run()
+        deadline = time.monotonic() + 5
+        while monitor.cycles < 3 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # the cycles still end, so the next ones get started
+        self.assertGreaterEqual(monitor.cycles, 3)
+        self.assertGreaterEqual(len(monitor.checked), 30)
+        # and no worker died
+        self.assertEqual(len(worker_threads()) - before, 3)
+        monitor.stopped = True
+
+if __name__ == "__main__":
+    unittest.main()
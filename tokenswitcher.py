@@ -2,59 +2,291 @@ import requests
 import os
 import threading
 import time
+import contextlib
+import logging
+import jsoncodec
+import metrics
 
 USER_AGENT = "PixivAndroidApp/5.0.234 (Android 11; Pixel 5)"
 AUTH_TOKEN_URL = "https://oauth.secure.pixiv.net/auth/token"
 CLIENT_ID = "MOBrBDS8blbauoSck0ZfDbtuzpyT"
 CLIENT_SECRET = "lsACyCD94FhDUtGTXi3QzcFE2uU1hqtDaKeqrdwj"
 
+DEFAULT_RATE_LIMIT_CONFIG = {
+    "rate": 1.0, # requests per second per account
+    "burst": 5,
+    "backoff": 30, # seconds to leave an account alone after it gets rate limited; doubles every time
+    "max_backoff": 600
+}
+
+DEFAULT_TOKEN_REFRESH_CONFIG = {
+    "margin": 300, # refresh this many seconds before the access token expires
+    "persist": False, # save refreshed tokens so a restart can reuse them
+    "path": "./tokens.json"
+}
+
 class ApiToken:
-    def __init__(self, access, refresh):
+    # notified whenever a request is done, for acquire() waiting on accounts that are at max_in_flight
+    released = threading.Condition()
+    num_released = 0
+
+    def __init__(self, access, refresh, index=0, rate=1.0, burst=5, backoff=30, max_backoff=600):
         self.access_token = access
         self.refresh_token = refresh
+        self.env_refresh_token = refresh # the one from .env, before any rotation (see TokenCache)
+        self.index = index
+        self.user_id = None # pixiv user ID of the account, known after the first refresh
+        self.expires_at = None # unix time, None if we don't know
+        self.refresh_lock = threading.Lock()
+        self.generation = 0 # bumped on every refresh
+        self.cache = None
+
+        # token bucket + rate limit backoff
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.bucket = burst
+        self.last_refill = time.monotonic()
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.backoff = 0
+        self.backoff_until = 0
+        self.in_flight = 0
+        self.max_in_flight = None
+
+        # usage stats
+        self.num_requests = 0
+        self.num_rate_limits = 0
+        self.num_refreshes = 0
+
+    def refresh(self, generation=None):
+        # generation: the one the failed request was made with. if the token has been refreshed since,
+        # the request just used an old one and there's nothing to do
+        if generation is None:
+            generation = self.generation
+        with self.refresh_lock:
+            if self.generation != generation:
+                return # somebody else refreshed it in the meantime, no need to do it twice
+            response = requests.post(
+                AUTH_TOKEN_URL,
+                data={
+                    "client_id": CLIENT_ID,
+                    "client_secret": CLIENT_SECRET,
+                    "grant_type": "refresh_token",
+                    "include_policy": "true",
+                    "refresh_token": self.refresh_token,
+                },
+                headers={"User-Agent": USER_AGENT},
+                timeout=30
+            )
+
+            data = response.json()
+            self.refresh_token = data["refresh_token"] # pretty sure its constant
+            self.access_token = data["access_token"]
+            self.expires_at = time.time() + data.get("expires_in", 3600)
+            self.user_id = int(data["user"]["id"]) if "user" in data else self.user_id
+            self.num_refreshes += 1
+            self.generation += 1
+        metrics.TOKEN_REFRESHES.inc(account=self.index)
+        if self.cache is not None:
+            self.cache.store(self)
+
+    def expires_in(self):
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.time()
 
-    def refresh(self):
-        response = requests.post(
-            AUTH_TOKEN_URL,
-            data={
-                "client_id": CLIENT_ID,
-                "client_secret": CLIENT_SECRET,
-                "grant_type": "refresh_token",
-                "include_policy": "true",
-                "refresh_token": self.refresh_token,
-            },
-            headers={"User-Agent": USER_AGENT},
-            timeout=30
-        )
-        
-        data = response.json()
-        self.refresh_token = data["refresh_token"] # pretty sure its constant
-        self.access_token = data["access_token"]
+    def refill(self, now):
+        self.bucket = min(self.burst, self.bucket + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def budget(self, now):
+        # how many requests we could make right now
+        with self.lock:
+            if now < self.backoff_until:
+                return 0
+            if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+                return 0
+            self.refill(now)
+            return self.bucket
+
+    def wait_time(self, now, reserve=0):
+        with self.lock:
+            if now < self.backoff_until:
+                return self.backoff_until - now
+            if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+                return float("inf") # until a request is done; release() wakes acquire() up
+            self.refill(now)
+            return max(0, (1 + reserve - self.bucket) / self.rate)
+
+    def try_acquire(self, now, reserve=0):
+        # reserve: requests' worth of budget that has to be left over afterwards
+        with self.lock:
+            if now < self.backoff_until:
+                return False
+            if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+                return False
+            self.refill(now)
+            if self.bucket < 1 + reserve:
+                return False
+            self.bucket -= 1
+            self.in_flight += 1
+            self.num_requests += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        with ApiToken.released:
+            ApiToken.num_released += 1
+            ApiToken.released.notify_all()
 
+    def rate_limited(self):
+        with self.lock:
+            self.num_rate_limits += 1
+            self.backoff = min(self.max_backoff, self.backoff * 2 if self.backoff else self.base_backoff)
+            self.backoff_until = time.monotonic() + self.backoff
+            self.bucket = 0
+        metrics.RATE_LIMITS.inc(account=self.index)
+        logging.getLogger().debug("Account %d got rate limited; backing off for %d seconds", self.index, self.backoff)
+
+    def succeeded(self):
+        with self.lock:
+            self.backoff = 0
+
+    def usage(self):
+        now = time.monotonic()
+        return {
+            "account": self.index,
+            "requests": self.num_requests,
+            "rate_limits": self.num_rate_limits,
+            "refreshes": self.num_refreshes,
+            "in_flight": self.in_flight,
+            "budget": round(self.budget(now), 2),
+            "backoff_left": round(max(0, self.backoff_until - now))
+        }
+
+# Hands out accounts to requests. Every request leases the account with the most budget left (see
+# ApiToken above), so the load is spread across accounts and a rate-limited account is left alone
+# for a while instead of everyone switching accounts at once.
 class TokenSwitcher:
-    def __init__(self, num_accounts, load_tokens=True):
+    def __init__(self, num_accounts, load_tokens=True, rate_limit_config=DEFAULT_RATE_LIMIT_CONFIG):
         self.num_accounts = num_accounts
         self.tokens = []
+        # only use an account if it has this much budget to spare; lets background work (backfill.py)
+        # stay out of the way of the monitors sharing the accounts
+        self.reserve = 0
         if load_tokens:
             for i in range(self.num_accounts):
-                self.tokens.append(ApiToken(os.getenv(f"ACCESS_TOKEN{i}"), os.getenv(f"REFRESH_TOKEN{i}")))
-        self.current_token = 0
+                self.tokens.append(ApiToken(
+                    os.getenv(f"ACCESS_TOKEN{i}"),
+                    os.getenv(f"REFRESH_TOKEN{i}"),
+                    i,
+                    rate_limit_config.get("rate", DEFAULT_RATE_LIMIT_CONFIG["rate"]),
+                    rate_limit_config.get("burst", DEFAULT_RATE_LIMIT_CONFIG["burst"]),
+                    rate_limit_config.get("backoff", DEFAULT_RATE_LIMIT_CONFIG["backoff"]),
+                    rate_limit_config.get("max_backoff", DEFAULT_RATE_LIMIT_CONFIG["max_backoff"])
+                ))
+
+    def acquire(self):
+        while True:
+            num_released = ApiToken.num_released
+            now = time.monotonic()
+            best = max(self.tokens, key=lambda token: token.budget(now))
+            if best.try_acquire(now, self.reserve):
+                return best
+            wait = min(token.wait_time(now, self.reserve) for token in self.tokens)
+            with ApiToken.released:
+                # unless a request was done while we were looking
+                if ApiToken.num_released == num_released:
+                    ApiToken.released.wait(min(1, max(0.05, wait)))
+
+    @contextlib.contextmanager
+    def lease(self):
+        token = self.acquire()
+        try:
+            yield token
+        finally:
+            token.release()
+
+    def usage(self):
+        return [token.usage() for token in self.tokens]
+
+    def log_usage(self):
+        for usage in self.usage():
+            logging.getLogger().info("Account %(account)d: %(requests)d requests, %(rate_limits)d rate limits, %(refreshes)d refreshes, %(in_flight)d in flight, budget %(budget)s, backoff %(backoff_left)ds", usage)
+
+# Keeps refreshed tokens in a file (tokens.json by default) so they can be reused after a restart
+# instead of refreshing every account at once. It has access tokens in it, so keep it private.
+class TokenCache:
+    def __init__(self, path):
+        self.path = path
         self.lock = threading.Lock()
-        self.last_switch_time = 0
-        self.cooldown = 3
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as cache_json:
+                self.entries = jsoncodec.load(cache_json)
 
-    def get_access_token(self):
-        return self.tokens[self.current_token].access_token
+    def apply(self, token):
+        entry = self.entries.get(str(token.index))
+        # saved by account. the refresh token might have been rotated since .env was written, so it
+        # counts if it started out from the same one; if .env has a different one now, it's for a
+        # different account (or a new login) and whatever we saved is useless
+        env_refresh_token = token.refresh_token
+        if entry is not None and env_refresh_token in (entry["refresh_token"], entry.get("env_refresh_token")):
+            token.refresh_token = entry["refresh_token"]
+            token.access_token = entry["access_token"]
+            token.expires_at = entry["expires_at"]
+            token.user_id = entry.get("user_id")
+            env_refresh_token = entry.get("env_refresh_token", env_refresh_token)
+        token.env_refresh_token = env_refresh_token
+        token.cache = self
 
-    def switch_token(self):
+    def store(self, token):
         with self.lock:
-            now = time.monotonic()
-            if now - self.last_switch_time < self.cooldown:
-                return
-            self.current_token += 1
-            if self.current_token >= self.num_accounts:
-                self.current_token = 0
-            self.last_switch_time = now
-
-    def refresh_token(self):
-        self.tokens[self.current_token].refresh()
+            self.entries[str(token.index)] = {
+                "env_refresh_token": token.env_refresh_token,
+                "refresh_token": token.refresh_token,
+                "access_token": token.access_token,
+                "expires_at": token.expires_at,
+                "user_id": token.user_id
+            }
+            temp_path = self.path + ".tmp"
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as cache_json:
+                jsoncodec.dump(self.entries, cache_json)
+            os.replace(temp_path, self.path)
+
+# Refreshes access tokens in the background a little before they expire, so a worker never has to
+# stop and wait for a refresh. Tokens we don't know the expiry of (nothing saved in the token cache)
+# are left alone until a request with them fails (see utility.api_wrapper), otherwise every restart
+# would refresh every account at once.
+class TokenRefresher:
+    def __init__(self, tokens, margin=300):
+        self.tokens = tokens
+        self.margin = margin
+
+    @staticmethod
+    def from_json(json_refresh, tokens):
+        return TokenRefresher(tokens, json_refresh.get("margin", DEFAULT_TOKEN_REFRESH_CONFIG["margin"]))
+
+    def run(self):
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def loop(self):
+        while True:
+            next_check = 60
+            for token in self.tokens:
+                expires_in = token.expires_in()
+                if expires_in is None:
+                    continue
+                if expires_in <= self.margin:
+                    try:
+                        logging.getLogger().debug("Refreshing access token for account %d ahead of time", token.index)
+                        token.refresh()
+                        expires_in = token.expires_in()
+                    except Exception as e:
+                        logging.getLogger().error("Failed to refresh access token for account %d: %s", token.index, e)
+                        continue
+                next_check = min(next_check, expires_in - self.margin)
+            time.sleep(max(5, next_check))
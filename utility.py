@@ -1,31 +1,36 @@
 import logging
 import datetime
+import time
+import metrics
 
-def handle_oauth_error(api, token_switcher):
-    logging.getLogger().debug(f"Refreshing access token for account {token_switcher.current_token}")
-    token_switcher.refresh_token()
-    access_token = token_switcher.get_access_token()
-    api.set_auth(access_token)
-
-def api_wrapper(api, token_switcher, api_func, *args, **kwargs):
+def api_wrapper(clients, token_switcher, api_method, *args, **kwargs):
+    # api_method is either the name of an API method or a function that takes the API client first
     while True:
-        j = api_func(*args, **kwargs) # "Jay"
-        if "error" in j:
-            error_message = j["error"]["message"]
-            if "invalid_grant" in error_message:
-                # TODO create some sort of function thing for this oauth handler thing
-                logging.getLogger().debug("OAuth error detected; refreshing access token")
-                handle_oauth_error(api, token_switcher)
-                continue
-            if "Rate Limit" in error_message:
-                #logging.getLogger().info("We got rate limited; trying again in 5 seconds...")
-                token_switcher.switch_token()
-                token_switcher.refresh_token()
-                #logging.getLogger().info(f"Switch to account {token_switcher.current_token}")
-                api.set_auth(token_switcher.get_access_token())
-                continue
-            logging.getLogger().error("Unknown error. Please handle it properly. %s", j)
-        return j
+        with token_switcher.lease() as token:
+            # before the access token, so a refresh in between can't make us think the new one failed
+            generation = token.generation
+            with clients.client(token.access_token) as api:
+                start = time.monotonic()
+                if isinstance(api_method, str):
+                    j = getattr(api, api_method)(*args, **kwargs) # "Jay"
+                else:
+                    j = api_method(api, *args, **kwargs)
+                metrics.API_SECONDS.observe(time.monotonic() - start, account=token.index)
+                if "error" in j:
+                    error_message = j["error"]["message"]
+                    if "invalid_grant" in error_message:
+                        # the next lease picks up the refreshed token
+                        logging.getLogger().debug(f"OAuth error detected; refreshing access token for account {token.index}")
+                        token.refresh(generation)
+                        continue
+                    if "Rate Limit" in error_message:
+                        # leave this account alone for a while, the next lease picks another one
+                        token.rate_limited()
+                        continue
+                    logging.getLogger().error("Unknown error. Please handle it properly. %s", j)
+                else:
+                    token.succeeded()
+                return j
 
 def hrdatetime():
     return datetime.datetime.now().strftime("%Y-%b-%d %H:%M:%S")
@@ -0,0 +1,47 @@
+import jsoncodec
+import logging
+import os
+import threading
+
+WATERMARK_PATH = "./watermarks.json"
+
+# Newest illustration ID we've seen from each artist. pixiv returns illustrations newest first, so
+# when checking an artist we can stop at the first one that isn't newer than this.
+class WatermarkCache:
+    def __init__(self, path=WATERMARK_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.watermarks = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as watermarks_json:
+                self.watermarks = {int(k): v for k, v in jsoncodec.load(watermarks_json).items()}
+
+    def get(self, artist_id):
+        return self.watermarks.get(artist_id)
+
+    def update(self, artist_id, illust_id):
+        with self.lock:
+            # an artist with nothing posted gets 0, so they still count as polled (see seeder.py)
+            if artist_id not in self.watermarks or illust_id > self.watermarks[artist_id]:
+                self.watermarks[artist_id] = illust_id
+                self.dirty = True
+
+    def seed_from_log(self, illusts):
+        # no watermarks yet (just turned on or upgraded): everyone we've logged something from has
+        # been polled before, so they shouldn't count as new artists (see seeder.py)
+        for illust in illusts:
+            artist_id = illust["user"].get("id")
+            if artist_id is not None:
+                self.update(artist_id, illust["id"])
+        logging.getLogger().info("Filled in watermarks for %d artists from the illustration log", len(self.watermarks))
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as watermarks_json:
+                jsoncodec.dump(self.watermarks, watermarks_json)
+            os.replace(temp_path, self.path)
+            self.dirty = False